@@ -0,0 +1,94 @@
+"""
+JWT authentication costing at most one query per request.
+
+The user of a verified token is loaded on first use, with its profile and therapist in the same
+query. Tokens also carry the CLAIMS below, so a view that needs nothing more (get_claim) answers
+without loading the user at all. Only values that never change once set are claims, so not
+is_therapist, which a client becoming a therapist flips; a claim unset when the token was issued is
+read from the database instead. Such a view doesn't see a user deactivated
+after the token was issued, as with simplejwt's TokenUser.
+"""
+import uuid
+from django.contrib.auth import get_user_model
+from django.utils.functional import SimpleLazyObject, empty
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt import authentication, serializers
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import Token
+
+# claim: (relation of the user, field)
+CLAIMS = {
+    'profile': ('profile', 'surrogate'),
+    'stripe_id': ('profile', 'stripe_id'),
+    'therapist_id': ('therapist', 'id'),
+}
+
+
+def read_claim(user, name):
+    relation, field = CLAIMS[name]
+    # users made with createsuperuser have no profile
+    value = getattr(getattr(user, relation, None), field, None)
+    return str(value) if isinstance(value, uuid.UUID) else value
+
+
+def get_claim(request, name):
+    """
+    A claim of the request's token, read from its user when the token doesn't carry it.
+    """
+    token = getattr(request, 'auth', None)
+    value = token.get(name) if isinstance(token, Token) else None
+    return read_claim(request.user, name) if value is None else value
+
+
+def load_user(user_id):
+    user = get_user_model().objects.select_related('profile', 'therapist')\
+        .filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    if user is None:
+        raise AuthenticationFailed(_('User not found'), code='user_not_found')
+    if not user.is_active:
+        raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+    return user
+
+
+class LazyUser(SimpleLazyObject):
+    """
+    The user of a token, loaded on first use. Its pk and whether it's authenticated come from the token.
+    """
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id):
+        super().__init__(lambda: load_user(user_id))
+        self.__dict__['pk'] = self.__dict__['id'] = user_id
+
+    def __bool__(self):
+        # IsAuthenticated checks request.user before is_authenticated
+        return True
+
+    def load(self):
+        """
+        The user itself, raises AuthenticationFailed when it was deleted or deactivated since the token was issued.
+        """
+        if self._wrapped is empty:
+            self._setup()
+        return self._wrapped
+
+
+class JWTAuthentication(authentication.JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        return LazyUser(user_id)
+
+
+class TokenObtainPairSerializer(serializers.TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        # access tokens made from the refresh token copy its claims
+        token = super().get_token(user)
+        for name in CLAIMS:
+            token[name] = read_claim(user, name)
+        return token
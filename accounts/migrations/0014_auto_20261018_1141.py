@@ -0,0 +1,37 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_user_username'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='stripe_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='stripe_next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='stripe_status',
+            field=models.CharField(choices=[('NR', 'Not required'), ('PD', 'Pending'), ('PV', 'Provisioned'), ('FL', 'Failed')], default='NR', max_length=2),
+        ),
+        migrations.RunSQL(
+            "UPDATE accounts_userprofile SET stripe_status = 'PV' WHERE stripe_id IS NOT NULL",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(condition=models.Q(stripe_status='PD'), fields=['stripe_next_attempt_at'], name='profile_stripe_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_auto_20261018_1141'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(condition=models.Q(charges_enabled=True), fields=['user'], name='profile_listed_idx'),
+        ),
+    ]
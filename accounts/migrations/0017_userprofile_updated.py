@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_userprofile_calendar_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
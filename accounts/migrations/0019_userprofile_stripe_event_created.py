@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0018_userprofile_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='stripe_event_created',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
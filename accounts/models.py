@@ -1,6 +1,8 @@
 from django.db import models
 from django.apps import apps
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
+from django.db.models.signals import post_save
 from django.dispatch import receiver
 from allauth.account.signals import user_signed_up
 import uuid
@@ -20,16 +22,57 @@ class User(AbstractUser):
 
 
 class UserProfile(models.Model):
+    STRIPE_NOT_REQUIRED = 'NR'
+    STRIPE_PENDING = 'PD'
+    STRIPE_PROVISIONED = 'PV'
+    STRIPE_FAILED = 'FL'
+
+    STRIPE_STATUS_CHOICES = [
+        (STRIPE_NOT_REQUIRED, 'Not required'),
+        (STRIPE_PENDING, 'Pending'),
+        (STRIPE_PROVISIONED, 'Provisioned'),
+        (STRIPE_FAILED, 'Failed'),
+    ]
+
     surrogate = models.UUIDField(default=uuid.uuid4, db_index=True)
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
     name = models.CharField(blank=False, null=False, max_length=60, default="")
     avatar = models.ImageField(upload_to='avatars', null=True, blank=True)
+    # re-encoded avatar and its thumbnails, maintained by images.queue
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     is_therapist = models.BooleanField(default=False)
     stripe_id = models.CharField(max_length=40, null=True, blank=True)
     stripe_account_link = models.URLField(blank=True, null=True)
     charges_enabled = models.BooleanField(default=False)
     created = models.IntegerField(null=True, blank=True)
     expires_at = models.IntegerField(null=True, blank=True)
+    # the Stripe account of a therapist is provisioned after signup by the payments worker
+    stripe_status = models.CharField(max_length=2, choices=STRIPE_STATUS_CHOICES, default=STRIPE_NOT_REQUIRED)
+    stripe_attempts = models.IntegerField(default=0)
+    stripe_next_attempt_at = models.DateTimeField(default=timezone.now)
+    # Stripe's timestamp of the last account.updated event applied, older ones arriving late are ignored
+    stripe_event_created = models.IntegerField(null=True, blank=True)
+    # secret of the user's calendar feed url, created when they first ask for it
+    calendar_token = models.UUIDField(null=True, blank=True, unique=True, editable=False)
+    # validator of the conditional GETs of user/me, queryset.update() calls have to set it themselves
+    updated = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f'{self.user.email} - {self.name}'
+
+    class Meta:
+        indexes = [
+            # the payments worker's provisioning queue
+            models.Index(fields=['stripe_next_attempt_at'], name='profile_stripe_pending_idx',
+                         condition=models.Q(stripe_status='PD')),
+            # the join behind the public therapist directory, which only lists therapists taking payments
+            models.Index(fields=['user'], name='profile_listed_idx', condition=models.Q(charges_enabled=True)),
+        ]
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, update_fields=None, **kwargs):
+    # user/me also shows the email, logging in only moves last_login
+    if created or update_fields == frozenset(['last_login']):
+        return
+    UserProfile.objects.filter(user=instance).update(updated=timezone.now())
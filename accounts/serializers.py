@@ -2,15 +2,16 @@ import os
 from django.contrib.sites.models import Site
 from django.contrib.auth.forms import PasswordResetForm
 from django.conf import settings
+from django.db import transaction
 from django.utils.translation import gettext as _
 from rest_auth.registration.serializers import RegisterSerializer
 from rest_auth.serializers import PasswordResetSerializer, PasswordResetConfirmSerializer
 from allauth.account.adapter import get_adapter
 from allauth.account.utils import setup_user_email
 from rest_framework import serializers
-from therapist.models import Therapist, TherapistSpecialties
+from therapist import geocoding
+from therapist.models import Specialty, Therapist, TherapistSpecialties
 from .models import UserProfile, User
-import stripe
 
 
 class RegistrationSerializer(RegisterSerializer):
@@ -39,35 +40,39 @@ class RegistrationSerializer(RegisterSerializer):
         }
 
     def save(self, request):
-        adapter = get_adapter()
-        user = adapter.new_user(request)
-        self.cleaned_data = self.get_cleaned_data()
-        adapter.save_user(request, user, self)
-        setup_user_email(request, user, [])
-
-        if self.cleaned_data.get('is_therapist', False):
-            is_therapist = True
-        else:
-            is_therapist = False
-        user_profile = UserProfile.objects.create(user=user,
-                                                  is_therapist=is_therapist,
-                                                  name=self.cleaned_data.get('name', ''))
-
-        if is_therapist:
-            therapist = Therapist.objects.create(user=user, bio=self.cleaned_data.get('bio', ''),
-                                                 phone_number=self.validated_data.get('phone_number', ''),
-                                                 office_number=self.validated_data.get('office_number', ''),
-                                                 address=self.validated_data.get('address', ''))
-            specialties = self.validated_data.get('specialties', '').split(",")
-            for specialty in specialties:
-                TherapistSpecialties.objects.create(therapist=therapist, specialty=specialty)
-
-            # only handling stripe accounts for therapists for now
-            # TODO run this again in case of migration from regular account -> therapist account
-            account = setup_stripe_account(user, user_profile)
-
-        user_profile.save()
-        user.save()
+        # the Stripe account is provisioned by the payments worker once this commits,
+        # clients can follow it through profile.stripe_status
+        with transaction.atomic():
+            adapter = get_adapter()
+            user = adapter.new_user(request)
+            self.cleaned_data = self.get_cleaned_data()
+            adapter.save_user(request, user, self)
+            setup_user_email(request, user, [])
+
+            if self.cleaned_data.get('is_therapist', False):
+                is_therapist = True
+            else:
+                is_therapist = False
+            user_profile = UserProfile.objects.create(
+                user=user,
+                is_therapist=is_therapist,
+                name=self.cleaned_data.get('name', ''),
+                # only handling stripe accounts for therapists for now
+                # TODO provision again in case of migration from regular account -> therapist account
+                stripe_status=UserProfile.STRIPE_PENDING if is_therapist else UserProfile.STRIPE_NOT_REQUIRED,
+            )
+
+            if is_therapist:
+                therapist = Therapist(user=user, bio=self.cleaned_data.get('bio', ''),
+                                      phone_number=self.validated_data.get('phone_number', ''),
+                                      office_number=self.validated_data.get('office_number', ''),
+                                      address=self.validated_data.get('address', ''))
+                geocoding.locate(therapist)
+                therapist.save()
+                specialties = Specialty.get_or_create_many(self.validated_data.get('specialties', '').split(","))
+                TherapistSpecialties.objects.bulk_create([
+                    TherapistSpecialties(therapist=therapist, specialty=specialty) for specialty in specialties
+                ])
         return user
 
 
@@ -90,37 +95,3 @@ class CustomPasswordResetConfirmSerializer(PasswordResetConfirmSerializer):
                 'frontend_url': 'https://%s' % (Site.objects.get_current().domain),
             }
         }
-
-def setup_stripe_account(user, user_profile):
-    stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-
-    account = stripe.Account.create(
-        type="express",
-        country="GR",
-        email=user.email,
-        capabilities={
-            "card_payments": {"requested": True},
-            "transfers": {"requested": True},
-        },
-    )
-
-    if settings.DEBUG:
-        redirect = 'http://localhost:3000/users/oauth/callback'
-        refresh_url = "http://localhost:3000/reauth"
-    else:
-        redirect = 'https://%s%s' % (Site.objects.get_current().domain, '/users/oauth/callback')
-        refresh_url = 'https://%s%s' % (Site.objects.get_current().domain, '/reauth')
-
-    account_link = stripe.AccountLink.create(
-        account=account.id,
-        refresh_url=refresh_url,
-        return_url=redirect,
-        type="account_onboarding",
-    )
-
-    user_profile.stripe_id = account.id
-    user_profile.stripe_account_link = account_link.url
-    user_profile.created = account_link.created
-    user_profile.expires_at = account_link.expires_at
-    user_profile.save()
-    return account_link
@@ -1,3 +1,417 @@
-from django.test import TestCase
+import csv
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import time, timedelta
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from accounts.authentication import TokenObtainPairSerializer
+from accounts.models import User, UserProfile
+from reviews.models import Review
+from therapist import geocoding
+from therapist.geocoding import nearby
+from therapist.models import AvailableTimeRange, Specialty, Therapist, TherapySession
 
-# Create your tests here.
+THERAPISTS = 5
+SESSIONS_PER_THERAPIST = 3
+
+
+def create_user(email, is_therapist=False, charges_enabled=False):
+    user = User.objects.create(email=email)
+    UserProfile.objects.create(user=user, name=email.split('@')[0], is_therapist=is_therapist,
+                               charges_enabled=charges_enabled)
+    return user
+
+
+def authorization(user):
+    return {'HTTP_AUTHORIZATION': f'Bearer {TokenObtainPairSerializer.get_token(user).access_token}'}
+
+
+class QueryCountTests(TestCase):
+    """
+    The v1 lists run a fixed number of queries however many rows they return, an N+1 fails these.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = create_user('client@example.com')
+        specialties = [Specialty.objects.create(name=name, slug=name) for name in ('cbt', 'couples')]
+        cls.therapists = []
+        start = timezone.now() + timedelta(days=1)
+        for i in range(THERAPISTS):
+            therapist = Therapist.objects.create(
+                user=create_user(f'therapist{i}@example.com', is_therapist=True, charges_enabled=True), bio='bio')
+            therapist.specialties.set(specialties)
+            AvailableTimeRange.objects.bulk_create([
+                AvailableTimeRange(therapist=therapist, weekday=weekday, start_time=time(9), end_time=time(17))
+                for weekday in (1, 2)])
+            for j in range(SESSIONS_PER_THERAPIST):
+                client = cls.client_user if j == 0 else create_user(f'client{i}-{j}@example.com')
+                TherapySession.objects.create(therapist=therapist, user=client, start_date=start + timedelta(hours=j))
+            Review.objects.create(user=cls.client_user, therapist=therapist, stars=4)
+            cls.therapists.append(therapist)
+
+    def setUp(self):
+        # the directory is cached across requests, see therapist.cache
+        cache.clear()
+
+    def test_therapist_list(self):
+        # the page, the therapists with their profiles, availability and specialties
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/v1/therapists/')
+        self.assertEqual(len(response.json()['results']), THERAPISTS)
+        # served from the cache
+        with self.assertNumQueries(0):
+            self.client.get('/api/v1/therapists/')
+
+    def test_therapist_list_with_review(self):
+        self.client.get('/api/v1/therapists/')
+        headers = authorization(self.client_user)
+        # the requester, then their reviews for the whole page
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/therapists/', **headers)
+        self.assertTrue(all(therapist['review'] for therapist in response.json()['results']))
+
+    def test_therapist_detail(self):
+        # Last-Modified, then the therapist as in the list
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/v1/therapists/{self.therapists[0].surrogate}/')
+        self.assertEqual(len(response.json()['availability_times']), 2)
+
+    def test_my_sessions_of_client(self):
+        headers = authorization(self.client_user)
+        # the token has no therapist_id, so the user is loaded to check they didn't become one
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/my_sessions/', **headers)
+        self.assertEqual(len(response.json()['results']), THERAPISTS)
+
+    def test_my_sessions_of_therapist(self):
+        headers = authorization(self.therapists[0].user)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/my_sessions/', **headers)
+        self.assertEqual(len(response.json()['results']), SESSIONS_PER_THERAPIST)
+
+    def test_reviews(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/reviews/')
+        self.assertEqual(len(response.json()['results']), THERAPISTS)
+
+    def test_user_me(self):
+        headers = authorization(self.therapists[0].user)
+        # the requester for the permission check, Last-Modified, the user with profile and therapist,
+        # then availability, specialties and the sessions with their clients' profiles
+        with self.assertNumQueries(6):
+            response = self.client.get('/api/v1/user/me/?expand=therapist.sessions', **headers)
+        self.assertEqual(len(response.json()[0]['therapist']['sessions']), SESSIONS_PER_THERAPIST)
+
+
+class SlotsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.therapists = [Therapist.objects.create(
+            user=create_user(f'therapist{i}@example.com', is_therapist=True, charges_enabled=True))
+            for i in range(2)]
+        for therapist in cls.therapists:
+            AvailableTimeRange.objects.bulk_create([
+                AvailableTimeRange(therapist=therapist, weekday=weekday, start_time=time(9), end_time=time(17))
+                for weekday in range(1, 8)])
+
+    def test_slots(self):
+        response = self.client.get(f'/api/v1/therapists/{self.therapists[0].surrogate}/slots/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['slots'])
+
+    def test_slots_of_malformed_surrogate(self):
+        self.assertEqual(self.client.get('/api/v1/therapists/not-a-uuid/slots/').status_code, 404)
+
+    def test_batch_slots(self):
+        surrogates = [str(therapist.surrogate) for therapist in self.therapists]
+        response = self.client.get(f'/api/v1/therapists/slots/?therapists={",".join(surrogates)}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(therapist['therapist'] for therapist in response.json()), sorted(surrogates))
+
+    def test_batch_slots_of_malformed_surrogate(self):
+        response = self.client.get(f'/api/v1/therapists/slots/?therapists={self.therapists[0].surrogate},not-a-uuid')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('therapists', response.json())
+
+
+ADDRESSES = {
+    'Syntagma Square, Athens': (37.9755, 23.7348),
+    'Acropolis Museum, Athens': (37.9685, 23.7285),
+    'Port of Piraeus': (37.9420, 23.6465),
+    'Aristotelous Square, Thessaloniki': (40.6325, 22.9410),
+    # either side of the antimeridian, and of the north pole
+    'Taveuni East': (-17.0, 179.95),
+    'Taveuni West': (-17.0, -179.95),
+    'North Pole East': (89.95, 0.0),
+    'North Pole West': (89.95, 180.0),
+}
+
+
+class NearbyTests(TestCase):
+    """
+    Therapists are located by the FileGeocoder from a CSV of ADDRESSES.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join(cls.directory, 'addresses.csv')
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['address', 'latitude', 'longitude'])
+            writer.writerows((address, *location) for address, location in ADDRESSES.items())
+        cls.settings_override = override_settings(GEOCODER='therapist.geocoding.FileGeocoder', GEOCODER_FILE=path)
+        cls.settings_override.enable()
+        geocoding.get_geocoder.cache_clear()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        geocoding.get_geocoder.cache_clear()
+        shutil.rmtree(cls.directory)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.therapists = {}
+        for i, address in enumerate(ADDRESSES):
+            therapist = Therapist(user=create_user(f'therapist{i}@example.com', is_therapist=True,
+                                                   charges_enabled=True), address=address)
+            geocoding.locate(therapist)
+            therapist.save()
+            cls.therapists[address] = therapist
+
+    def setUp(self):
+        cache.clear()
+
+    def found(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [therapist['address'] for therapist in response.json()['results']]
+
+    def nearby(self, latitude, longitude, radius_km):
+        return {therapist.address for therapist in nearby(Therapist.objects.all(), latitude, longitude, radius_km)}
+
+    def test_located(self):
+        therapist = self.therapists['Port of Piraeus']
+        self.assertEqual((therapist.latitude, therapist.longitude), ADDRESSES['Port of Piraeus'])
+
+        response = self.client.patch(f'/api/v1/update_therapist_profile/{therapist.pk}/',
+                                     {'address': '  syntagma square,   ATHENS'}, content_type='application/json',
+                                     **authorization(therapist.user))
+        self.assertEqual(response.status_code, 200)
+        therapist.refresh_from_db()
+        self.assertEqual((therapist.latitude, therapist.longitude), ADDRESSES['Syntagma Square, Athens'])
+
+        # unknown addresses aren't placed anywhere
+        response = self.client.patch(f'/api/v1/update_therapist_profile/{therapist.pk}/',
+                                     {'address': 'Nowhere'}, content_type='application/json',
+                                     **authorization(therapist.user))
+        self.assertEqual(response.status_code, 200)
+        therapist.refresh_from_db()
+        self.assertEqual((therapist.latitude, therapist.longitude), (None, None))
+
+    def test_nearest_first(self):
+        self.assertEqual(self.found('/api/v1/therapists/?near=37.9755,23.7348'),
+                         ['Syntagma Square, Athens', 'Acropolis Museum, Athens', 'Port of Piraeus'])
+        # Piraeus is 8.7km away, Thessaloniki over 300km
+        self.assertEqual(self.found('/api/v1/therapists/?near=37.9755,23.7348&radius=5'),
+                         ['Syntagma Square, Athens', 'Acropolis Museum, Athens'])
+        self.assertEqual(self.found('/api/v1/therapists/?near=40.64,22.94&radius=100'),
+                         ['Aristotelous Square, Thessaloniki'])
+
+    def test_invalid(self):
+        for query in ('near=37.9', 'near=athens', 'near=37.9,23.7,1', 'near=91,23.7', 'near=37.9,181',
+                      'near=37.9,23.7&radius=many', 'near=37.9,23.7&radius=0', 'near=37.9,23.7&radius=101'):
+            self.assertEqual(self.client.get(f'/api/v1/therapists/?{query}').status_code, 400, query)
+
+    def test_pages(self):
+        url, found = '/api/v1/therapists/?near=37.9755,23.7348&page_size=1', []
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page['results']), 1)
+            found.extend(therapist['address'] for therapist in page['results'])
+            url = page['next']
+        self.assertEqual(found, ['Syntagma Square, Athens', 'Acropolis Museum, Athens', 'Port of Piraeus'])
+
+    def test_antimeridian(self):
+        self.assertEqual(self.nearby(-17.0, 179.99, 10), {'Taveuni East', 'Taveuni West'})
+        self.assertEqual(self.nearby(-17.0, -179.99, 10), {'Taveuni East', 'Taveuni West'})
+
+    def test_pole(self):
+        # 11km apart, over the pole
+        self.assertEqual(self.nearby(89.95, 0.0, 20), {'North Pole East', 'North Pole West'})
+        self.assertEqual(self.nearby(89.99, 90.0, 20), {'North Pole East', 'North Pole West'})
+
+
+def schedule(therapist, *time_ranges):
+    return {'therapist': str(therapist.surrogate), 'available_times': [
+        {'weekday': weekday, 'start_time': start_time, 'end_time': end_time}
+        for weekday, start_time, end_time in time_ranges]}
+
+
+def stored_schedule(therapist):
+    return sorted(AvailableTimeRange.objects.filter(therapist=therapist)
+                  .values_list('weekday', 'start_time', 'end_time'))
+
+
+class BulkAvailabilityTests(TestCase):
+    url = '/api/v1/therapists/availability/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = create_user('staff@example.com')
+        User.objects.filter(pk=cls.staff.pk).update(is_staff=True)
+        cls.therapists = [Therapist.objects.create(
+            user=create_user(f'therapist{i}@example.com', is_therapist=True, charges_enabled=True))
+            for i in range(2)]
+        AvailableTimeRange.objects.bulk_create([
+            AvailableTimeRange(therapist=therapist, weekday=weekday, start_time=time(9), end_time=time(12))
+            # a duplicate of the monday range
+            for therapist in cls.therapists for weekday in (1, 1, 2)])
+
+    def post(self, user, *schedules):
+        return self.client.post(self.url, {'schedules': list(schedules)}, content_type='application/json',
+                                **authorization(user))
+
+    def test_replace(self):
+        kept = AvailableTimeRange.objects.filter(therapist=self.therapists[0], weekday=1).order_by('pk').first()
+        response = self.post(self.staff, schedule(self.therapists[0], (1, '09:00', '12:00'), (3, '10:00', '11:00')),
+                             schedule(self.therapists[1]))
+        self.assertEqual(response.status_code, 200)
+        # the monday duplicate and tuesday of the first, everything of the second
+        self.assertEqual(response.json(), {'deleted': 5, 'created': 1})
+        self.assertEqual(stored_schedule(self.therapists[0]), [(1, time(9), time(12)), (3, time(10), time(11))])
+        self.assertEqual(stored_schedule(self.therapists[1]), [])
+        # unchanged rows are left in place
+        self.assertTrue(AvailableTimeRange.objects.filter(pk=kept.pk).exists())
+
+    def test_unchanged(self):
+        response = self.post(self.staff, schedule(self.therapists[0], (1, '09:00', '12:00'), (2, '09:00', '12:00')))
+        self.assertEqual(response.json(), {'deleted': 1, 'created': 0})
+
+    def test_conflicts(self):
+        response = self.post(self.staff, schedule(self.therapists[0], (1, '09:00', '12:00'), (1, '11:00', '13:00'),
+                                                  (2, '12:00', '10:00'), (3, '09:00', '10:00'), (3, '10:00', '11:00')))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'schedules': {'0': {'available_times': [
+            '11:00:00-13:00:00 overlaps 09:00:00-12:00:00 on weekday 1.',
+            '12:00:00-10:00:00 on weekday 2 ends before it starts.',
+        ]}}})
+        self.assertEqual(len(stored_schedule(self.therapists[0])), 3)
+
+    def test_unknown_therapist(self):
+        unknown = uuid.uuid4()
+        response = self.post(self.staff, {'therapist': str(unknown), 'available_times': []})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'schedules': [f'Unknown therapists: {unknown}.']})
+
+    def test_therapist_listed_twice(self):
+        response = self.post(self.staff, schedule(self.therapists[0]), schedule(self.therapists[0]))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'schedules': ['Each therapist can only be listed once.']})
+
+    def test_staff_only(self):
+        self.assertEqual(self.post(self.therapists[0].user, schedule(self.therapists[0])).status_code, 403)
+        self.assertEqual(self.client.post(self.url, {'schedules': []}, content_type='application/json').status_code,
+                         401)
+        self.assertEqual(len(stored_schedule(self.therapists[0])), 3)
+
+
+class BulkAvailabilityQueryCountTests(TransactionTestCase):
+    """
+    A TransactionTestCase, so the cache bumps registered with on_commit run and are counted.
+    """
+    RANGES = 10
+
+    def test_query_count(self):
+        staff = create_user('staff@example.com')
+        User.objects.filter(pk=staff.pk).update(is_staff=True)
+        therapist = Therapist.objects.create(user=create_user('therapist@example.com', is_therapist=True))
+        AvailableTimeRange.objects.bulk_create([
+            AvailableTimeRange(therapist=therapist, weekday=1, start_time=time(hour), end_time=time(hour, 30))
+            for hour in range(self.RANGES)])
+        updated = Therapist.objects.get(pk=therapist.pk).updated
+        headers = authorization(staff)
+        body = {'schedules': [schedule(therapist, *[(2, f'{hour:02}:00', f'{hour:02}:30')
+                                                    for hour in range(self.RANGES)])]}
+
+        # the requester, the therapists, then locking them, their ranges, the ranges to delete and the
+        # delete, the insert, and a single bump: the update of the therapists and their surrogates
+        with self.assertNumQueries(9):
+            response = self.client.post('/api/v1/therapists/availability/', body, content_type='application/json',
+                                        **headers)
+        self.assertEqual(response.json(), {'deleted': self.RANGES, 'created': self.RANGES})
+        self.assertGreater(Therapist.objects.get(pk=therapist.pk).updated, updated)
+
+
+class CalendarFeedTests(TestCase):
+    SESSIONS = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        therapist = Therapist.objects.create(user=create_user('therapist@example.com', is_therapist=True,
+                                                              charges_enabled=True))
+        client = create_user('client@example.com')
+        start = timezone.now() + timedelta(days=1)
+        for i in range(cls.SESSIONS):
+            TherapySession.objects.create(therapist=therapist, user=client, start_date=start + timedelta(hours=i))
+        token = uuid.uuid4()
+        UserProfile.objects.filter(user=client).update(calendar_token=token)
+        cls.url = f'/api/v1/calendar/{token}.ics'
+
+    def test_streamed(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content).count(b'BEGIN:VEVENT'), self.SESSIONS)
+
+    async def test_asgi(self):
+        # a streamed body would be iterated in the event loop, and query the database from there
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.content.count(b'BEGIN:VEVENT'), self.SESSIONS)
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    """
+    Overlapping bookings racing each other, the exclusion constraint lets exactly one through.
+    """
+    BOOKINGS = 8
+
+    def test_one_of_concurrent_overlapping_bookings_succeeds(self):
+        therapist = Therapist.objects.create(user=create_user('therapist@example.com', is_therapist=True,
+                                                              charges_enabled=True))
+        # the tokens read the users, before the threads take the pool's connections
+        headers = [authorization(create_user(f'client{i}@example.com')) for i in range(self.BOOKINGS)]
+        start = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        barrier = threading.Barrier(self.BOOKINGS, timeout=10)
+        statuses = []
+
+        def book(i):
+            try:
+                barrier.wait()
+                # every session overlaps every other one
+                response = Client().post('/api/v1/create_session/', {
+                    'therapist': str(therapist.surrogate),
+                    'start_date': (start + timedelta(minutes=5 * i)).isoformat(),
+                }, content_type='application/json', **headers[i])
+                statuses.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=book, args=(i,)) for i in range(self.BOOKINGS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(statuses), [201] + [409] * (self.BOOKINGS - 1))
+        self.assertEqual(TherapySession.objects.filter(therapist=therapist).count(), 1)
@@ -0,0 +1,78 @@
+"""
+Async versions of the views that wait on Stripe, served instead of the sync ones when ASYNC_STRIPE_VIEWS
+is set. Under the ASGI server an in-flight Stripe request holds no worker, only a coroutine.
+
+DRF's views are sync only, so authentication and the method check are done here, answering the same
+way api_view and IsAuthenticated do.
+"""
+import functools
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework.exceptions import AuthenticationFailed
+from accounts.authentication import JWTAuthentication, get_claim
+from payments import stripe_client
+from .views import account_link_params, checkout_session_params, direct_payment_params, store_account_link
+
+
+def stripe_view(methods, authenticated=True):
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            if authenticated:
+                authentication = JWTAuthentication()
+                try:
+                    # only verifies the token, the user is loaded when a view first needs it
+                    credentials = authentication.authenticate(request)
+                except AuthenticationFailed as e:
+                    return unauthorized(authentication, e.detail)
+                if credentials is None:
+                    return unauthorized(authentication, 'Authentication credentials were not provided.')
+                request.user, request.auth = credentials
+            try:
+                return await view(request, *args, **kwargs)
+            except AuthenticationFailed as e:
+                # the user was deleted or deactivated since the token was issued
+                return unauthorized(JWTAuthentication(), e.detail)
+        return wrapper
+    return decorator
+
+
+def unauthorized(authentication, detail):
+    # simplejwt's errors carry a code next to the detail, rendered as DRF would
+    response = JsonResponse(detail if isinstance(detail, dict) else {'detail': detail}, status=401)
+    response['WWW-Authenticate'] = authentication.authenticate_header(None)
+    return response
+
+
+@stripe_view(['POST'])
+async def create_direct_payment(request, stripe_id):
+    payment_intent = await stripe_client.acall('PaymentIntent.create', **direct_payment_params(stripe_id))
+    return JsonResponse({'url': payment_intent.charges.url})
+
+
+@stripe_view(['POST'])
+async def get_stripe_login(request):
+    # a query only when the token doesn't carry the claim
+    stripe_id = await sync_to_async(get_claim)(request, 'stripe_id')
+    login = await stripe_client.acall('Account.create_login_link', f'{stripe_id}')
+    return JsonResponse({'url': login.url})
+
+
+@stripe_view(['POST'])
+async def create_stripe_account_link(request):
+    user_profile = await sync_to_async(lambda: request.user.profile)()
+    account_link = await stripe_client.acall('AccountLink.create', **account_link_params(user_profile.stripe_id))
+    await sync_to_async(store_account_link)(user_profile, account_link)
+    return JsonResponse({'url': account_link.url})
+
+
+@stripe_view(['POST'], authenticated=False)
+async def create_checkout_session(request, stripe_id, session_id):
+    try:
+        checkout_session = await stripe_client.acall('checkout.Session.create',
+                                                     **checkout_session_params(stripe_id, session_id))
+        return JsonResponse({'sessionId': checkout_session['id']})
+    except Exception as e:
+        return JsonResponse({'error': str(e)})
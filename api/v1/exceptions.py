@@ -0,0 +1,28 @@
+from contextlib import contextmanager
+from django.db import IntegrityError, transaction
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+# SQLSTATE of a violated exclusion constraint
+EXCLUSION_VIOLATION = '23P01'
+
+
+class SessionConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The therapist already has a session at this time.'
+    default_code = 'session_conflict'
+
+
+@contextmanager
+def session_conflict_as_409():
+    """
+    Turns a violation of TherapySession's exclude_overlapping_sessions constraint into a 409.
+    The savepoint keeps the surrounding transaction usable.
+    """
+    try:
+        with transaction.atomic():
+            yield
+    except IntegrityError as e:
+        if getattr(e.__cause__, 'pgcode', None) == EXCLUSION_VIOLATION:
+            raise SessionConflict()
+        raise
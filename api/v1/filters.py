@@ -0,0 +1,72 @@
+import django_filters
+from django.db.models import Count
+from django.utils import timezone
+from therapist.models import Therapist, TherapistSpecialties, TherapySession
+from rest_framework.exceptions import ValidationError
+from therapist.geocoding import nearby
+from therapist.search import search
+
+
+class TherapistFilter(django_filters.FilterSet):
+    # comma separated slugs, therapists must have all of them
+    specialty = django_filters.CharFilter(method='filter_specialty')
+    # full-text search, results are ordered by rank
+    q = django_filters.CharFilter(method='filter_search')
+    # "latitude,longitude", with an optional ?radius= in km, results are ordered by distance
+    near = django_filters.CharFilter(method='filter_near')
+
+    DEFAULT_RADIUS_KM = 10
+    MAX_RADIUS_KM = 100
+
+    def filter_specialty(self, queryset, name, value):
+        slugs = {slug.strip().lower() for slug in value.split(',') if slug.strip()}
+        if not slugs:
+            return queryset
+
+        # an index scan on (specialty, therapist), grouped per therapist, inside the main query
+        matching = TherapistSpecialties.objects.filter(specialty__slug__in=slugs)\
+            .values('therapist_id').annotate(matches=Count('specialty_id'))\
+            .filter(matches=len(slugs)).values('therapist_id')
+        return queryset.filter(pk__in=matching)
+
+    def filter_search(self, queryset, name, value):
+        if not value.strip():
+            return queryset
+        return search(queryset, value)
+
+    def filter_near(self, queryset, name, value):
+        try:
+            latitude, longitude = (float(coordinate) for coordinate in value.split(','))
+            radius = float(self.data.get('radius', self.DEFAULT_RADIUS_KM))
+        except ValueError:
+            raise ValidationError({'near': 'Expected "latitude,longitude" and a numeric radius.'})
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValidationError({'near': 'Coordinates out of range.'})
+        if not 0 < radius <= self.MAX_RADIUS_KM:
+            raise ValidationError({'radius': f'Must be between 0 and {self.MAX_RADIUS_KM} km.'})
+        return nearby(queryset, latitude, longitude, radius)
+
+    class Meta:
+        model = Therapist
+        fields = ['specialty', 'q', 'near']
+
+
+class TherapySessionFilter(django_filters.FilterSet):
+    UPCOMING = 'upcoming'
+    PAST = 'past'
+
+    # upcoming sessions haven't ended yet, they are paged soonest first and past ones latest first
+    when = django_filters.ChoiceFilter(choices=[(UPCOMING, 'Upcoming'), (PAST, 'Past')], method='filter_when')
+    # ?status=PD&status=AC
+    status = django_filters.MultipleChoiceFilter(choices=TherapySession.STATUS_CHOICES)
+    after = django_filters.IsoDateTimeFilter(field_name='start_date', lookup_expr='gte')
+    before = django_filters.IsoDateTimeFilter(field_name='start_date', lookup_expr='lt')
+
+    def filter_when(self, queryset, name, value):
+        if value == self.UPCOMING:
+            return queryset.filter(end_date__gt=timezone.now())
+        return queryset.filter(end_date__lte=timezone.now())
+
+    class Meta:
+        model = TherapySession
+        fields = ['when', 'status', 'after', 'before']
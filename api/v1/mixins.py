@@ -0,0 +1,112 @@
+import hashlib
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+def parse_field_paths(value):
+    """
+    Parses a comma separated query param like "id,profile.name" into a set of field paths.
+    """
+    if not value:
+        return None
+    return {path.strip() for path in value.split(',') if path.strip()}
+
+
+def split_field_paths(paths):
+    """
+    Splits {'id', 'profile.name'} into the top level names {'id', 'profile'}
+    and the nested paths of each field {'profile': {'name'}}.
+    """
+    top, nested = set(), {}
+    for path in paths or ():
+        name, _, rest = path.partition('.')
+        top.add(name)
+        if rest:
+            nested.setdefault(name, set()).add(rest)
+    return top, nested
+
+
+class SparseFieldsSerializerMixin:
+    """
+    Drops the fields the client didn't ask for before anything is computed.
+
+    `fields` in the context restricts the output to the listed fields, and the relations
+    in Meta.expandable_fields are left out unless they are listed in `expand`. Dotted
+    paths ("profile.name") are handed down to the nested serializer through nested_context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsSerializerMixin, self).__init__(*args, **kwargs)
+        fields, self._nested_fields = split_field_paths(self.context.get('fields'))
+        expand, self._nested_expand = split_field_paths(self.context.get('expand'))
+        expandable = getattr(self.Meta, 'expandable_fields', [])
+
+        for name in list(self.fields):
+            if name in expandable:
+                if name not in expand:
+                    self.fields.pop(name)
+            elif self.context.get('fields') and name not in fields:
+                self.fields.pop(name)
+
+    def nested_context(self, field_name):
+        return {
+            'fields': self._nested_fields.get(field_name),
+            'expand': self._nested_expand.get(field_name),
+        }
+
+
+class SparseFieldsViewMixin:
+    """
+    Passes ?fields= and ?expand= to the serializer context.
+    """
+
+    def get_sparse_fields_context(self):
+        return {
+            'fields': parse_field_paths(self.request.query_params.get('fields')),
+            'expand': parse_field_paths(self.request.query_params.get('expand')),
+        }
+
+    def get_serializer_context(self):
+        context = super(SparseFieldsViewMixin, self).get_serializer_context()
+        context.update(self.get_sparse_fields_context())
+        return context
+
+    def get_requested_fields(self):
+        return self.get_serializer().fields.keys()
+
+
+class ConditionalGetViewMixin:
+    """
+    ETag and Last-Modified validators derived from get_last_modified(), which should be a single
+    indexed query. Views wrap their handler in conditional_response(), when the client's copy is
+    still current the answer is a 304 and the object is neither loaded nor serialized.
+    """
+
+    def get_last_modified(self):
+        """
+        When the requested representation last changed, or None to skip the conditional handling.
+        """
+        raise NotImplementedError
+
+    def get_etag(self, last_modified):
+        # the representation also depends on who is asking and on ?fields=/?expand=
+        key = f'{last_modified.isoformat()}:{self.request.user.pk}:{self.request.get_full_path()}'
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+    def conditional_response(self, request, render):
+        last_modified = self.get_last_modified()
+        if last_modified is None:
+            return render()
+
+        etag = self.get_etag(last_modified)
+        timestamp = int(last_modified.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = render()
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(timestamp)
+            # the client may keep its copy but has to revalidate it, shared caches can't tell users apart
+            response['Cache-Control'] = 'private, no-cache'
+            patch_vary_headers(response, ['Authorization'])
+        return response
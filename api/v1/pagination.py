@@ -0,0 +1,42 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Opaque cursor pagination, pages are fetched with `WHERE <ordering> > <cursor> LIMIT n`
+    so deep pages cost as much as the first one and no COUNT(*) is ever run.
+    """
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+
+class TherapistPagination(KeysetPagination):
+    ordering = 'created'
+
+    def get_ordering(self, request, queryset, view):
+        # search results (see TherapistFilter) are paged by relevance, or nearest first
+        if 'rank' in queryset.query.annotations:
+            return ('-rank',)
+        if 'distance' in queryset.query.annotations:
+            return ('distance',)
+        return super(TherapistPagination, self).get_ordering(request, queryset, view)
+
+
+class TherapySessionPagination(KeysetPagination):
+    ordering = '-created'
+
+    def get_ordering(self, request, queryset, view):
+        # see TherapySessionFilter.when
+        when = request.query_params.get('when')
+        if when == 'upcoming':
+            return ('start_date',)
+        if when == 'past':
+            return ('-start_date',)
+        return super(TherapySessionPagination, self).get_ordering(request, queryset, view)
+
+
+class ReviewPagination(KeysetPagination):
+    # reviews have no timestamp, the primary key follows insertion order
+    ordering = 'id'
@@ -1,33 +1,65 @@
 import os
+from datetime import timedelta
+from django.utils import timezone
 from rest_framework import serializers
-from django.db.models import Avg
 from accounts.models import User, UserProfile
+from images.processing import variant_urls
 from reviews.models import Review
+from therapist import geocoding
+from therapist.availability import find_conflicts, replace_time_ranges
 from therapist.models import Therapist, TherapySession, AvailableTimeRange
+from .exceptions import session_conflict_as_409
+from .mixins import SparseFieldsSerializerMixin
 import stripe
 
 
-class UserProfileSerializer(serializers.ModelSerializer):
+def get_requester_review(therapist, user):
+    if not user or not user.is_authenticated:
+        return None
+
+    # TherapistsViewSet merges the requester's reviews into its cached therapists instead
+    review = Review.objects.filter(user=user, therapist=therapist).first()
+    if review is None:
+        return None
+    return ReviewSerializer(review).data
+
+
+def get_rating_summary(therapist):
+    # denormalized on the therapist, see reviews.models.update_rating_summary
+    return {'average_rating': therapist.rating_average, 'count': therapist.rating_count,
+            'histogram': therapist.rating_histogram}
+
+
+class UserProfileSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
+    avatar_variants = serializers.SerializerMethodField()
 
     def get_id(self, profile):
         return profile.surrogate
 
+    def get_avatar_variants(self, profile):
+        return variant_urls(profile, 'avatar')
+
     class Meta:
         model = UserProfile
-        fields = ['id', 'name', 'avatar', 'is_therapist', 'stripe_id', 'stripe_account_link',
-                  'created', 'expires_at', 'charges_enabled']
+        fields = ['id', 'name', 'avatar', 'avatar_variants', 'is_therapist', 'stripe_id', 'stripe_account_link',
+                  'created', 'expires_at', 'charges_enabled', 'stripe_status']
 
 
-class PublicUserProfileSerializer(serializers.ModelSerializer):
+class PublicUserProfileSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     id = serializers.SerializerMethodField()
+    # {"96": {"webp": url, "jpg": url}, "320": {...}}, null until the upload has been processed
+    avatar_variants = serializers.SerializerMethodField()
 
     def get_id(self, profile):
         return profile.surrogate
 
+    def get_avatar_variants(self, profile):
+        return variant_urls(profile, 'avatar')
+
     class Meta:
         model = UserProfile
-        fields = ['id', 'name', 'avatar']
+        fields = ['id', 'name', 'avatar', 'avatar_variants']
 
 
 class UpdateUserProfileSerializer(serializers.ModelSerializer):
@@ -41,16 +73,16 @@ class UpdateUserProfileSerializer(serializers.ModelSerializer):
         fields = ['name', 'avatar']
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     profile = serializers.SerializerMethodField()
     therapist = serializers.SerializerMethodField()
 
     def get_profile(self, user):
-        return UserProfileSerializer(user.profile).data
+        return UserProfileSerializer(user.profile, context=self.nested_context('profile')).data
 
     def get_therapist(self, user):
         if user.profile.is_therapist:
-            return TherapistWithSessionsSerializer(user.therapist).data
+            return TherapistWithSessionsSerializer(user.therapist, context=self.nested_context('therapist')).data
         return None
 
     class Meta:
@@ -58,15 +90,20 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['email', 'profile', 'therapist']
 
 
-class TherapySessionSerializer(serializers.ModelSerializer):
+class TherapySessionSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     user = serializers.SerializerMethodField()
     therapist = serializers.SerializerMethodField()
 
     def get_user(self, session):
-        return PublicUserProfileSerializer(session.user.profile).data
+        return PublicUserProfileSerializer(session.user.profile, context=self.nested_context('user')).data
 
     def get_therapist(self, session):
-        return TherapistSerializer(session.therapist).data
+        return TherapistSerializer(session.therapist, context=self.nested_context('therapist')).data
+
+    def update(self, instance, validated_data):
+        # moving a rejected session back to pending can collide with a newer booking
+        with session_conflict_as_409():
+            return super(TherapySessionSerializer, self).update(instance, validated_data)
 
     class Meta:
         model = TherapySession
@@ -74,6 +111,33 @@ class TherapySessionSerializer(serializers.ModelSerializer):
                   'start_date', 'end_date', 'status']
 
 
+class TherapistSummarySerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
+    """
+    What a session needs to show of its therapist, all of it from therapist.user.profile.
+    """
+    id = serializers.SerializerMethodField()
+    profile = serializers.SerializerMethodField()
+
+    def get_id(self, therapist):
+        return therapist.surrogate
+
+    def get_profile(self, therapist):
+        return PublicUserProfileSerializer(therapist.user.profile, context=self.nested_context('profile')).data
+
+    class Meta:
+        model = Therapist
+        fields = ['id', 'profile', 'phone_number', 'office_number', 'address']
+
+
+class MySessionSerializer(TherapySessionSerializer):
+    """
+    The sessions of the requester, expects select_related('user__profile', 'therapist__user__profile').
+    """
+
+    def get_therapist(self, session):
+        return TherapistSummarySerializer(session.therapist, context=self.nested_context('therapist')).data
+
+
 class CreateTherapySessionSerializer(serializers.ModelSerializer):
     therapist = serializers.UUIDField(required=True)
 
@@ -85,7 +149,9 @@ class CreateTherapySessionSerializer(serializers.ModelSerializer):
             therapist_surrogate = None
 
         therapist = Therapist.objects.get(surrogate=therapist_surrogate)
-        instance = TherapySession.objects.create(user=user, therapist=therapist, **validated_data)
+        # overlapping bookings are rejected by the database, see TherapySession.Meta.constraints
+        with session_conflict_as_409():
+            instance = TherapySession.objects.create(user=user, therapist=therapist, **validated_data)
         return instance
 
     class Meta:
@@ -94,7 +160,7 @@ class CreateTherapySessionSerializer(serializers.ModelSerializer):
         read_only_fields = ['end_date', 'user']
 
 
-class TherapistSerializer(serializers.ModelSerializer):
+class TherapistSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     specialties = serializers.StringRelatedField(many=True)
     availability_times = serializers.SerializerMethodField()
     profile = serializers.SerializerMethodField()
@@ -109,20 +175,13 @@ class TherapistSerializer(serializers.ModelSerializer):
         return therapist.surrogate
 
     def get_profile(self, therapist):
-        return UserProfileSerializer(therapist.user.profile).data
+        return UserProfileSerializer(therapist.user.profile, context=self.nested_context('profile')).data
 
     def get_review(self, therapist):
-        user = self.context.get('user')
-        if user and user.is_authenticated:
-            review = Review.objects.filter(user=user, therapist=therapist)
-            if review.exists():
-                return ReviewSerializer(review.first()).data
-        return None
+        return get_requester_review(therapist, self.context.get('user'))
 
     def get_reviews(self, therapist):
-        average_rating = therapist.reviews.all().aggregate(Avg('stars'))['stars__avg']
-        rating_count = therapist.reviews.count()
-        return {'average_rating': average_rating, 'count': rating_count}
+        return get_rating_summary(therapist)
 
     class Meta:
         model = Therapist
@@ -130,7 +189,7 @@ class TherapistSerializer(serializers.ModelSerializer):
         'address', 'credit', 'availability_times', 'status', 'specialties', 'review', 'reviews']
 
 
-class TherapistWithSessionsSerializer(serializers.ModelSerializer):
+class TherapistWithSessionsSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     specialties = serializers.StringRelatedField(many=True)
     profile = serializers.SerializerMethodField()
     availability_times = serializers.SerializerMethodField()
@@ -146,28 +205,24 @@ class TherapistWithSessionsSerializer(serializers.ModelSerializer):
         return AvailableTimeRangeSerializer(therapist.available_time_ranges.all(), many=True).data
 
     def get_profile(self, therapist):
-        return UserProfileSerializer(therapist.user.profile).data
+        return UserProfileSerializer(therapist.user.profile, context=self.nested_context('profile')).data
 
     def get_sessions(self, therapist):
-        return TherapySessionSerializer(therapist.sessions.all(), many=True).data
+        return TherapySessionSerializer(therapist.sessions.all(), many=True,
+                                        context=self.nested_context('sessions')).data
 
     def get_review(self, therapist):
-        user = self.context.get('user')
-        if user and user.is_authenticated:
-            review = Review.objects.filter(user=user, therapist=therapist)
-            if review.exists():
-                return ReviewSerializer(review.first()).data
-        return None
+        return get_requester_review(therapist, self.context.get('user'))
 
     def get_reviews(self, therapist):
-        average_rating = therapist.reviews.all().aggregate(Avg('stars'))['stars__avg']
-        rating_count = therapist.reviews.count()
-        return {'average_rating': average_rating, 'count': rating_count}
+        return get_rating_summary(therapist)
 
     class Meta:
         model = Therapist
         fields = ['id', 'bio', 'profile', 'phone_number', 'office_number', 'address', 'credit', 
         'sessions', 'availability_times', 'status', 'specialties', 'review', 'reviews']
+        # only serialized when asked for with ?expand=sessions
+        expandable_fields = ['sessions']
 
 
 class ReviewSerializer(serializers.ModelSerializer):
@@ -206,14 +261,21 @@ class ReviewSerializer(serializers.ModelSerializer):
 
 
 class UpdateTherapistProfileSerializer(serializers.ModelSerializer):
+    document_variants = serializers.SerializerMethodField()
+
+    def get_document_variants(self, therapist):
+        return {field: variant_urls(therapist, field) for field in ['license', 'id_front', 'id_back']}
 
     def update(self, instance, validated_data):
+        if 'address' in validated_data and validated_data['address'] != instance.address:
+            instance.address = validated_data['address']
+            geocoding.locate(instance)
         instance = super(UpdateTherapistProfileSerializer, self).update(instance, validated_data)
         return instance
 
     class Meta:
         model = Therapist
-        fields = ['license', 'id_back', 'id_front', 'afm', 'doy', 'iban', 'bio']
+        fields = ['license', 'id_back', 'id_front', 'afm', 'doy', 'iban', 'bio', 'address', 'document_variants']
 
 
 class AvailableTimeRangeSerializer(serializers.ModelSerializer):
@@ -228,15 +290,97 @@ class AvailableTimeRangeSimpleSerializer(serializers.ModelSerializer):
         fields = ['weekday', 'start_time', 'end_time']
 
 
+class CommaSeparatedListField(serializers.ListField):
+    """
+    A ListField that also splits its values on commas, so ?therapists=a,b is ?therapists=a&therapists=b.
+    """
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = [data]
+        if isinstance(data, list):
+            data = [item.strip() for value in data for item in str(value).split(',') if item.strip()]
+        return super().to_internal_value(data)
+
+
+class SlotsQuerySerializer(serializers.Serializer):
+    """
+    Validates the ?from=&to=&therapists= params of the slots endpoints, the window defaults to the next two weeks.
+    """
+    MAX_WINDOW = timedelta(days=93)
+    MAX_THERAPISTS = 50
+
+    def get_fields(self):
+        # "from" is a keyword so the fields can't be declared on the class
+        return {
+            'from': serializers.DateTimeField(required=False),
+            'to': serializers.DateTimeField(required=False),
+            'therapists': CommaSeparatedListField(child=serializers.UUIDField(), required=False),
+        }
+
+    def validate(self, data):
+        start = data.get('from') or timezone.now()
+        end = data.get('to') or start + timedelta(days=14)
+        if end <= start:
+            raise serializers.ValidationError({'to': 'Must be after from.'})
+        if end - start > self.MAX_WINDOW:
+            raise serializers.ValidationError({'to': f'The window can be at most {self.MAX_WINDOW.days} days.'})
+
+        therapists = data.get('therapists', [])
+        if len(therapists) > self.MAX_THERAPISTS:
+            raise serializers.ValidationError(
+                {'therapists': f'At most {self.MAX_THERAPISTS} therapists can be requested at once.'})
+        return {'from': start, 'to': end, 'therapists': therapists}
+
+
 class ChangeAvailableTimesSerializer(serializers.Serializer):
     available_times = serializers.ListField(child=AvailableTimeRangeSimpleSerializer())
 
+    def validate_available_times(self, value):
+        conflicts = find_conflicts([(time_range['weekday'], time_range['start_time'], time_range['end_time'])
+                                    for time_range in value])
+        if conflicts:
+            raise serializers.ValidationError(conflicts)
+        return value
+
     def create(self, validated_data):
         therapist = Therapist.objects.get(surrogate=self.context.get('therapist'))
 
+        # an empty list leaves the schedule alone
         if len(validated_data.get('available_times', [])) > 0:
-            therapist.available_time_ranges.all().delete()
-        for time_range in validated_data.get('available_times', []):
-            AvailableTimeRange.objects.create(therapist=therapist, start_time=time_range.get('start_time'),
-                                              end_time=time_range.get('end_time'), weekday=time_range.get('weekday'))
+            replace_time_ranges({therapist.id: [
+                (time_range['weekday'], time_range['start_time'], time_range['end_time'])
+                for time_range in validated_data['available_times']
+            ]})
         return validated_data
+
+
+class TherapistScheduleSerializer(ChangeAvailableTimesSerializer):
+    therapist = serializers.UUIDField()
+
+
+class BulkAvailableTimesSerializer(serializers.Serializer):
+    """
+    The weekly schedules of many therapists at once, an empty available_times clears a schedule.
+    """
+    MAX_THERAPISTS = 200
+
+    schedules = serializers.ListField(child=TherapistScheduleSerializer(), max_length=MAX_THERAPISTS)
+
+    def validate_schedules(self, value):
+        surrogates = [schedule['therapist'] for schedule in value]
+        if len(set(surrogates)) != len(surrogates):
+            raise serializers.ValidationError('Each therapist can only be listed once.')
+        ids = dict(Therapist.objects.filter(surrogate__in=surrogates).values_list('surrogate', 'id'))
+        unknown = [str(surrogate) for surrogate in surrogates if surrogate not in ids]
+        if unknown:
+            raise serializers.ValidationError(f'Unknown therapists: {", ".join(unknown)}.')
+        for schedule in value:
+            schedule['therapist_id'] = ids[schedule['therapist']]
+        return value
+
+    def create(self, validated_data):
+        return replace_time_ranges({
+            schedule['therapist_id']: [(time_range['weekday'], time_range['start_time'], time_range['end_time'])
+                                       for time_range in schedule['available_times']]
+            for schedule in validated_data['schedules']
+        })
@@ -1,12 +1,17 @@
+from django.conf import settings
 from django.urls import path, include
 from django.conf.urls import url
 from rest_framework import routers, serializers, viewsets
-from . import views
+from . import async_views, views
+
+# the views waiting on Stripe, async ones for the ASGI server
+stripe_views = async_views if settings.ASYNC_STRIPE_VIEWS else views
 
 router = routers.DefaultRouter()
 router.register(r'user/me', views.UserMeViewSet, basename="user_me")
 router.register(r'therapists/(?P<surrogate>[\w\-]+)/availability', views.ChangeAvailabilityTimes,
                 basename="change_availability")
+router.register(r'therapists/availability', views.BulkAvailabilityTimes, basename="bulk_availability")
 router.register(r'therapists', views.TherapistsViewSet, basename="therapists")
 router.register(r'create_session', views.CreateTherapySessionViewSet, basename="create_session")
 router.register(r'therapy_sessions', views.CreateTherapySessionViewSet, basename="therapy_sessions")
@@ -20,9 +25,15 @@ urlpatterns = [
     path('v1/', include(router.urls)),
     path('v1/stripe_publishable_key/', views.get_stripe_publishable_key, name="stripe_key"),
     path('v1/create_checkout_session/<str:stripe_id>/<str:session_id>/',
-         views.create_checkout_session, name="create_checkout_session"),
-    path('v1/create_stripe_account_link/', views.create_stripe_account_link, name="create_stripe_account_link"),
-    path('v1/get_stripe_login/', views.get_stripe_login, name="get_stripe_login"),
-    path('v1/create_direct_payment/<str:stripe_id>/', views.create_direct_payment, name="create_direct_payment"),
-    path('v1/stripe_webhook/', views.check_out_success_webhook, name="stripe_webhook")
+         stripe_views.create_checkout_session, name="create_checkout_session"),
+    path('v1/create_stripe_account_link/', stripe_views.create_stripe_account_link, name="create_stripe_account_link"),
+    path('v1/get_stripe_login/', stripe_views.get_stripe_login, name="get_stripe_login"),
+    path('v1/create_direct_payment/<str:stripe_id>/', stripe_views.create_direct_payment, name="create_direct_payment"),
+    path('v1/stripe_webhook/', views.check_out_success_webhook, name="stripe_webhook"),
+    path('v1/calendar_feed/', views.calendar_feed_url, name="calendar_feed_url"),
+    path('v1/calendar/<uuid:token>.ics', views.calendar_feed, name="calendar_feed"),
+    path('v1/db_pool_stats/', views.db_pool_stats, name="db_pool_stats"),
+    path('v1/metrics/', views.metrics, name="metrics"),
+    path('v1/uploads/', views.create_upload, name="create_upload"),
+    path('v1/uploads/<uuid:upload_id>/', views.upload, name="upload"),
 ]
@@ -1,37 +1,232 @@
+import base64
+import hashlib
+import hmac
+import json
 import os
+import uuid
 import stripe
+from collections import OrderedDict
 from django.contrib.sites.models import Site
 from django.conf import settings
-from django.http import HttpResponse
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Prefetch, Q
+from django.http import HttpResponse, Http404, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_safe
 from rest_framework import viewsets, mixins, permissions, generics
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from accounts.authentication import get_claim
 from accounts.models import User, UserProfile
+from images import uploads
+from images.models import Upload
 from reviews.models import Review
 from therapist.models import Therapist, TherapySession, AvailableTimeRange
+from therapist.calendar import get_feed_owner, get_feed_sessions, render_calendar
+from therapist.cache import get_directory_version, get_therapist_versions
+from therapist.slots import compute_free_slots
+from payments import stripe_client
+from payments.events import store_event
+from therapy import metrics as request_metrics
+from therapy.db.pool import pool_stats
 from . import serializers
+from .filters import TherapistFilter, TherapySessionFilter
+from .mixins import ConditionalGetViewMixin, SparseFieldsViewMixin
+from .pagination import TherapistPagination, TherapySessionPagination, ReviewPagination
 
 
-class UserMeViewSet(viewsets.ModelViewSet):
+class UserMeViewSet(ConditionalGetViewMixin, SparseFieldsViewMixin, viewsets.ModelViewSet):
     serializer_class = serializers.UserSerializer
 
     def get_queryset(self):
-        return User.objects.filter(pk=self.request.user.pk)
-
-
-class TherapistsViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
+        queryset = User.objects.filter(pk=self.request.user.pk).select_related('profile', 'therapist')\
+            .prefetch_related('therapist__available_time_ranges', 'therapist__specialties')
+        if 'therapist.sessions' in (self.get_sparse_fields_context()['expand'] or ()):
+            # session.therapist is set to the prefetched therapist, so the nested
+            # TherapistSerializer reuses the prefetches above
+            queryset = queryset.prefetch_related(
+                Prefetch('therapist__sessions', queryset=TherapySession.objects.select_related('user__profile'))
+            )
+        return queryset
+
+    def get_last_modified(self):
+        if not self.request.user.is_authenticated:
+            return None
+        # changes to the therapist's sessions, availability and reviews move therapist.updated
+        updated = UserProfile.objects.filter(user_id=self.request.user.pk)\
+            .values_list('updated', 'user__therapist__updated').first()
+        return max(filter(None, updated)) if updated else None
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(request, lambda: super(UserMeViewSet, self).list(request, *args, **kwargs))
+
+
+class TherapistsViewSet(ConditionalGetViewMixin, SparseFieldsViewMixin, viewsets.GenericViewSet, mixins.ListModelMixin,
+                        mixins.RetrieveModelMixin):
     serializer_class = serializers.TherapistWithSessionsSerializer
+    pagination_class = TherapistPagination
+    filterset_class = TherapistFilter
     lookup_field = 'surrogate'
 
     def get_queryset(self):
-        return Therapist.objects.filter(user__profile__charges_enabled=True)
+        queryset = Therapist.objects.filter(user__profile__charges_enabled=True).select_related('user__profile')
+
+        # only load the relations of the fields that will be serialized
+        fields = self.get_requested_fields()
+        if 'sessions' in fields:
+            # session.therapist is set to the prefetched therapist, so the nested
+            # TherapistSerializer reuses the prefetches below
+            queryset = queryset.prefetch_related(
+                Prefetch('sessions', queryset=TherapySession.objects.select_related('user__profile'))
+            )
+        if 'availability_times' in fields or 'sessions' in fields:
+            queryset = queryset.prefetch_related('available_time_ranges')
+        if 'specialties' in fields or 'sessions' in fields:
+            queryset = queryset.prefetch_related('specialties')
+        return queryset
 
     def get_serializer_context(self):
         return {
             'user': self.request.user,
+            **self.get_sparse_fields_context(),
         }
 
+    def list(self, request, *args, **kwargs):
+        page_key = 'therapist-directory:%s:%s' % (
+            get_directory_version(),
+            hashlib.md5(request.build_absolute_uri().encode()).hexdigest(),
+        )
+        page = cache.get(page_key)
+        if page is None:
+            queryset = self.filter_queryset(Therapist.objects.filter(user__profile__charges_enabled=True)
+                                            .only('surrogate', 'created'))
+            therapists = self.paginate_queryset(queryset)
+            page = {
+                'surrogates': [therapist.surrogate for therapist in therapists],
+                'next': self.paginator.get_next_link(),
+                'previous': self.paginator.get_previous_link(),
+            }
+            cache.set(page_key, page, settings.THERAPIST_CACHE_TIMEOUT)
+
+        return Response(OrderedDict([
+            ('next', page['next']),
+            ('previous', page['previous']),
+            ('results', self.get_cached_therapists(page['surrogates'])),
+        ]))
+
+    def get_last_modified(self):
+        try:
+            surrogate = uuid.UUID(self.kwargs['surrogate'])
+        except ValueError:
+            return None
+        # everything the therapist is serialized with moves therapist.updated, see therapist.cache
+        return Therapist.objects.filter(surrogate=surrogate, user__profile__charges_enabled=True)\
+            .values_list('updated', flat=True).first()
+
+    def retrieve(self, request, surrogate=None, *args, **kwargs):
+        return self.conditional_response(request, lambda: self.render_therapist(surrogate))
+
+    def render_therapist(self, surrogate):
+        try:
+            surrogate = uuid.UUID(surrogate)
+        except ValueError:
+            raise Http404
+        therapists = self.get_cached_therapists([surrogate])
+        if not therapists:
+            raise Http404
+        return Response(therapists[0])
+
+    def get_cached_therapists(self, surrogates):
+        """
+        Serialized therapists in the given order, built from fragments cached under each therapist's
+        version. A page of hits is two cache round trips and no queries; the per-user `review`
+        is merged in afterwards.
+        """
+        fields = list(self.get_requested_fields())
+        sparse = self.get_sparse_fields_context()
+        variant = hashlib.md5(repr((
+            [field for field in fields if field != 'review'],
+            sorted(sparse['fields'] or []),
+            sorted(sparse['expand'] or []),
+        )).encode()).hexdigest()
+
+        versions = get_therapist_versions(surrogates)
+        keys = {surrogate: f'therapist:{surrogate}:{versions[surrogate]}:{variant}' for surrogate in surrogates}
+        fragments = cache.get_many(list(keys.values()))
+
+        missing = [surrogate for surrogate in surrogates if keys[surrogate] not in fragments]
+        if missing:
+            # fragments are shared between users, so they are rendered without one
+            instances = list(self.get_queryset().filter(surrogate__in=missing))
+            serializer = self.get_serializer_class()(instances, many=True, context={'user': None, **sparse})
+            rendered = {keys[instance.surrogate]: data for instance, data in zip(instances, serializer.data)}
+            cache.set_many(rendered, settings.THERAPIST_CACHE_TIMEOUT)
+            fragments.update(rendered)
+
+        # therapists that are no longer listed have no fragment
+        surrogates = [surrogate for surrogate in surrogates if keys[surrogate] in fragments]
+        therapists = [fragments[keys[surrogate]] for surrogate in surrogates]
+        if 'review' in fields and therapists:
+            # the requester's reviews for the whole page in a single query
+            reviews = {}
+            if self.request.user.is_authenticated:
+                reviews = {review.therapist.surrogate: serializers.ReviewSerializer(review).data for review in
+                           Review.objects.filter(user=self.request.user, therapist__surrogate__in=surrogates)
+                           .select_related('therapist__user')}
+            therapists = [OrderedDict((field, reviews.get(surrogate) if field == 'review' else value)
+                                      for field, value in therapist.items())
+                          for surrogate, therapist in zip(surrogates, therapists)]
+        return therapists
+
+    @action(detail=True, methods=['get'])
+    def slots(self, request, surrogate=None):
+        try:
+            surrogate = uuid.UUID(surrogate)
+        except ValueError:
+            raise Http404
+        query = serializers.SlotsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        slots = self.get_free_slots([surrogate], query.validated_data['from'], query.validated_data['to'])
+        if not slots:
+            raise Http404
+        return Response(slots[0])
+
+    @action(detail=False, methods=['get'], url_path='slots')
+    def batch_slots(self, request):
+        query = serializers.SlotsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        if not query.validated_data['therapists']:
+            raise ValidationError({'therapists': 'This field is required.'})
+        return Response(self.get_free_slots(query.validated_data['therapists'],
+                                            query.validated_data['from'], query.validated_data['to']))
+
+    def get_free_slots(self, surrogates, start, end):
+        """
+        Bookable slots of the given therapists in three queries, however many therapists are asked for.
+        """
+        start = max(start, timezone.now())
+        therapists = list(Therapist.objects.filter(user__profile__charges_enabled=True, surrogate__in=surrogates)
+                          .prefetch_related('available_time_ranges').order_by('created'))
+
+        busy = {therapist.id: [] for therapist in therapists}
+        sessions = TherapySession.objects.filter(therapist__in=therapists, start_date__lt=end, end_date__gt=start)\
+            .exclude(status=TherapySession.REJECTED).order_by('start_date').values_list('therapist_id', 'start_date',
+                                                                                        'end_date')
+        for therapist_id, session_start, session_end in sessions:
+            busy[therapist_id].append((session_start, session_end))
+
+        return [{
+            'therapist': therapist.surrogate,
+            'slots': [{'start_date': slot_start, 'end_date': slot_end} for slot_start, slot_end in
+                      compute_free_slots(therapist.available_time_ranges.all(), busy[therapist.id], start, end)]
+        } for therapist in therapists]
+
 
 class CreateTherapySessionViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
     permission_classes = [permissions.IsAuthenticated, ]
@@ -44,19 +239,21 @@ class CreateTherapySessionViewSet(viewsets.GenericViewSet, mixins.CreateModelMix
         }
 
 
-class MySessionsViewSet(viewsets.ModelViewSet):
+class MySessionsViewSet(SparseFieldsViewMixin, viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated, ]
-    serializer_class = serializers.TherapySessionSerializer
+    serializer_class = serializers.MySessionSerializer
+    pagination_class = TherapySessionPagination
+    filterset_class = TherapySessionFilter
     lookup_field = 'surrogate'
 
     def get_queryset(self):
-        sessions = self.request.user.sessions.all()
-        if self.request.user.profile.is_therapist:
-            sessions |= self.request.user.therapist.sessions.all()
-        return sessions.order_by('-created')
-
-    def get_object(self):
-        return TherapySession.objects.get(surrogate=self.kwargs['surrogate'])
+        # sessions booked by the user, and the ones booked with them when they're a therapist; only a
+        # token without a therapist_id claim loads the user, to see whether they became one since
+        mine = Q(user_id=self.request.user.pk)
+        therapist_id = get_claim(self.request, 'therapist_id')
+        if therapist_id is not None:
+            mine |= Q(therapist_id=therapist_id)
+        return TherapySession.objects.filter(mine).select_related('user__profile', 'therapist__user__profile')
 
 
 class ProfileViewSet(viewsets.GenericViewSet, mixins.UpdateModelMixin):
@@ -84,7 +281,9 @@ class UpdateTherapistProfileViewSet(viewsets.GenericViewSet, mixins.UpdateModelM
 
 class ReviewSerializer(viewsets.ModelViewSet):
     serializer_class = serializers.ReviewSerializer
-    queryset = Review.objects.all()
+    pagination_class = ReviewPagination
+    # the therapist is rendered by its str(), which reads the user
+    queryset = Review.objects.select_related('therapist__user')
     lookup_field = 'surrogate'
 
     def get_permissions(self):
@@ -116,15 +315,23 @@ class ChangeAvailabilityTimes(viewsets.GenericViewSet, mixins.CreateModelMixin):
         }
 
 
-@api_view(http_method_names=['POST'])
-@permission_classes((permissions.IsAuthenticated,))
-def create_direct_payment(request, stripe_id):
-    stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-    domain_url = request.scheme + '://' + request.get_host() + '/'
-    # if settings.DEBUG:
-    if os.environ.get('DEVELOPMENT_MODE') == 'True' or os.environ.get('DEVELOPMENT_MODE') == True:
-        domain_url = domain_url.replace('8000', '3000')
-    payment_intent = stripe.PaymentIntent.create(
+class BulkAvailabilityTimes(viewsets.GenericViewSet, mixins.CreateModelMixin):
+    """
+    Replaces the weekly schedules of many therapists in one call, for staff.
+    """
+    serializer_class = serializers.BulkAvailableTimesSerializer
+    permission_classes = [permissions.IsAdminUser, ]
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save())
+
+
+# the parameters of the Stripe calls, shared by the sync views and api.v1.async_views
+
+def direct_payment_params(stripe_id):
+    return dict(
         payment_method_types=['card'],
         amount=3000,
         currency='eur',
@@ -134,24 +341,8 @@ def create_direct_payment(request, stripe_id):
         }
     )
 
-    url = payment_intent.charges.url
-    return Response({'url': url})
-
-
-@api_view(http_method_names=['POST'])
-@permission_classes((permissions.IsAuthenticated,))
-def get_stripe_login(request):
-    stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-    login = stripe.Account.create_login_link(f'{request.user.profile.stripe_id}')
-    return Response({'url': login.url})
-
-
-@api_view(http_method_names=['POST'])
-@permission_classes((permissions.IsAuthenticated,))
-def create_stripe_account_link(request):
-    stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-    user_profile = request.user.profile
 
+def account_link_params(stripe_id):
     #if settings.DEBUG:
     if os.environ.get('DEVELOPMENT_MODE') == 'True' or os.environ.get('DEVELOPMENT_MODE') == True:
         redirect = 'http://localhost:3000/users/oauth/callback'
@@ -161,20 +352,289 @@ def create_stripe_account_link(request):
         redirect = 'https://drempathy-app.herokuapp.com/users/oauth/callback'
         refresh_url = 'https://drempathy-app.herokuapp.com/reauth'
 
-    account_link = stripe.AccountLink.create(
-        account=request.user.profile.stripe_id,
+    return dict(
+        account=stripe_id,
         refresh_url=refresh_url,
         return_url=redirect,
         type="account_onboarding",
     )
 
+
+def store_account_link(user_profile, account_link):
     user_profile.stripe_account_link = account_link.url
     user_profile.created = account_link.created
     user_profile.expires_at = account_link.expires_at
     user_profile.save()
+
+
+def checkout_session_params(stripe_id, session_id):
+    #domain_url = request.scheme + '://' + request.get_host() + '/'
+    domain_url = 'https://drempathy-app.herokuapp.com/'
+    #if settings.DEBUG:
+    if os.environ.get('DEVELOPMENT_MODE') == 'True' or os.environ.get('DEVELOPMENT_MODE') == True:
+        #domain_url = domain_url.replace('8000', '3000')
+        domain_url = "http://localhost:8000/"
+
+    # Create new Checkout Session for the order
+    # Other optional params include:
+    # [billing_address_collection] - to display billing address details on the page
+    # [customer] - if you have an existing Stripe Customer ID
+    # [payment_intent_data] - capture the payment later
+    # [customer_email] - prefill the email input in the form
+    # For full details see https://stripe.com/docs/api/checkout/sessions/create
+
+    # ?session_id={CHECKOUT_SESSION_ID} means the redirect will have the session ID set as a query param
+    return dict(
+        success_url=domain_url + 'success?session_id={CHECKOUT_SESSION_ID}',
+        cancel_url=domain_url,
+        mode="payment",
+        payment_method_types=['card'],
+        line_items=[
+            {
+                "amount": 3000,
+                "currency": 'eur',
+                "name": 'session',
+                "quantity": 1,
+
+            },
+        ],
+        metadata={
+            "session_id": session_id
+        },
+        payment_intent_data={
+            'application_fee_amount': 600,
+            'on_behalf_of': stripe_id,
+            'transfer_data': {
+                #'amount': 3000,
+                'destination': stripe_id,
+            },
+            'metadata': {
+                "session_id": session_id
+            }
+        },
+    )
+
+
+@api_view(http_method_names=['POST'])
+@permission_classes((permissions.IsAuthenticated,))
+def create_direct_payment(request, stripe_id):
+    payment_intent = stripe_client.call('PaymentIntent.create', **direct_payment_params(stripe_id))
+
+    url = payment_intent.charges.url
+    return Response({'url': url})
+
+
+@api_view(http_method_names=['POST'])
+@permission_classes((permissions.IsAuthenticated,))
+def get_stripe_login(request):
+    login = stripe_client.call('Account.create_login_link', f'{get_claim(request, "stripe_id")}')
+    return Response({'url': login.url})
+
+
+@api_view(http_method_names=['POST'])
+@permission_classes((permissions.IsAuthenticated,))
+def create_stripe_account_link(request):
+    user_profile = request.user.profile
+    account_link = stripe_client.call('AccountLink.create', **account_link_params(user_profile.stripe_id))
+
+    store_account_link(user_profile, account_link)
     return Response({'url': account_link.url})
 
 
+@api_view(http_method_names=['GET', 'POST'])
+@permission_classes((permissions.IsAuthenticated,))
+def calendar_feed_url(request):
+    """
+    The url of the user's calendar feed, POST replaces it so the previous url stops working.
+    """
+    profile = request.user.profile
+    if profile.calendar_token is None or request.method == 'POST':
+        profile.calendar_token = uuid.uuid4()
+        profile.save(update_fields=['calendar_token'])
+    return Response({'url': request.build_absolute_uri(reverse('calendar_feed', args=[profile.calendar_token]))})
+
+
+@require_safe
+def calendar_feed(request, token):
+    """
+    iCalendar feed of the sessions of the user the token belongs to, for calendar apps to subscribe to.
+    """
+    owner = get_feed_owner(token)
+    if owner is None:
+        raise Http404
+
+    last_modified = owner['last_modified']
+    # the count changes when a session is deleted, which leaves no newer timestamp behind
+    etag = quote_etag(f"{owner['session_count']}-{last_modified.timestamp() if last_modified else 0}")
+    last_modified = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        sessions = get_feed_sessions(owner['user_id'], owner['therapist_id'])
+        domain = Site.objects.get_current().domain
+        if isinstance(request, ASGIRequest):
+            # the ASGI handler iterates a streamed body in the event loop, where the database can't be
+            # queried, so the calendar is rendered here in the view's thread
+            response = HttpResponse(b''.join(render_calendar(sessions, owner['user_id'], domain)),
+                                    content_type='text/calendar; charset=utf-8')
+        else:
+            # a server side cursor, memory stays flat however long the history is
+            response = StreamingHttpResponse(render_calendar(sessions.iterator(chunk_size=500), owner['user_id'],
+                                                             domain),
+                                             content_type='text/calendar; charset=utf-8')
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+TUS_VERSION = '1.0.0'
+UPLOAD_ERROR_STATUS = {
+    uploads.OffsetMismatch: 409,
+    uploads.UploadBusy: 423,
+    uploads.ChecksumMismatch: 460,
+    uploads.InvalidContent: 415,
+}
+
+
+def tus_response(status, detail=None, **headers):
+    response = Response({'detail': detail} if detail else None, status=status)
+    response['Tus-Resumable'] = TUS_VERSION
+    for name, value in headers.items():
+        response[name.replace('_', '-')] = value
+    return response
+
+
+def header_int(request, name):
+    value = request.headers.get(name, '')
+    return int(value) if value.isdigit() else None
+
+
+def parse_upload_metadata(header):
+    """
+    The "key base64value,..." pairs of Upload-Metadata, None when malformed.
+    """
+    metadata = {}
+    for pair in filter(None, (pair.strip() for pair in header.split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value, validate=True).decode('utf-8')
+        except (ValueError, UnicodeDecodeError):
+            return None
+    return metadata
+
+
+@api_view(http_method_names=['POST', 'OPTIONS'])
+@permission_classes((permissions.IsAuthenticated,))
+def create_upload(request):
+    """
+    Starts a resumable upload of a verification document, the tus creation extension. Upload-Metadata
+    carries the Therapist field as "field" and the content type as "filetype".
+    """
+    if request.method == 'OPTIONS':
+        return tus_response(204, Tus_Version=TUS_VERSION, Tus_Extension='creation,checksum,expiration,termination',
+                            Tus_Max_Size=str(settings.UPLOAD_MAX_SIZE),
+                            Tus_Checksum_Algorithm=','.join(uploads.CHECKSUM_ALGORITHMS))
+    if request.headers.get('Tus-Resumable') != TUS_VERSION:
+        return tus_response(412, 'Unsupported Tus-Resumable version.', Tus_Version=TUS_VERSION)
+    if get_claim(request, 'therapist_id') is None:
+        return tus_response(403, 'Only therapists upload verification documents.')
+
+    length = header_int(request, 'Upload-Length')
+    metadata = parse_upload_metadata(request.headers.get('Upload-Metadata', ''))
+    if not length or metadata is None:
+        return tus_response(400, 'Upload-Length and a valid Upload-Metadata are required.')
+    if metadata.get('field') not in uploads.UPLOAD_FIELDS:
+        return tus_response(400, f'The field must be one of {", ".join(uploads.UPLOAD_FIELDS)}.')
+    if length > settings.UPLOAD_MAX_SIZE:
+        return tus_response(413, f'Uploads can be at most {settings.UPLOAD_MAX_SIZE} bytes.')
+    if metadata.get('filetype') not in uploads.ALLOWED_TYPES:
+        return tus_response(415, f'The filetype must be one of {", ".join(uploads.ALLOWED_TYPES)}.')
+
+    try:
+        upload = uploads.create_upload(request.user, metadata['field'], metadata['filetype'], length)
+    except uploads.UploadError as e:
+        return tus_response(400, str(e))
+    return tus_response(201, Location=request.build_absolute_uri(reverse('upload', args=[upload.id])),
+                        Upload_Expires=http_date(upload.expires_at.timestamp()))
+
+
+@api_view(http_method_names=['HEAD', 'PATCH', 'DELETE'])
+@permission_classes((permissions.IsAuthenticated,))
+def upload(request, upload_id):
+    """
+    HEAD tells how many bytes the upload has received, PATCH appends the request body at Upload-Offset
+    and DELETE gives up on it. The body is streamed to disk, it is never held in memory.
+    """
+    if request.headers.get('Tus-Resumable') != TUS_VERSION:
+        return tus_response(412, 'Unsupported Tus-Resumable version.', Tus_Version=TUS_VERSION)
+    upload = Upload.objects.filter(pk=upload_id, user=request.user).first()
+    if upload is None:
+        return tus_response(404, 'Not found.')
+    if upload.expires_at <= timezone.now():
+        return tus_response(410, 'The upload has expired.')
+    expires = http_date(upload.expires_at.timestamp())
+
+    if request.method == 'HEAD':
+        return tus_response(200, Upload_Offset=str(upload.offset), Upload_Length=str(upload.length),
+                            Upload_Expires=expires, Cache_Control='no-store')
+    if request.method == 'DELETE':
+        try:
+            uploads.terminate(upload)
+        except uploads.UploadError as e:
+            return tus_response(UPLOAD_ERROR_STATUS[type(e)], str(e))
+        return tus_response(204)
+
+    if request.content_type != 'application/offset+octet-stream':
+        return tus_response(415, 'The Content-Type must be application/offset+octet-stream.')
+    offset = header_int(request, 'Upload-Offset')
+    # a body without it, chunked, would otherwise be taken for an empty one
+    size = header_int(request, 'Content-Length')
+    if offset is None:
+        return tus_response(400, 'Upload-Offset is required.')
+    if size is None:
+        return tus_response(400, 'Content-Length is required.')
+    if offset + size > upload.length:
+        return tus_response(413, 'The request body goes past Upload-Length.')
+    checksum = None
+    if 'Upload-Checksum' in request.headers:
+        algorithm, _, digest = request.headers['Upload-Checksum'].partition(' ')
+        try:
+            checksum = (algorithm, base64.b64decode(digest, validate=True))
+        except ValueError:
+            checksum = None
+        if algorithm not in uploads.CHECKSUM_ALGORITHMS or not checksum:
+            return tus_response(400, 'Upload-Checksum must be an algorithm and a base64 digest.')
+
+    try:
+        upload = uploads.append_chunk(upload, offset, request.stream, size, checksum)
+    except uploads.UploadError as e:
+        return tus_response(UPLOAD_ERROR_STATUS.get(type(e), 400), str(e))
+    return tus_response(204, Upload_Offset=str(upload.offset), Upload_Expires=expires)
+
+
+@api_view(http_method_names=['GET'])
+@permission_classes((permissions.IsAdminUser,))
+def db_pool_stats(request):
+    """
+    Wait time and utilization of the database connection pool of the process that served the request,
+    each worker has its own.
+    """
+    return Response(pool_stats())
+
+
+@require_safe
+def metrics(request):
+    """
+    The Prometheus scrape endpoint, see therapy.metrics. Needs METRICS_TOKEN as a bearer token.
+    """
+    token = settings.METRICS_TOKEN
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                                 f'Bearer {token}'.encode()):
+        raise Http404
+    return HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @api_view(http_method_names=['GET'])
 @permission_classes((permissions.AllowAny,))
 def get_stripe_publishable_key(request):
@@ -184,7 +644,7 @@ def get_stripe_publishable_key(request):
 @csrf_exempt
 @api_view(http_method_names=['POST'])
 def connect_stripe_account(request):
-    account = stripe.AccountLink.create(
+    account = stripe_client.call('AccountLink.create',
         account="acct_1Hx0mAIOSAQCOqoS",
         refresh_url="https://example.com/reauth",
         return_url="https://example.com/return",
@@ -197,53 +657,9 @@ def connect_stripe_account(request):
 @api_view(http_method_names=['POST'])
 @permission_classes((permissions.AllowAny,))
 def create_checkout_session(request, stripe_id, session_id):
-    #domain_url = request.scheme + '://' + request.get_host() + '/'
-    domain_url = 'https://drempathy-app.herokuapp.com/'
-    #if settings.DEBUG:
-    if os.environ.get('DEVELOPMENT_MODE') == 'True' or os.environ.get('DEVELOPMENT_MODE') == True:
-        #domain_url = domain_url.replace('8000', '3000')
-        domain_url = "http://localhost:8000/"
-
-    stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
     try:
-        # Create new Checkout Session for the order
-        # Other optional params include:
-        # [billing_address_collection] - to display billing address details on the page
-        # [customer] - if you have an existing Stripe Customer ID
-        # [payment_intent_data] - capture the payment later
-        # [customer_email] - prefill the email input in the form
-        # For full details see https://stripe.com/docs/api/checkout/sessions/create
-
-        # ?session_id={CHECKOUT_SESSION_ID} means the redirect will have the session ID set as a query param
-        checkout_session = stripe.checkout.Session.create(
-            success_url=domain_url + 'success?session_id={CHECKOUT_SESSION_ID}',
-            cancel_url=domain_url,
-            mode="payment",
-            payment_method_types=['card'],
-            line_items=[
-                {
-                    "amount": 3000,
-                    "currency": 'eur',
-                    "name": 'session',
-                    "quantity": 1,
-
-                },
-            ],
-            metadata={
-                "session_id": session_id
-            },
-            payment_intent_data={
-                'application_fee_amount': 600,
-                'on_behalf_of': stripe_id,
-                'transfer_data': {
-                    #'amount': 3000,
-                    'destination': stripe_id,
-                },
-                'metadata': {
-                    "session_id": session_id
-                }
-            },
-        )
+        checkout_session = stripe_client.call('checkout.Session.create',
+                                              **checkout_session_params(stripe_id, session_id))
         return Response({'sessionId': checkout_session['id']})
     except Exception as e:
         return Response({'error': str(e)})
@@ -254,7 +670,7 @@ def create_checkout_session(request, stripe_id, session_id):
 @permission_classes((permissions.AllowAny,))
 def check_out_success_webhook(request):
     payload = request.body
-    sig_header = request.META['HTTP_STRIPE_SIGNATURE']
+    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE', '')
     event = None
 
     try:
@@ -268,27 +684,6 @@ def check_out_success_webhook(request):
         # Invalid signature
         return HttpResponse(status=400)
 
-    # Handle the event
-    if event.type == 'payment_intent.succeeded':
-        payment_intent = event.data.object # contains a stripe.PaymentIntent
-        session_id = payment_intent.get('metadata', {}).get('session_id')
-        session = TherapySession.objects.get(surrogate=session_id)
-        session.status = TherapySession.PAYMENT_COMPLETED
-        session.save()
-        print('PaymentIntent was successful!', payment_intent, session_id)
-    elif event.type == 'payment_method.attached':
-        payment_method = event.data.object # contains a stripe.PaymentMethod
-        print('PaymentMethod was attached to a Customer!')
-    # ... handle other event types
-    elif event.type == 'account.updated':
-        account = event.data.object
-        charges_enabled = account.get('charges_enabled', '')
-        user_profile = UserProfile.objects.get(stripe_id=account.get('id', ''))
-        print(account)
-        print(user_profile)
-
-        user_profile.charges_enabled = charges_enabled
-        user_profile.save()
-    else:
-        print('Unhandled event type {}'.format(event.type))
+    # applied later by the process_stripe_events worker, redeliveries are dropped
+    store_event(json.loads(payload))
     return HttpResponse(status=200)
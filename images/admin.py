@@ -0,0 +1,6 @@
+from django.contrib import admin
+from .models import ImageJob, Upload
+
+# Register your models here.
+admin.site.register(ImageJob)
+admin.site.register(Upload)
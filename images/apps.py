@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class ImagesConfig(AppConfig):
+    name = 'images'
+
+    def ready(self):
+        # connects the receivers that queue new uploads
+        from . import queue
@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from images.queue import process_pending_images
+from images.uploads import delete_expired_uploads
+
+
+class Command(BaseCommand):
+    help = 'Re-encodes uploaded avatars and verification documents and renders their thumbnails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10)
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the queue and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            if process_pending_images(options['batch_size']):
+                continue
+            # idle, a good time to clear abandoned resumable uploads
+            delete_expired_uploads()
+            if options['once']:
+                break
+            time.sleep(options['interval'])
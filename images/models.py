@@ -0,0 +1,54 @@
+import uuid
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+
+class ImageJob(models.Model):
+    """
+    An uploaded image waiting for the process_images worker to re-encode it and render its variants.
+    """
+    # app_label.ModelName of the model holding the image
+    model = models.CharField(max_length=100)
+    object_id = models.IntegerField()
+    field = models.CharField(max_length=50)
+    # storage name of the upload, a newer upload of the same field gets its own job
+    source = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return f'{self.model} {self.object_id} {self.field} - {self.source}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['model', 'object_id', 'field', 'source'], name='unique_image_job'),
+        ]
+        indexes = [
+            # the worker's queue: unprocessed jobs that are due
+            models.Index(fields=['next_attempt_at'], name='image_job_pending_idx',
+                         condition=models.Q(processed_at__isnull=True)),
+        ]
+
+
+class Upload(models.Model):
+    """
+    A verification document uploaded in pieces, see images.uploads. Kept once complete so a client
+    that lost the last response can still HEAD it, until expires_at.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='uploads')
+    field = models.CharField(max_length=50)
+    content_type = models.CharField(max_length=100)
+    # the declared size and the bytes received so far
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.user} {self.field} - {self.offset}/{self.length}'
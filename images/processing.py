@@ -0,0 +1,103 @@
+"""
+Re-encoding of uploaded images and rendering of their fixed-size variants.
+
+Re-encoding drops the EXIF and other metadata phones embed (location included) and caps the size
+of the original. Every processed upload gets a fresh directory, so its URLs never change and can
+be cached for good.
+"""
+import io
+import posixpath
+import uuid
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+MAX_ORIGINAL_SIZE = 2048
+JPEG_OPTIONS = {'quality': 82, 'optimize': True, 'progressive': True}
+# (Pillow format, file extension, save options) of every variant
+FORMATS = [
+    ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    ('JPEG', 'jpg', JPEG_OPTIONS),
+]
+
+
+def open_image(name):
+    with default_storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        image.load()
+    # applies the EXIF orientation, which is about to be dropped with the rest of the metadata
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert('RGB')
+
+
+def save_image(image, name, image_format, options):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def process_image(name, sizes, crop):
+    """
+    Re-encodes the image stored under name and renders it at each of the sizes, cropped to squares
+    when crop is set, bounded by size x size otherwise. Returns the storage names of the new files as
+    {'original': name, 'variants': {size: {extension: name}}}; the caller deletes the source.
+    """
+    image = open_image(name)
+    image.thumbnail((MAX_ORIGINAL_SIZE, MAX_ORIGINAL_SIZE), Image.LANCZOS)
+    directory = posixpath.join(posixpath.dirname(name), 'processed', uuid.uuid4().hex)
+
+    written = []
+    try:
+        original = save_image(image, posixpath.join(directory, 'original.jpg'), 'JPEG', JPEG_OPTIONS)
+        written.append(original)
+        variants = {}
+        for size in sizes:
+            if crop:
+                variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            else:
+                variant = image.copy()
+                variant.thumbnail((size, size), Image.LANCZOS)
+            variants[str(size)] = {}
+            for image_format, extension, options in FORMATS:
+                variants[str(size)][extension] = save_image(variant, posixpath.join(directory, f'{size}.{extension}'),
+                                                            image_format, options)
+                written.append(variants[str(size)][extension])
+    except Exception:
+        delete_files(written)
+        raise
+    return {'original': original, 'variants': variants}
+
+
+def delete_files(names):
+    for name in names:
+        default_storage.delete(name)
+
+
+def processed_files(entry):
+    """
+    The storage names of the files of an image_variants entry, original included.
+    """
+    if not entry:
+        return []
+    names = [entry['source']]
+    for formats in entry.get('variants', {}).values():
+        names.extend(formats.values())
+    return names
+
+
+def variant_urls(instance, field):
+    """
+    {size: {extension: url}} of the processed variants of an image field, None until its current
+    upload has been processed. Built from the model's image_variants alone, no queries.
+    """
+    image = getattr(instance, field)
+    entry = instance.image_variants.get(field)
+    if not image or not entry or entry['source'] != image.name:
+        return None
+    return {size: {extension: default_storage.url(name) for extension, name in formats.items()}
+            for size, formats in entry['variants'].items()}
@@ -0,0 +1,113 @@
+"""
+Queues uploaded images for the process_images worker and applies its results.
+
+A field's upload is current while image_variants[field]['source'] matches the field; saving a
+new upload queues a job, and the processed original replaces the upload once the job is done.
+"""
+import logging
+from datetime import timedelta
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import ImageJob
+from .processing import delete_files, process_image, processed_files
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = timedelta(hours=1)
+# how long a claimed job is left to its worker, well past the time a batch takes to render
+LEASE = timedelta(minutes=5)
+
+# the processed image fields of each model: (variant sizes, crop to squares)
+IMAGE_FIELDS = {
+    'accounts.UserProfile': {
+        'avatar': ([96, 320], True),
+    },
+    'therapist.Therapist': {
+        'license': ([640], False),
+        'id_front': ([640], False),
+        'id_back': ([640], False),
+    },
+}
+
+
+@receiver(post_save, sender='accounts.UserProfile')
+@receiver(post_save, sender='therapist.Therapist')
+def queue_new_uploads(sender, instance, **kwargs):
+    label = sender._meta.label
+    jobs = []
+    for field in IMAGE_FIELDS[label]:
+        name = getattr(instance, field).name
+        if name and name != instance.image_variants.get(field, {}).get('source'):
+            jobs.append(ImageJob(model=label, object_id=instance.pk, field=field, source=name))
+    # the same upload saved twice is queued once
+    ImageJob.objects.bulk_create(jobs, ignore_conflicts=True)
+
+
+def apply_job(job):
+    model = apps.get_model(job.model)
+    sizes, crop = IMAGE_FIELDS[job.model][job.field]
+    # rendered outside of the transaction below, it's the slow part
+    result = process_image(job.source, sizes, crop)
+    written = [result['original']] + [name for formats in result['variants'].values() for name in formats.values()]
+
+    try:
+        with transaction.atomic():
+            instance = model.objects.select_for_update().filter(pk=job.object_id, **{job.field: job.source}).first()
+            if instance is None:
+                # deleted, or replaced by a newer upload with a job of its own, either way the upload is unused
+                delete_files(written + [job.source])
+                return
+
+            previous = instance.image_variants.get(job.field)
+            instance.image_variants[job.field] = {'source': result['original'], 'variants': result['variants']}
+            setattr(instance, job.field, result['original'])
+            # post_save takes care of the cache invalidation, and queues nothing as the source now matches
+            instance.save(update_fields=[job.field, 'image_variants', 'updated'])
+    except Exception:
+        delete_files(written)
+        raise
+
+    # the upload still carries its metadata, it must not stay reachable
+    stale = [job.source] + [name for name in processed_files(previous) if name != job.source]
+    transaction.on_commit(lambda: delete_files(stale))
+
+
+def claim_pending_jobs(batch_size):
+    """
+    Leases a batch of due jobs to this worker by moving their next attempt past LEASE, so no other
+    worker picks them up while they render outside of any transaction. A worker that dies leaves its
+    jobs to be picked up again once the lease runs out.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(ImageJob.objects.select_for_update(skip_locked=True)
+                    .filter(processed_at__isnull=True, next_attempt_at__lte=now)
+                    .order_by('next_attempt_at')[:batch_size])
+        ImageJob.objects.filter(pk__in=[job.pk for job in jobs]).update(next_attempt_at=now + LEASE)
+    return jobs
+
+
+def process_pending_images(batch_size=10):
+    """
+    Processes a batch of due jobs and returns how many were picked up, see claim_pending_jobs.
+    Failures are retried with exponential backoff until MAX_ATTEMPTS, after which the upload is
+    served as it is.
+    """
+    jobs = claim_pending_jobs(batch_size)
+    for job in jobs:
+        try:
+            apply_job(job)
+            job.processed_at = timezone.now()
+        except Exception as e:
+            logger.exception('Failed to process %s', job)
+            job.attempts += 1
+            job.next_attempt_at = timezone.now() + min(timedelta(seconds=2 ** job.attempts), MAX_BACKOFF)
+            job.last_error = repr(e)
+            if job.attempts >= MAX_ATTEMPTS:
+                job.processed_at = timezone.now()
+        job.save(update_fields=['processed_at', 'attempts', 'next_attempt_at', 'last_error'])
+    return len(jobs)
@@ -0,0 +1,398 @@
+import base64
+import fcntl
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import uuid
+from unittest import mock
+from urllib.parse import urlparse
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from accounts.authentication import TokenObtainPairSerializer
+from accounts.models import User, UserProfile
+from therapist.models import Therapist
+from . import processing, queue, uploads
+from .models import ImageJob, Upload
+from .views import parse_range
+
+CONTENT = b'0123456789'
+
+
+def create_user(email, is_staff=False):
+    user = User.objects.create(email=email, is_staff=is_staff)
+    UserProfile.objects.create(user=user, name=email.split('@')[0], is_therapist=not is_staff)
+    return user
+
+
+def authorization(user):
+    return {'HTTP_AUTHORIZATION': f'Bearer {TokenObtainPairSerializer.get_token(user).access_token}'}
+
+
+def image_bytes(image_format='JPEG', size=(64, 48), exif=None):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, image_format, **({'exif': exif} if exif else {}))
+    return buffer.getvalue()
+
+
+def phone_exif():
+    exif = Image.Exif()
+    exif[0x010F] = 'Phone maker'
+    # rotated by 90°, the way phones store portraits
+    exif[0x0112] = 6
+    return exif
+
+
+class TemporaryMediaMixin:
+    """
+    MEDIA_ROOT and UPLOAD_TEMP_DIR in a directory removed after the tests.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.settings_override = override_settings(MEDIA_ROOT=cls.media_root, MEDIA_ACCEL_HEADER='',
+                                                  UPLOAD_TEMP_DIR=os.path.join(cls.media_root, 'uploads'))
+        cls.settings_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        shutil.rmtree(cls.media_root)
+
+
+class ServeMediaTests(TemporaryMediaMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        processed = f'licenses/processed/{uuid.uuid4().hex}'
+        cls.license = f'{processed}/original.jpg'
+        cls.variant = f'{processed}/256.webp'
+        for name in (cls.license, cls.variant, 'id/front.jpg', 'licenses/other.jpg', 'avatars/avatar.jpg',
+                     'licenses/processed/0000/original.jpg'):
+            path = os.path.join(cls.media_root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(CONTENT)
+
+        cls.owner = create_user('owner@example.com')
+        Therapist.objects.create(user=cls.owner, license=cls.license, id_front='id/front.jpg')
+        cls.other = create_user('other@example.com')
+        Therapist.objects.create(user=cls.other, license='licenses/other.jpg')
+        cls.staff = create_user('staff@example.com', is_staff=True)
+
+    def get(self, name, user=None, **headers):
+        if user is not None:
+            headers.update(authorization(user))
+        return self.client.get(f'/media/{name}', **headers)
+
+    def test_anonymous(self):
+        for name in (self.license, 'id/front.jpg'):
+            self.assertEqual(self.get(name).status_code, 404)
+
+    def test_other_therapist(self):
+        for name in (self.license, self.variant, 'id/front.jpg'):
+            self.assertEqual(self.get(name, self.other).status_code, 404)
+        self.assertEqual(self.get('licenses/other.jpg', self.other).status_code, 200)
+
+    def test_owner(self):
+        for name in (self.license, self.variant, 'id/front.jpg'):
+            response = self.get(name, self.owner)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), CONTENT)
+            self.assertTrue(response['Cache-Control'].startswith('private'))
+        # another directory of processed files
+        self.assertEqual(self.get('licenses/processed/0000/original.jpg', self.owner).status_code, 404)
+
+    def test_staff(self):
+        for name in (self.license, 'id/front.jpg', 'licenses/other.jpg'):
+            self.assertEqual(self.get(name, self.staff).status_code, 200)
+
+    def test_invalid_token(self):
+        self.assertEqual(self.get(self.license, HTTP_AUTHORIZATION='Bearer nonsense').status_code, 404)
+
+    def test_public(self):
+        response = self.get('avatars/avatar.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Cache-Control'].startswith('public'))
+
+    def test_traversal(self):
+        for name in ('../therapy/settings.py', 'avatars/../../therapy/settings.py', '%2e%2e/therapy/settings.py',
+                     'avatars/%2e%2e/licenses/other.jpg'):
+            self.assertEqual(self.get(name).status_code, 404, name)
+
+    def test_range(self):
+        response = self.get('avatars/avatar.jpg', HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 2-4/{len(CONTENT)}')
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+
+    def test_unsatisfiable_range(self):
+        response = self.get('avatars/avatar.jpg', HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(CONTENT)}')
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_no_range(self):
+        for header in (None, '', 'bytes=-', 'items=0-1', 'bytes=0-1,3-4'):
+            self.assertIsNone(parse_range(header, 10), header)
+
+    def test_range(self):
+        self.assertEqual(parse_range('bytes=0-0', 10), (0, 0))
+        self.assertEqual(parse_range('bytes=2-', 10), (2, 9))
+        # clamped to the end of the file
+        self.assertEqual(parse_range('bytes=5-100', 10), (5, 9))
+
+    def test_suffix(self):
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        # longer than the file
+        self.assertEqual(parse_range('bytes=-30', 10), (0, 9))
+        self.assertIs(parse_range('bytes=-0', 10), False)
+
+    def test_unsatisfiable(self):
+        self.assertIs(parse_range('bytes=10-', 10), False)
+        self.assertIs(parse_range('bytes=20-30', 10), False)
+        self.assertIs(parse_range('bytes=5-2', 10), False)
+        self.assertIs(parse_range('bytes=0-', 0), False)
+
+
+def metadata(**values):
+    return ','.join(f'{key} {base64.b64encode(value.encode()).decode()}' for key, value in values.items())
+
+
+@override_settings(UPLOAD_MAX_SIZE=1024 * 1024)
+class UploadTests(TemporaryMediaMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('therapist@example.com')
+        cls.therapist = Therapist.objects.create(user=cls.user)
+        cls.image = image_bytes()
+
+    def setUp(self):
+        self.headers = {'HTTP_TUS_RESUMABLE': '1.0.0', **authorization(self.user)}
+
+    def create(self, length=None, field='license', filetype='image/jpeg', user=None, **headers):
+        headers = {**self.headers, **(authorization(user) if user else {}),
+                   'HTTP_UPLOAD_LENGTH': str(length or len(self.image)),
+                   'HTTP_UPLOAD_METADATA': metadata(field=field, filetype=filetype), **headers}
+        return self.client.post('/api/v1/uploads/', **headers)
+
+    def create_url(self, **kwargs):
+        response = self.create(**kwargs)
+        self.assertEqual(response.status_code, 201)
+        return urlparse(response['Location']).path
+
+    def patch(self, url, offset, body, **headers):
+        return self.client.generic('PATCH', url, body, content_type='application/offset+octet-stream',
+                                   HTTP_UPLOAD_OFFSET=str(offset), **self.headers, **headers)
+
+    def offset(self, url):
+        return int(self.client.head(url, **self.headers)['Upload-Offset'])
+
+    def test_creation_validation(self):
+        self.assertEqual(self.create(HTTP_TUS_RESUMABLE='0.2.2').status_code, 412)
+        self.assertEqual(self.create(user=create_user('client@example.com')).status_code, 403)
+        self.assertEqual(self.create(length=1024 * 1024 + 1).status_code, 413)
+        self.assertEqual(self.create(filetype='application/pdf').status_code, 415)
+        self.assertEqual(self.create(field='bio').status_code, 400)
+        self.assertEqual(self.create(HTTP_UPLOAD_METADATA='field not-base64!').status_code, 400)
+        self.assertFalse(Upload.objects.exists())
+
+    def test_resume(self):
+        url = self.create_url()
+        half = len(self.image) // 2
+        response = self.patch(url, 0, self.image[:half])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response['Upload-Offset'], str(half))
+        # the client lost the response and asks where to resume from
+        self.assertEqual(self.offset(url), half)
+        response = self.patch(url, half, self.image[half:])
+        self.assertEqual(response['Upload-Offset'], str(len(self.image)))
+
+        self.therapist.refresh_from_db()
+        self.assertTrue(self.therapist.license.name.startswith('licenses/'))
+        with self.therapist.license.open('rb') as f:
+            self.assertEqual(f.read(), self.image)
+        upload = Upload.objects.get()
+        self.assertIsNotNone(upload.completed_at)
+        self.assertFalse(os.path.exists(uploads.temp_path(upload)))
+
+    def test_offset_mismatch(self):
+        url = self.create_url()
+        self.patch(url, 0, self.image[:10])
+        self.assertEqual(self.patch(url, 5, self.image[5:20]).status_code, 409)
+        self.assertEqual(self.offset(url), 10)
+
+    def test_checksum_mismatch(self):
+        url = self.create_url()
+        self.patch(url, 0, self.image[:10])
+        digest = base64.b64encode(hashlib.sha1(b'something else').digest()).decode()
+        response = self.patch(url, 10, self.image[10:20], HTTP_UPLOAD_CHECKSUM=f'sha1 {digest}')
+        self.assertEqual(response.status_code, 460)
+        self.assertEqual(self.offset(url), 10)
+
+        digest = base64.b64encode(hashlib.sha1(self.image[10:20]).digest()).decode()
+        response = self.patch(url, 10, self.image[10:20], HTTP_UPLOAD_CHECKSUM=f'sha1 {digest}')
+        self.assertEqual(response['Upload-Offset'], '20')
+
+    def test_busy(self):
+        url = self.create_url()
+        upload = Upload.objects.get()
+        os.makedirs(os.path.join(self.media_root, 'uploads'), exist_ok=True)
+        with open(uploads.temp_path(upload), 'wb') as f:
+            # a request already writing to the upload
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.assertEqual(self.patch(url, 0, self.image[:10]).status_code, 423)
+        self.assertEqual(self.offset(url), 0)
+
+    def test_invalid_content(self):
+        url = self.create_url(filetype='image/png')
+        response = self.patch(url, 0, self.image)
+        self.assertEqual(response.status_code, 415)
+        self.assertFalse(Upload.objects.exists())
+        self.therapist.refresh_from_db()
+        self.assertFalse(self.therapist.license)
+
+    def test_without_content_length(self):
+        url = self.create_url()
+        response = self.patch(url, 0, self.image[:10], CONTENT_LENGTH='')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.offset(url), 0)
+
+    def test_past_upload_length(self):
+        url = self.create_url(length=10)
+        self.assertEqual(self.patch(url, 0, self.image[:11]).status_code, 413)
+
+    def test_interrupted(self):
+        url = self.create_url()
+        upload = Upload.objects.get()
+
+        class DroppedConnection(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell() >= 10:
+                    raise OSError('connection reset')
+                return super().read(min(size, 10 - self.tell()))
+
+        with self.assertLogs('images.uploads', 'INFO'):
+            uploads.append_chunk(upload, 0, DroppedConnection(self.image), len(self.image))
+        # the bytes received before the connection dropped are kept
+        self.assertEqual(self.offset(url), 10)
+
+
+class ProcessImageTests(TemporaryMediaMixin, SimpleTestCase):
+    def setUp(self):
+        self.name = default_storage.save('licenses/license.jpg', ContentFile(image_bytes(exif=phone_exif())))
+
+    def open(self, name):
+        with default_storage.open(name, 'rb') as f:
+            image = Image.open(f)
+            image.load()
+        return image
+
+    def test_original(self):
+        result = processing.process_image(self.name, [32], False)
+        original = self.open(result['original'])
+        self.assertEqual(original.format, 'JPEG')
+        self.assertNotIn('exif', original.info)
+        self.assertEqual(dict(original.getexif()), {})
+        # the orientation is applied before it's dropped
+        self.assertEqual(original.size, (48, 64))
+        # the caller deletes the source
+        self.assertTrue(default_storage.exists(self.name))
+
+    def test_variants(self):
+        result = processing.process_image(self.name, [32, 16], False)
+        self.assertEqual(set(result['variants']), {'32', '16'})
+        for size, formats in result['variants'].items():
+            self.assertEqual(set(formats), {'webp', 'jpg'})
+            for extension, name in formats.items():
+                self.assertTrue(name.startswith(os.path.dirname(result['original']) + '/'))
+                image = self.open(name)
+                self.assertEqual(image.format, {'webp': 'WEBP', 'jpg': 'JPEG'}[extension])
+                self.assertEqual(max(image.size), int(size))
+                self.assertNotIn('exif', image.info)
+
+    def test_cropped(self):
+        result = processing.process_image(self.name, [32], True)
+        self.assertEqual(self.open(result['variants']['32']['webp']).size, (32, 32))
+
+    def test_not_an_image(self):
+        name = default_storage.save('licenses/license.jpg', ContentFile(b'not an image'))
+        with self.assertRaises(OSError):
+            processing.process_image(name, [32], False)
+
+
+class ImageQueueTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        self.name = default_storage.save('licenses/license.jpg', ContentFile(image_bytes(exif=phone_exif())))
+        # queues a job for the upload
+        self.therapist = Therapist.objects.create(user=create_user('therapist@example.com'), license=self.name)
+
+    def processed_files(self):
+        directory = os.path.join(self.media_root, 'licenses', 'processed')
+        return {os.path.join(path, name) for path, _, names in os.walk(directory) for name in names}
+
+    def test_process(self):
+        self.assertEqual(queue.process_pending_images(), 1)
+        self.therapist.refresh_from_db()
+        entry = self.therapist.image_variants['license']
+        self.assertEqual(self.therapist.license.name, entry['source'])
+        self.assertNotEqual(entry['source'], self.name)
+        self.assertIsNotNone(processing.variant_urls(self.therapist, 'license'))
+        self.assertIsNotNone(ImageJob.objects.get().processed_at)
+        # the processed original was saved, the job it would queue is already done
+        self.assertEqual(queue.process_pending_images(), 0)
+
+    def test_replaced_by_newer_upload(self):
+        job = ImageJob.objects.get()
+        processed = self.processed_files()
+        newer = default_storage.save('licenses/newer.jpg', ContentFile(image_bytes()))
+        self.therapist.license = newer
+        self.therapist.save()
+
+        queue.apply_job(job)
+        self.therapist.refresh_from_db()
+        self.assertEqual(self.therapist.license.name, newer)
+        self.assertNotIn('license', self.therapist.image_variants)
+        # neither the stale upload nor what was rendered from it is left behind
+        self.assertFalse(default_storage.exists(self.name))
+        self.assertEqual(self.processed_files(), processed)
+        self.assertTrue(default_storage.exists(newer))
+
+    def test_claimed_jobs_are_leased(self):
+        claimed = []
+        process_image = processing.process_image
+
+        def render(*args):
+            # another worker, while this one renders
+            claimed.extend(queue.claim_pending_jobs(10))
+            return process_image(*args)
+
+        with mock.patch.object(queue, 'process_image', render):
+            self.assertEqual(queue.process_pending_images(), 1)
+        self.assertEqual(claimed, [])
+
+    def test_lease_runs_out(self):
+        self.assertEqual(len(queue.claim_pending_jobs(10)), 1)
+        self.assertEqual(queue.claim_pending_jobs(10), [])
+        ImageJob.objects.update(next_attempt_at=timezone.now() - queue.LEASE)
+        self.assertEqual(len(queue.claim_pending_jobs(10)), 1)
+
+    def test_failure(self):
+        processed = self.processed_files()
+        with default_storage.open(self.name, 'wb') as f:
+            f.write(b'not an image')
+        with self.assertLogs('images.queue', 'ERROR'):
+            self.assertEqual(queue.process_pending_images(), 1)
+        job = ImageJob.objects.get()
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNone(job.processed_at)
+        self.assertGreater(job.next_attempt_at, timezone.now())
+        self.assertIn('UnidentifiedImageError', job.last_error)
+        # nothing rendered is left behind
+        self.assertEqual(self.processed_files(), processed)
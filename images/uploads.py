@@ -0,0 +1,179 @@
+"""
+Resumable uploads of verification documents, following the tus protocol (https://tus.io).
+
+An upload is declared with its size, then its bytes are appended by any number of requests, each
+streamed to a file under UPLOAD_TEMP_DIR a chunk at a time, so a dropped connection only loses the
+request in flight and memory stays flat whatever the size. The complete file is attached to the
+therapist, whose post_save queues it for images.queue like any other upload.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+from therapist.models import Therapist
+from .models import Upload
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_FIELDS = ('license', 'id_front', 'id_back')
+# declared type: (Pillow format the content must have, extension)
+ALLOWED_TYPES = {
+    'image/jpeg': ('JPEG', 'jpg'),
+    'image/png': ('PNG', 'png'),
+    'image/webp': ('WEBP', 'webp'),
+}
+CHECKSUM_ALGORITHMS = ('sha1', 'sha256', 'md5')
+EXPIRY = timedelta(days=1)
+# incomplete uploads a user can have at once, each one holds disk space until it expires
+MAX_ACTIVE_UPLOADS = 6
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class OffsetMismatch(UploadError):
+    pass
+
+
+class UploadBusy(UploadError):
+    pass
+
+
+class ChecksumMismatch(UploadError):
+    pass
+
+
+class InvalidContent(UploadError):
+    pass
+
+
+def temp_path(upload):
+    return os.path.join(settings.UPLOAD_TEMP_DIR, upload.id.hex)
+
+
+def create_upload(user, field, content_type, length):
+    now = timezone.now()
+    active = Upload.objects.filter(user=user, completed_at__isnull=True, expires_at__gt=now).count()
+    if active >= MAX_ACTIVE_UPLOADS:
+        raise UploadError(f'At most {MAX_ACTIVE_UPLOADS} uploads can be in progress at once.')
+    return Upload.objects.create(user=user, field=field, content_type=content_type, length=length,
+                                 expires_at=now + EXPIRY)
+
+
+def append_chunk(upload, offset, stream, size, checksum=None):
+    """
+    Appends size bytes read from stream to the upload, which must have received exactly offset bytes
+    so far, and attaches the file once it is complete. checksum is an (algorithm, digest) pair the
+    bytes must match, they are all dropped otherwise. Without one, the bytes received before a
+    dropped connection are kept so the client can resume from there.
+    """
+    os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+    with open(os.open(temp_path(upload), os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as f:
+        # a second request for the same upload would interleave its bytes
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadBusy('Another request is writing to this upload.')
+        # read under the lock, the request that held it may have moved the offset
+        upload.refresh_from_db(fields=['offset', 'completed_at'])
+        if offset != upload.offset:
+            raise OffsetMismatch(f'The upload is at offset {upload.offset}.')
+        if upload.completed_at is not None:
+            return upload
+
+        # drops whatever an interrupted request wrote past the recorded offset
+        f.seek(offset)
+        f.truncate()
+        digest = hashlib.new(checksum[0]) if checksum else None
+        received = 0
+        try:
+            while received < size:
+                chunk = stream.read(min(CHUNK_SIZE, size - received))
+                if not chunk:
+                    break
+                f.write(chunk)
+                if digest:
+                    digest.update(chunk)
+                received += len(chunk)
+        except OSError:
+            logger.info('Upload %s interrupted after %d bytes', upload.pk, received)
+        if digest and (received < size or digest.digest() != checksum[1]):
+            f.truncate(offset)
+            raise ChecksumMismatch('The request body does not match Upload-Checksum.')
+
+        f.flush()
+        upload.offset = offset + received
+        Upload.objects.filter(pk=upload.pk).update(offset=upload.offset)
+        if upload.offset == upload.length:
+            attach(upload, f)
+    return upload
+
+
+def attach(upload, f):
+    """
+    Checks the complete upload is an image of its declared type and saves it as the therapist's document.
+    """
+    image_format, extension = ALLOWED_TYPES[upload.content_type]
+    f.seek(0)
+    try:
+        with Image.open(f) as image:
+            valid = image.format == image_format
+            # walks the file without decoding the pixels
+            image.verify()
+    except Exception:
+        valid = False
+    if not valid:
+        discard(upload)
+        raise InvalidContent(f'The file is not a valid {upload.content_type} image.')
+
+    f.seek(0)
+    with transaction.atomic():
+        therapist = Therapist.objects.select_for_update().get(user_id=upload.user_id)
+        # copied to storage a chunk at a time
+        getattr(therapist, upload.field).save(f'{upload.id.hex}.{extension}', File(f), save=False)
+        therapist.save(update_fields=[upload.field, 'updated'])
+        upload.completed_at = timezone.now()
+        Upload.objects.filter(pk=upload.pk).update(completed_at=upload.completed_at)
+    os.remove(temp_path(upload))
+
+
+def discard(upload):
+    try:
+        os.remove(temp_path(upload))
+    except FileNotFoundError:
+        pass
+    upload.delete()
+
+
+def terminate(upload):
+    """
+    Deletes an upload and its file, unless a request is still writing to it.
+    """
+    try:
+        with open(temp_path(upload), 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(temp_path(upload))
+    except FileNotFoundError:
+        pass
+    except BlockingIOError:
+        raise UploadBusy('Another request is writing to this upload.')
+    upload.delete()
+
+
+def delete_expired_uploads():
+    deleted = 0
+    for upload in Upload.objects.filter(expires_at__lte=timezone.now()).iterator():
+        try:
+            terminate(upload)
+        except UploadBusy:
+            continue
+        deleted += 1
+    return deleted
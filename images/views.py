@@ -0,0 +1,151 @@
+import mimetypes
+import os
+import posixpath
+import re
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+from django.views.static import was_modified_since
+from rest_framework.exceptions import AuthenticationFailed
+from accounts.authentication import JWTAuthentication
+from therapist.models import Therapist
+
+# verification documents, only their therapist and staff can fetch them
+PROTECTED_PREFIXES = ('licenses/', 'id/')
+PROTECTED_FIELDS = ('license', 'id_front', 'id_back')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def get_user(request):
+    # the admin's session, or the JWT the app sends everywhere else
+    if request.user.is_authenticated:
+        return request.user
+    try:
+        authenticated = JWTAuthentication().authenticate(request)
+        # can_read needs the user itself, a deactivated one fails here
+        return authenticated[0].load() if authenticated else None
+    except AuthenticationFailed:
+        return None
+
+
+def can_read(user, path):
+    if user is None:
+        return False
+    if user.is_staff:
+        return True
+    # a processed document shares its directory with its variants, see images.processing
+    directory = posixpath.dirname(path)
+    if '/processed/' in path:
+        lookups = {f'{field}__startswith': directory + '/' for field in PROTECTED_FIELDS}
+    else:
+        lookups = {field: path for field in PROTECTED_FIELDS}
+    matches = Q()
+    for lookup, value in lookups.items():
+        matches |= Q(**{lookup: value})
+    return Therapist.objects.filter(matches, user=user).exists()
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serves MEDIA_ROOT. Verification documents need their therapist or staff, the bytes are handed to
+    the front-end server with MEDIA_ACCEL_HEADER when one is configured.
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    if path in ('', '.'):
+        raise Http404
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+
+    protected = path.startswith(PROTECTED_PREFIXES)
+    # unknown and forbidden documents look the same
+    if protected and not can_read(get_user(request), path):
+        raise Http404
+
+    if settings.MEDIA_ACCEL_HEADER:
+        # the front-end server sends the file, ranges and conditional requests included
+        response = HttpResponse(content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        if settings.MEDIA_ACCEL_HEADER == 'X-Accel-Redirect':
+            # an nginx internal location aliasing MEDIA_ROOT
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + path
+        else:
+            response[settings.MEDIA_ACCEL_HEADER] = full_path
+    else:
+        response = serve_file(request, full_path)
+
+    # processed files never change, see images.processing
+    max_age = 365 * 24 * 60 * 60 if '/processed/' in path else 60 * 60
+    response['Cache-Control'] = f'{"private" if protected else "public"}, max-age={max_age}'
+    return response
+
+
+def serve_file(request, full_path):
+    """
+    The pure Python fallback for local runs, with If-Modified-Since and single byte range support.
+    """
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
+        return HttpResponseNotModified()
+
+    size = stat.st_size
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(open(full_path, 'rb'))
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(full_path, start, end), status=206)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    return response
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single "bytes=" range, inclusive, None to send the whole file and False when
+    the range can't be satisfied. Multiple ranges are answered with the whole file.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def read_range(full_path, start, end):
+    with open(full_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,124 @@
+import logging
+import uuid
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from accounts.models import UserProfile
+from therapist.cache import bump_directory_version, bump_therapist_versions
+from therapist.models import TherapySession
+from .models import StripeEvent
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF = timedelta(hours=1)
+# about 10 hours, the last 8 of them hourly
+MAX_ATTEMPTS = 20
+
+
+def store_event(event):
+    """
+    Stores a verified webhook event, redeliveries of an event id that is already stored are dropped.
+    """
+    StripeEvent.objects.bulk_create([
+        StripeEvent(event_id=event['id'], type=event['type'], stripe_created=event['created'], payload=event)
+    ], ignore_conflicts=True)
+
+
+def parse_session_id(event):
+    session_id = event.payload['data']['object'].get('metadata', {}).get('session_id')
+    if not session_id:
+        return None
+    try:
+        return uuid.UUID(str(session_id))
+    except ValueError:
+        # no retry can fix it
+        logger.warning('Stripe event %s has a malformed session_id %r', event.event_id, session_id)
+        return None
+
+
+def handle_payment_intent_succeeded(events):
+    session_ids = [parse_session_id(event) for event in events]
+    session_ids = [session_id for session_id in session_ids if session_id]
+    TherapySession.objects.filter(surrogate__in=session_ids).update(status=TherapySession.PAYMENT_COMPLETED,
+                                                                    updated=timezone.now())
+    bump_therapist_versions(sessions__surrogate__in=session_ids)
+
+
+def handle_account_updated(events):
+    # only the latest state of every account matters
+    latest = {}
+    for event in sorted(events, key=lambda event: event.stripe_created):
+        account = event.payload['data']['object']
+        latest[account['id']] = (event.stripe_created, account)
+
+    for account_id, (created, account) in latest.items():
+        # a retried event can be older than one applied since, its state is stale then
+        UserProfile.objects.filter(Q(stripe_event_created__isnull=True) | Q(stripe_event_created__lt=created),
+                                   stripe_id=account_id)\
+            .update(charges_enabled=account.get('charges_enabled', False), stripe_event_created=created,
+                    updated=timezone.now())
+
+    # update() sends no signals
+    bump_therapist_versions(user__profile__stripe_id__in=list(latest))
+    bump_directory_version()
+
+
+HANDLERS = {
+    'payment_intent.succeeded': handle_payment_intent_succeeded,
+    'account.updated': handle_account_updated,
+}
+
+
+def process_pending_events(batch_size=100):
+    """
+    Applies a batch of due events and returns how many were picked up. Rows are locked with SKIP LOCKED
+    so several workers can run side by side. Events of the same type are applied together; when a group
+    fails, its events are retried one by one with exponential backoff, until MAX_ATTEMPTS marks them failed.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(StripeEvent.objects.select_for_update(skip_locked=True)
+                      .filter(processed_at__isnull=True, failed_at__isnull=True, next_attempt_at__lte=now)
+                      .order_by('next_attempt_at')[:batch_size])
+
+        by_type = {}
+        for event in events:
+            by_type.setdefault(event.type, []).append(event)
+
+        for event_type, group in by_type.items():
+            handler = HANDLERS.get(event_type)
+            if handler is None:
+                logger.info('Unhandled event type %s', event_type)
+                mark_processed(group, now)
+                continue
+
+            try:
+                with transaction.atomic():
+                    handler(group)
+                mark_processed(group, now)
+            except Exception:
+                logger.exception('Failed to apply %d %s events as a batch', len(group), event_type)
+                for event in group:
+                    apply_single_event(handler, event, now)
+    return len(events)
+
+
+def apply_single_event(handler, event, now):
+    try:
+        with transaction.atomic():
+            handler([event])
+        mark_processed([event], now)
+    except Exception as e:
+        logger.exception('Failed to apply Stripe event %s', event.event_id)
+        event.attempts += 1
+        event.next_attempt_at = now + min(timedelta(seconds=2 ** event.attempts), MAX_BACKOFF)
+        event.last_error = repr(e)
+        if event.attempts >= MAX_ATTEMPTS:
+            logger.error('Giving up on Stripe event %s after %d attempts', event.event_id, event.attempts)
+            event.failed_at = now
+        event.save(update_fields=['attempts', 'next_attempt_at', 'last_error', 'failed_at'])
+
+
+def mark_processed(events, now):
+    StripeEvent.objects.filter(pk__in=[event.pk for event in events]).update(processed_at=now)
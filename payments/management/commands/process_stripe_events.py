@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand
+from payments.events import process_pending_events
+from payments.provisioning import provision_pending_accounts
+
+
+class Command(BaseCommand):
+    help = 'Applies the Stripe webhook events stored by the stripe_webhook endpoint ' \
+           'and provisions the Stripe accounts of new therapists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the queue and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_pending_events(options['batch_size'])
+            processed += provision_pending_accounts()
+            if processed:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from payments.provisioning import requeue_failed_accounts
+
+
+class Command(BaseCommand):
+    help = 'Puts the therapists whose Stripe account provisioning gave up back in the provisioning queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('emails', nargs='*', help='Only these users, all of them by default')
+
+    def handle(self, *args, **options):
+        filters = {'user__email__in': options['emails']} if options['emails'] else {}
+        requeued = requeue_failed_accounts(**filters)
+        self.stdout.write(f'Requeued {requeued} accounts')
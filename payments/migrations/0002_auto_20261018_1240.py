@@ -0,0 +1,26 @@
+# Generated by Django 3.1.4 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='stripeevent',
+            name='stripe_event_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(condition=models.Q(('failed_at__isnull', True), ('processed_at__isnull', True)), fields=['next_attempt_at'], name='stripe_event_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import models
+from django.utils import timezone
+
+
+class StripeEvent(models.Model):
+    """
+    A verified Stripe webhook event, stored as received and applied later by the process_stripe_events worker.
+    """
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    # unix timestamp Stripe created the event at, orders repeated events for the same object
+    stripe_created = models.IntegerField()
+    payload = models.JSONField()
+    received = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    # set when the worker gives up on the event after MAX_ATTEMPTS, clear it to retry the event
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.event_id} - {self.type}'
+
+    class Meta:
+        indexes = [
+            # the worker's queue: unprocessed events that are due
+            models.Index(fields=['next_attempt_at'], name='stripe_event_pending_idx',
+                         condition=models.Q(processed_at__isnull=True, failed_at__isnull=True)),
+        ]
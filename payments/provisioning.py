@@ -0,0 +1,103 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.utils import timezone
+from accounts.models import UserProfile
+from . import stripe_client
+
+logger = logging.getLogger(__name__)
+
+# 2 minutes doubling up to 6 hours, about a day and a half of retries before giving up
+MAX_ATTEMPTS = 12
+MAX_BACKOFF = timedelta(hours=6)
+# how long a claimed profile is left to its worker, well past the Stripe calls' timeouts and retries
+LEASE = timedelta(minutes=10)
+
+
+def setup_stripe_account(user, user_profile):
+    # a retry after a failed AccountLink.create must not open a second account
+    if not user_profile.stripe_id:
+        account = stripe_client.call('Account.create',
+            type="express",
+            country="GR",
+            email=user.email,
+            capabilities={
+                "card_payments": {"requested": True},
+                "transfers": {"requested": True},
+            },
+            idempotency_key=f'account-{user_profile.surrogate}',
+        )
+        user_profile.stripe_id = account.id
+        user_profile.save(update_fields=['stripe_id'])
+
+    if settings.DEBUG:
+        redirect = 'http://localhost:3000/users/oauth/callback'
+        refresh_url = "http://localhost:3000/reauth"
+    else:
+        redirect = 'https://%s%s' % (Site.objects.get_current().domain, '/users/oauth/callback')
+        refresh_url = 'https://%s%s' % (Site.objects.get_current().domain, '/reauth')
+
+    account_link = stripe_client.call('AccountLink.create',
+        account=user_profile.stripe_id,
+        refresh_url=refresh_url,
+        return_url=redirect,
+        type="account_onboarding",
+    )
+
+    user_profile.stripe_account_link = account_link.url
+    user_profile.created = account_link.created
+    user_profile.expires_at = account_link.expires_at
+    user_profile.stripe_status = UserProfile.STRIPE_PROVISIONED
+    # the profile isn't locked, fields the user edited meanwhile are left alone
+    user_profile.save(update_fields=['stripe_account_link', 'created', 'expires_at', 'stripe_status', 'updated'])
+    return account_link
+
+
+def claim_pending_accounts(batch_size):
+    """
+    Leases a batch of due profiles to this worker by moving their next attempt past LEASE, so no other
+    worker picks them up while their Stripe calls run outside of any transaction. A worker that dies
+    leaves its profiles to be picked up again once the lease runs out.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        profiles = list(UserProfile.objects.select_for_update(skip_locked=True, of=('self',))
+                        .select_related('user')
+                        .filter(stripe_status=UserProfile.STRIPE_PENDING, stripe_next_attempt_at__lte=now)
+                        .order_by('stripe_next_attempt_at')[:batch_size])
+        UserProfile.objects.filter(pk__in=[profile.pk for profile in profiles])\
+            .update(stripe_next_attempt_at=now + LEASE)
+    return profiles
+
+
+def provision_pending_accounts(batch_size=10):
+    """
+    Sets up the Stripe accounts of therapists that signed up since the last run and returns how many
+    profiles were picked up. Failures are retried with exponential backoff until MAX_ATTEMPTS, after
+    which the profile is STRIPE_FAILED until requeue_failed_accounts puts it back in the queue.
+    """
+    profiles = claim_pending_accounts(batch_size)
+    for profile in profiles:
+        try:
+            setup_stripe_account(profile.user, profile)
+        except Exception:
+            logger.exception('Failed to provision the Stripe account of %s', profile.user.email)
+            with transaction.atomic():
+                profile.stripe_attempts += 1
+                profile.stripe_next_attempt_at = timezone.now() + min(
+                    timedelta(minutes=2 ** profile.stripe_attempts), MAX_BACKOFF)
+                if profile.stripe_attempts >= MAX_ATTEMPTS:
+                    profile.stripe_status = UserProfile.STRIPE_FAILED
+                profile.save(update_fields=['stripe_attempts', 'stripe_next_attempt_at', 'stripe_status'])
+    return len(profiles)
+
+
+def requeue_failed_accounts(**filters):
+    """
+    Puts the profiles whose provisioning gave up back in the queue, with their attempts reset, once
+    whatever made Stripe refuse them is fixed. Returns how many were requeued.
+    """
+    return UserProfile.objects.filter(stripe_status=UserProfile.STRIPE_FAILED, **filters).update(
+        stripe_status=UserProfile.STRIPE_PENDING, stripe_attempts=0, stripe_next_attempt_at=timezone.now())
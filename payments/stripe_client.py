@@ -0,0 +1,218 @@
+"""
+The process-wide Stripe client. Every Stripe call goes through `call`, which uses a single pooled
+keep-alive session with explicit timeouts and records the latency of each operation.
+
+Async views use `acall` instead. The SDK has no async support, so it still builds the request and
+parses the response, but the request itself is sent with httpx and awaited, and the event loop keeps
+serving other requests in the meantime.
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+import weakref
+import httpx
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+import stripe
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """
+    Thread-safe cumulative latency histogram per operation, in seconds.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def observe(self, operation, seconds):
+        with self._lock:
+            stats = self._operations.setdefault(operation, {
+                'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0, 'errors': 0,
+            })
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+            stats['count'] += 1
+            stats['sum'] += seconds
+
+    def observe_error(self, operation):
+        with self._lock:
+            self._operations.setdefault(operation, {
+                'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0, 'errors': 0,
+            })['errors'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {operation: {**stats, 'buckets': list(stats['buckets'])}
+                    for operation, stats in self._operations.items()}
+
+
+latency = LatencyHistogram()
+
+
+class RequestBuilt(Exception):
+    pass
+
+
+class Exchange:
+    """
+    The request an acall built and the response it received.
+    """
+    def __init__(self):
+        self.request = None
+        self.response = None
+
+
+# the Exchange of the acall running in the current task
+current_exchange = contextvars.ContextVar('stripe_exchange', default=None)
+
+
+class ExchangeClient(stripe.http_client.HTTPClient):
+    """
+    Sends requests with the pooled sync client, except inside an acall: there the first SDK pass stops
+    at the built request, and the second is handed the response acall awaited.
+    """
+    def __init__(self, client):
+        super(ExchangeClient, self).__init__()
+        self.client = client
+
+    @property
+    def name(self):
+        return self.client.name
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        exchange = current_exchange.get()
+        if exchange is None:
+            return self.client.request_with_retries(method, url, headers, post_data)
+        if exchange.response is None:
+            exchange.request = (method, url, headers, post_data)
+            raise RequestBuilt()
+        return exchange.response
+
+    def close(self):
+        self.client.close()
+
+
+def build_http_client():
+    session = Session()
+    # no urllib3 retries, stripe retries idempotently on its own (max_network_retries)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.STRIPE_POOL_SIZE, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return ExchangeClient(stripe.http_client.RequestsClient(
+        timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+        session=session,
+    ))
+
+
+# an httpx client can only be used from the event loop it was created in; the ASGI server has one loop
+# per process, but the WSGI handler runs every async view in a loop of its own
+async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    loop = asyncio.get_event_loop()
+    if loop not in async_clients:
+        async_clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.STRIPE_READ_TIMEOUT, connect=settings.STRIPE_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=settings.STRIPE_ASYNC_POOL_SIZE,
+                                max_keepalive_connections=settings.STRIPE_ASYNC_POOL_SIZE),
+        )
+    return async_clients[loop]
+
+
+async def send(method, url, headers, post_data):
+    """
+    Sends a request the SDK built, retried on the same conditions and with the same backoff as the
+    SDK's own client. POSTs carry an Idempotency-Key, so retrying them is safe.
+    """
+    # _should_retry and _sleep_time_seconds are private to the SDK, which is pinned in requirements.txt
+    # for them and for acall's two passes; payments.tests checks both against the installed version
+    retry_policy = stripe.default_http_client
+    num_retries = 0
+    while True:
+        try:
+            response = await get_async_client().request(method.upper(), url, headers=headers, content=post_data)
+            response = (response.text, response.status_code, response.headers)
+            connection_error = None
+        except httpx.TransportError as e:
+            response = None
+            connection_error = stripe.error.APIConnectionError(
+                f'Unexpected error communicating with Stripe: {e!r}', should_retry=True)
+
+        if not retry_policy._should_retry(response, connection_error, num_retries):
+            if connection_error:
+                raise connection_error
+            return response
+        num_retries += 1
+        await asyncio.sleep(retry_policy._sleep_time_seconds(num_retries, response))
+
+
+def configure():
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    # lets benchmarks point the client at a local stub server
+    stripe.api_base = settings.STRIPE_API_BASE
+    stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES
+    stripe.default_http_client = build_http_client()
+
+
+def resolve(operation):
+    target = stripe
+    for name in operation.split('.'):
+        target = getattr(target, name)
+    return target
+
+
+def call(operation, *args, **kwargs):
+    """
+    Runs a Stripe SDK call by name, e.g. call('checkout.Session.create', mode='payment', ...).
+    """
+    method = resolve(operation)
+    start = time.perf_counter()
+    try:
+        result = method(*args, **kwargs)
+    except Exception:
+        latency.observe_error(operation)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        latency.observe(operation, elapsed)
+        logger.debug('stripe %s took %.3fs', operation, elapsed)
+    return result
+
+
+async def acall(operation, *args, **kwargs):
+    """
+    call() for async views, e.g. await acall('checkout.Session.create', mode='payment', ...).
+    """
+    method = resolve(operation)
+    exchange = Exchange()
+    # each task runs with a copy of the context, so concurrent acalls don't see each other's exchange
+    token = current_exchange.set(exchange)
+    start = time.perf_counter()
+    try:
+        try:
+            result = method(*args, **kwargs)
+        except RequestBuilt:
+            exchange.response = await send(*exchange.request)
+            # parses the response, and raises stripe's errors, exactly as a sync call would
+            result = method(*args, **kwargs)
+    except Exception:
+        latency.observe_error(operation)
+        raise
+    finally:
+        current_exchange.reset(token)
+        elapsed = time.perf_counter() - start
+        latency.observe(operation, elapsed)
+        logger.debug('stripe %s took %.3fs', operation, elapsed)
+    return result
+
+
+configure()
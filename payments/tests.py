@@ -0,0 +1,194 @@
+import re
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+import httpx
+import stripe
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from datetime import timedelta
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from stripe.version import VERSION
+from accounts.models import User, UserProfile
+from therapist.models import Therapist, TherapySession
+from . import events, stripe_client
+from .models import StripeEvent
+from .provisioning import (MAX_ATTEMPTS, LEASE, claim_pending_accounts, provision_pending_accounts,
+                           requeue_failed_accounts)
+
+CUSTOMER = '{"id": "cus_1", "object": "customer"}'
+CUSTOMER_URL = 'https://api.stripe.com/v1/customers/cus_1'
+
+
+def connect_error():
+    return httpx.ConnectError('refused', request=httpx.Request('GET', CUSTOMER_URL))
+
+
+def pinned_version(package):
+    requirements = (Path(settings.BASE_DIR) / 'requirements.txt').read_text()
+    return re.search(rf'^{package}==(\S+)$', requirements, re.MULTILINE).group(1)
+
+
+class AsyncStripeClientTests(SimpleTestCase):
+    """
+    acall runs the SDK twice around the request it sends itself, and send retries with the SDK's
+    private retry policy, so both depend on the SDK's internals. Upgrading stripe has to pass these.
+    """
+
+    def test_stripe_is_pinned(self):
+        self.assertEqual(VERSION, pinned_version('stripe'))
+
+    def test_acall(self):
+        sent = []
+
+        async def send(method, url, headers, post_data):
+            sent.append((method, url))
+            return CUSTOMER, 200, {}
+
+        with mock.patch.object(stripe_client, 'send', send):
+            customer = async_to_sync(stripe_client.acall)('Customer.retrieve', 'cus_1', api_key='sk_test')
+        self.assertEqual(sent, [('get', f'{stripe.api_base}/v1/customers/cus_1')])
+        self.assertIsInstance(customer, stripe.Customer)
+        self.assertEqual(customer.id, 'cus_1')
+
+    def test_acall_error(self):
+        async def send(method, url, headers, post_data):
+            return '{"error": {"message": "No such customer", "type": "invalid_request_error"}}', 404, {}
+
+        with mock.patch.object(stripe_client, 'send', send):
+            with self.assertRaises(stripe.error.InvalidRequestError):
+                async_to_sync(stripe_client.acall)('Customer.retrieve', 'cus_1', api_key='sk_test')
+
+    def test_send_retries(self):
+        responses = [connect_error(), SimpleNamespace(text='', status_code=503, headers={}),
+                     SimpleNamespace(text=CUSTOMER, status_code=200, headers={})]
+
+        async def request(*args, **kwargs):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        client = SimpleNamespace(request=request)
+        with mock.patch.object(stripe_client, 'get_async_client', lambda: client), \
+                mock.patch.object(stripe.default_http_client, '_sleep_time_seconds', return_value=0), \
+                mock.patch.object(stripe, 'max_network_retries', 2):
+            response = async_to_sync(stripe_client.send)('get', CUSTOMER_URL, {}, None)
+        self.assertEqual(response, (CUSTOMER, 200, {}))
+
+    def test_send_gives_up(self):
+        async def request(*args, **kwargs):
+            raise connect_error()
+
+        client = SimpleNamespace(request=request)
+        with mock.patch.object(stripe_client, 'get_async_client', lambda: client), \
+                mock.patch.object(stripe.default_http_client, '_sleep_time_seconds', return_value=0):
+            with self.assertRaises(stripe.error.APIConnectionError):
+                async_to_sync(stripe_client.send)('get', CUSTOMER_URL, {}, None)
+
+
+class ProvisioningTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(email='therapist@example.com')
+        self.profile = UserProfile.objects.create(user=user, is_therapist=True, stripe_status=UserProfile.STRIPE_PENDING)
+
+    def stripe(self, operation, **kwargs):
+        if operation == 'Account.create':
+            return SimpleNamespace(id='acct_1')
+        return SimpleNamespace(url='https://connect.stripe.com/setup/e/acct_1', created=1, expires_at=2)
+
+    def test_provision(self):
+        with mock.patch.object(stripe_client, 'call', self.stripe):
+            self.assertEqual(provision_pending_accounts(), 1)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.stripe_status, UserProfile.STRIPE_PROVISIONED)
+        self.assertEqual(self.profile.stripe_id, 'acct_1')
+
+    def test_claimed_accounts_are_leased(self):
+        claimed = []
+
+        def stripe(operation, **kwargs):
+            # another worker, while this one waits on Stripe
+            claimed.extend(claim_pending_accounts(10))
+            return self.stripe(operation, **kwargs)
+
+        with mock.patch.object(stripe_client, 'call', stripe):
+            provision_pending_accounts()
+        self.assertEqual(claimed, [])
+
+    def test_lease_runs_out(self):
+        self.assertEqual(len(claim_pending_accounts(10)), 1)
+        self.assertEqual(claim_pending_accounts(10), [])
+        UserProfile.objects.filter(pk=self.profile.pk).update(stripe_next_attempt_at=timezone.now() - LEASE)
+        self.assertEqual(len(claim_pending_accounts(10)), 1)
+
+    def test_failure(self):
+        def stripe(operation, **kwargs):
+            raise stripe_client.stripe.error.APIConnectionError('unreachable')
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            UserProfile.objects.filter(pk=self.profile.pk).update(stripe_next_attempt_at=timezone.now())
+            with mock.patch.object(stripe_client, 'call', stripe), self.assertLogs('payments.provisioning', 'ERROR'):
+                self.assertEqual(provision_pending_accounts(), 1)
+            self.profile.refresh_from_db()
+            self.assertEqual(self.profile.stripe_attempts, attempt)
+        self.assertEqual(self.profile.stripe_status, UserProfile.STRIPE_FAILED)
+        # the backoff reached hours
+        self.assertGreater(self.profile.stripe_next_attempt_at - timezone.now(), LEASE * 6)
+
+        self.assertEqual(requeue_failed_accounts(), 1)
+        with mock.patch.object(stripe_client, 'call', self.stripe):
+            self.assertEqual(provision_pending_accounts(), 1)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.stripe_status, UserProfile.STRIPE_PROVISIONED)
+
+
+def stripe_event(event_id, event_type, created, data):
+    events.store_event({'id': event_id, 'type': event_type, 'created': created, 'data': {'object': data}})
+
+
+class EventTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(email='therapist@example.com')
+        self.profile = UserProfile.objects.create(user=user, is_therapist=True, stripe_id='acct_1')
+
+    def test_older_account_update_is_ignored(self):
+        stripe_event('evt_2', 'account.updated', 200, {'id': 'acct_1', 'charges_enabled': True})
+        self.assertEqual(events.process_pending_events(), 1)
+        # a retry of an event Stripe sent before
+        stripe_event('evt_1', 'account.updated', 100, {'id': 'acct_1', 'charges_enabled': False})
+        self.assertEqual(events.process_pending_events(), 1)
+        self.profile.refresh_from_db()
+        self.assertTrue(self.profile.charges_enabled)
+        self.assertEqual(self.profile.stripe_event_created, 200)
+
+    def test_malformed_session_id(self):
+        therapist = Therapist.objects.create(user=self.profile.user)
+        client = User.objects.create(email='client@example.com')
+        UserProfile.objects.create(user=client)
+        session = TherapySession.objects.create(therapist=therapist, user=client,
+                                                start_date=timezone.now() + timedelta(days=1))
+        stripe_event('evt_1', 'payment_intent.succeeded', 100, {'metadata': {'session_id': 'not-a-uuid'}})
+        stripe_event('evt_2', 'payment_intent.succeeded', 100, {'metadata': {'session_id': str(session.surrogate)}})
+        with self.assertLogs('payments.events', 'WARNING'):
+            self.assertEqual(events.process_pending_events(), 2)
+        self.assertFalse(StripeEvent.objects.filter(processed_at__isnull=True).exists())
+        session.refresh_from_db()
+        self.assertEqual(session.status, TherapySession.PAYMENT_COMPLETED)
+
+    def test_failing_event_is_given_up_on(self):
+        def fail(group):
+            raise ValueError('unexpected payload')
+
+        stripe_event('evt_1', 'account.updated', 100, {'id': 'acct_1', 'charges_enabled': True})
+        with mock.patch.dict(events.HANDLERS, {'account.updated': fail}), self.assertLogs('payments.events', 'ERROR'):
+            for attempt in range(events.MAX_ATTEMPTS):
+                StripeEvent.objects.update(next_attempt_at=timezone.now())
+                self.assertEqual(events.process_pending_events(), 1)
+            StripeEvent.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(events.process_pending_events(), 0)
+        event = StripeEvent.objects.get()
+        self.assertEqual(event.attempts, events.MAX_ATTEMPTS)
+        self.assertIsNotNone(event.failed_at)
+        self.assertIsNone(event.processed_at)
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+from reviews.models import Review
+from therapist.models import Therapist
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalized rating summary of every therapist from their reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        fields = ['rating_count', 'rating_sum', 'rating_average', 'updated'] + \
+            [f'rating_{stars}' for stars in range(1, 6)]
+        now = timezone.now()
+
+        with transaction.atomic():
+            # locked before aggregating: a review saved meanwhile either committed before the totals are
+            # read, or its update_rating_summary waits for this transaction and applies on top of it
+            therapists = list(Therapist.objects.select_for_update().only('id').order_by('pk'))
+
+            # one grouped query for all the totals
+            summaries = Review.objects.filter(stars__isnull=False).values('therapist_id').annotate(
+                count=Count('id'),
+                total=Sum('stars'),
+                **{f'rating_{stars}': Count('id', filter=Q(stars=stars)) for stars in range(1, 6)}
+            )
+            summaries = {summary['therapist_id']: summary for summary in summaries}
+
+            for therapist in therapists:
+                summary = summaries.get(therapist.id)
+                if summary:
+                    therapist.rating_count = summary['count']
+                    therapist.rating_sum = summary['total']
+                    therapist.rating_average = summary['total'] / summary['count']
+                    for stars in range(1, 6):
+                        setattr(therapist, f'rating_{stars}', summary[f'rating_{stars}'])
+                else:
+                    therapist.rating_count = 0
+                    therapist.rating_sum = 0
+                    therapist.rating_average = None
+                    for stars in range(1, 6):
+                        setattr(therapist, f'rating_{stars}', 0)
+                therapist.updated = now
+
+            Therapist.objects.bulk_update(therapists, fields, batch_size=batch_size)
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt ratings for {len(therapists)} therapists'))
@@ -1,6 +1,11 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast, NullIf
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.core.validators import MaxValueValidator, MinValueValidator
 from accounts.models import User
+from therapist.cache import bump_therapist_versions
 from therapist.models import Therapist
 import uuid
 
@@ -11,7 +16,46 @@ class Review(models.Model):
     therapist = models.ForeignKey(Therapist, on_delete=models.CASCADE, related_name="reviews")
     stars = models.IntegerField(null=True, validators=[MinValueValidator(1), MaxValueValidator(5)])
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            previous = None
+            if self.pk is not None:
+                previous = Review.objects.select_for_update().filter(pk=self.pk)\
+                    .values('therapist_id', 'stars').first()
+
+            super(Review, self).save(*args, **kwargs)
+
+            # also covers a review moving between therapists
+            if previous is not None:
+                update_rating_summary(previous['therapist_id'], previous['stars'], -1)
+                if previous['therapist_id'] != self.therapist_id:
+                    bump_therapist_versions(pk=previous['therapist_id'])
+            update_rating_summary(self.therapist_id, self.stars, 1)
+
     class Meta:
         constraints = [
         models.UniqueConstraint(fields=['user', 'therapist'], name='unique_user_review')
     ]
+
+
+def update_rating_summary(therapist_id, stars, delta):
+    """
+    Adds (delta=1) or removes (delta=-1) a rating from the therapist's summary in a single UPDATE.
+    Reviews without stars don't count towards the rating.
+    """
+    if therapist_id is None or stars is None:
+        return
+
+    # every expression of an UPDATE reads the row as it was before the statement
+    Therapist.objects.filter(pk=therapist_id).update(**{
+        'rating_count': F('rating_count') + delta,
+        'rating_sum': F('rating_sum') + delta * stars,
+        'rating_average': Cast(F('rating_sum') + delta * stars, FloatField()) /
+                          NullIf(F('rating_count') + delta, 0),
+        f'rating_{stars}': F(f'rating_{stars}') + delta,
+    })
+
+
+@receiver(post_delete, sender=Review)
+def delete_review(sender, instance, **kwargs):
+    update_rating_summary(instance.therapist_id, instance.stars, -1)
@@ -1,3 +1,25 @@
+from io import StringIO
+from django.core.management import call_command
 from django.test import TestCase
+from accounts.models import User
+from therapist.models import Therapist
+from .models import Review
 
-# Create your tests here.
+
+class RebuildRatingsTests(TestCase):
+    def test_rebuild_ratings(self):
+        therapist = Therapist.objects.create(user=User.objects.create(email='therapist@example.com'))
+        unrated = Therapist.objects.create(user=User.objects.create(email='unrated@example.com'))
+        for i, stars in enumerate((5, 4, 4)):
+            Review.objects.create(user=User.objects.create(email=f'client{i}@example.com'), therapist=therapist,
+                                  stars=stars)
+        # drifted, e.g. by an update() that skipped update_rating_summary
+        Therapist.objects.update(rating_count=7, rating_sum=1, rating_4=0)
+
+        call_command('rebuild_ratings', stdout=StringIO())
+        therapist.refresh_from_db()
+        unrated.refresh_from_db()
+        self.assertEqual((therapist.rating_count, therapist.rating_sum, therapist.rating_4, therapist.rating_5),
+                         (3, 13, 2, 1))
+        self.assertAlmostEqual(therapist.rating_average, 13 / 3)
+        self.assertEqual((unrated.rating_count, unrated.rating_average), (0, None))
@@ -1,8 +1,9 @@
 from django.contrib import admin
-from .models import Therapist, TherapySession, AvailableTimeRange, TherapistSpecialties
+from .models import Therapist, TherapySession, AvailableTimeRange, TherapistSpecialties, Specialty
 
 # Register your models here.
 admin.site.register(Therapist)
 admin.site.register(TherapySession)
 admin.site.register(AvailableTimeRange)
 admin.site.register(TherapistSpecialties)
+admin.site.register(Specialty)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class TherapistConfig(AppConfig):
     name = 'therapist'
+
+    def ready(self):
+        # connects the cache invalidation and search vector receivers, and registers the system checks
+        from . import cache, checks, search
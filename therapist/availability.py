@@ -0,0 +1,61 @@
+from django.db import transaction
+from .cache import bump_once, bump_therapist_versions
+from .models import AvailableTimeRange, Therapist
+
+
+def find_conflicts(time_ranges):
+    """
+    Inverted and overlapping ranges among (weekday, start_time, end_time) tuples, found in one pass
+    over them sorted. Ranges that only touch, 09:00-10:00 and 10:00-11:00, don't overlap.
+    """
+    conflicts = []
+    previous = None
+    for time_range in sorted(time_ranges):
+        weekday, start_time, end_time = time_range
+        if start_time >= end_time:
+            conflicts.append(f'{start_time}-{end_time} on weekday {weekday} ends before it starts.')
+            continue
+        if previous is not None and previous[0] == weekday and start_time < previous[2]:
+            conflicts.append(f'{start_time}-{end_time} overlaps {previous[1]}-{previous[2]} on weekday {weekday}.')
+        if previous is None or previous[0] != weekday or end_time > previous[2]:
+            previous = time_range
+    return conflicts
+
+
+def replace_time_ranges(schedules):
+    """
+    Makes {therapist_id: [(weekday, start_time, end_time), ...]} the therapists' weekly schedules.
+
+    Only the difference to the stored rows is written, with one delete and one insert for all
+    the therapists, in a transaction so nobody reads a half replaced schedule.
+    """
+    with transaction.atomic():
+        # locking the therapists rather than their ranges also serializes the first schedule of each
+        list(Therapist.objects.select_for_update().filter(pk__in=schedules.keys()).values_list('pk'))
+        current = AvailableTimeRange.objects.filter(therapist_id__in=schedules.keys())
+        stale = []
+        changed = set()
+        wanted = {therapist_id: set(time_ranges) for therapist_id, time_ranges in schedules.items()}
+        for time_range in current:
+            key = (time_range.weekday, time_range.start_time, time_range.end_time)
+            if key in wanted[time_range.therapist_id]:
+                # already stored, duplicates of it are stale
+                wanted[time_range.therapist_id].discard(key)
+            else:
+                stale.append(time_range.id)
+                changed.add(time_range.therapist_id)
+
+        missing = [AvailableTimeRange(therapist_id=therapist_id, weekday=weekday, start_time=start_time,
+                                      end_time=end_time)
+                   for therapist_id, time_ranges in wanted.items() for weekday, start_time, end_time in time_ranges]
+
+        if stale:
+            # the therapists are bumped once below
+            with bump_once():
+                AvailableTimeRange.objects.filter(id__in=stale).delete()
+        AvailableTimeRange.objects.bulk_create(missing)
+
+        changed.update(time_range.therapist_id for time_range in missing)
+        if changed:
+            bump_therapist_versions(pk__in=changed)
+    return {'deleted': len(stale), 'created': len(missing)}
@@ -0,0 +1,147 @@
+"""
+Version tokens for the cached therapist directory.
+
+Every therapist has a version token in the cache, its serialized fragments are stored under
+the current token so a bump invalidates all of them at once. A bump also moves the therapist's
+updated timestamp, which conditional GETs validate against. The directory version covers
+which therapists are listed and in what order. Bumps run once the transaction commits, so a
+reader can never cache data older than the version it read.
+
+The workers bump versions too, so the cache has to be shared by every process (CACHE_URL), see
+therapist.checks.
+"""
+import contextvars
+import uuid
+from contextlib import contextmanager
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Therapist
+
+DIRECTORY_VERSION_KEY = 'therapist-directory-version'
+# set by bump_once, whose caller bumps the therapists it wrote to itself
+child_bumps_muted = contextvars.ContextVar('child_bumps_muted', default=False)
+
+
+def therapist_version_key(surrogate):
+    return f'therapist-version:{surrogate}'
+
+
+def new_version():
+    return uuid.uuid4().hex
+
+
+def get_therapist_versions(surrogates):
+    """
+    Current version token of each surrogate in (at most) two round trips.
+    """
+    keys = {therapist_version_key(surrogate): surrogate for surrogate in surrogates}
+    found = cache.get_many(list(keys))
+    missing = [key for key in keys if key not in found]
+    if missing:
+        # evicted or never set, add() keeps a token another process set meanwhile
+        for key in missing:
+            cache.add(key, new_version(), None)
+        found.update(cache.get_many(missing))
+    # a cache that keeps nothing (DummyCache) gets a fresh token, which never hits
+    return {surrogate: found.get(key) or new_version() for key, surrogate in keys.items()}
+
+
+def get_directory_version():
+    version = cache.get(DIRECTORY_VERSION_KEY)
+    if version is None:
+        cache.add(DIRECTORY_VERSION_KEY, new_version(), None)
+        version = cache.get(DIRECTORY_VERSION_KEY)
+    return version or new_version()
+
+
+def bump_therapist_versions(*args, **kwargs):
+    """
+    Invalidates the cached fragments of the therapists matching the filter(*args, **kwargs) lookup.
+    """
+    def bump():
+        therapists = Therapist.objects.filter(*args, **kwargs)
+        therapists.update(updated=timezone.now())
+        surrogates = therapists.values_list('surrogate', flat=True).distinct()
+        cache.set_many({therapist_version_key(surrogate): new_version() for surrogate in surrogates}, None)
+    transaction.on_commit(bump)
+
+
+@contextmanager
+def bump_once():
+    """
+    Mutes the per row bumps of sessions, availability and reviews written inside it, for bulk writes
+    that call bump_therapist_versions once for all the therapists they touched.
+    """
+    token = child_bumps_muted.set(True)
+    try:
+        yield
+    finally:
+        child_bumps_muted.reset(token)
+
+
+def bump_therapist_surrogate_version(surrogate):
+    transaction.on_commit(lambda: cache.set(therapist_version_key(surrogate), new_version(), None))
+
+
+def bump_directory_version():
+    transaction.on_commit(lambda: cache.set(DIRECTORY_VERSION_KEY, new_version(), None))
+
+
+@receiver(post_save, sender=Therapist)
+@receiver(post_delete, sender=Therapist)
+def therapist_changed(sender, instance, **kwargs):
+    # by surrogate, a deleted therapist can't be looked up anymore
+    bump_therapist_surrogate_version(instance.surrogate)
+    bump_directory_version()
+
+
+@receiver(post_save, sender='therapist.AvailableTimeRange')
+@receiver(post_delete, sender='therapist.AvailableTimeRange')
+@receiver(post_save, sender='therapist.TherapySession')
+@receiver(post_delete, sender='therapist.TherapySession')
+@receiver(post_save, sender='reviews.Review')
+@receiver(post_delete, sender='reviews.Review')
+def therapist_child_changed(sender, instance, **kwargs):
+    if not child_bumps_muted.get():
+        bump_therapist_versions(pk=instance.therapist_id)
+
+
+# specialties also decide which therapists ?specialty= and ?q= list
+
+@receiver(post_save, sender='therapist.TherapistSpecialties')
+@receiver(post_delete, sender='therapist.TherapistSpecialties')
+def therapist_specialty_changed(sender, instance, **kwargs):
+    bump_therapist_versions(pk=instance.therapist_id)
+    bump_directory_version()
+
+
+@receiver(m2m_changed, sender=Therapist.specialties.through)
+def therapist_specialties_changed(sender, instance, action, **kwargs):
+    # add() and remove() write the through rows in bulk, without their post_save
+    if not action.startswith('post_'):
+        return
+    if isinstance(instance, Therapist):
+        bump_therapist_versions(pk=instance.pk)
+    else:
+        bump_therapist_versions(pk__in=kwargs.get('pk_set') or [])
+    bump_directory_version()
+
+
+@receiver(post_save, sender='therapist.Specialty')
+def specialty_changed(sender, instance, **kwargs):
+    bump_therapist_versions(specialties=instance)
+    bump_directory_version()
+
+
+@receiver(post_save, sender='accounts.UserProfile')
+@receiver(post_delete, sender='accounts.UserProfile')
+def user_profile_changed(sender, instance, **kwargs):
+    # the therapist's own profile, or a client embedded in their sessions
+    bump_therapist_versions(Q(user_id=instance.user_id) | Q(sessions__user_id=instance.user_id))
+    if instance.is_therapist:
+        # charges_enabled decides who is listed
+        bump_directory_version()
@@ -0,0 +1,93 @@
+"""
+iCalendar (RFC 5545) feed of a user's therapy sessions, rendered line by line so it can be streamed.
+"""
+from django.db.models import DateTimeField, F, Func, IntegerField, OuterRef, Q, Subquery
+from django.utils import timezone
+from accounts.models import UserProfile
+from .models import Therapist, TherapySession
+
+EVENT_STATUS = {
+    TherapySession.PENDING: 'TENTATIVE',
+    TherapySession.APPROVED: 'CONFIRMED',
+    TherapySession.PAYMENT_COMPLETED: 'CONFIRMED',
+    TherapySession.REJECTED: 'CANCELLED',
+}
+
+
+def get_feed_owner(token):
+    """
+    The user id, therapist id, session count and last session change behind a calendar token, in
+    one query, which is all a conditional GET of an unchanged calendar needs. None for unknown tokens.
+    """
+    therapist = Therapist.objects.filter(user_id=OuterRef(OuterRef('user_id'))).values('id')
+    sessions = TherapySession.objects.filter(Q(user_id=OuterRef('user_id')) | Q(therapist_id=Subquery(therapist)))\
+        .order_by()
+    # plain COUNT()/MAX() functions, so the subqueries aggregate over all their rows without a GROUP BY
+    return UserProfile.objects.filter(calendar_token=token).annotate(
+        therapist_id=Subquery(Therapist.objects.filter(user_id=OuterRef('user_id')).values('id')),
+        session_count=Subquery(sessions.annotate(value=Func(F('id'), function='COUNT')).values('value'),
+                               output_field=IntegerField()),
+        last_modified=Subquery(sessions.annotate(value=Func(F('updated'), function='MAX')).values('value'),
+                               output_field=DateTimeField()),
+    ).values('user_id', 'therapist_id', 'session_count', 'last_modified').first()
+
+
+def get_feed_sessions(user_id, therapist_id):
+    mine = Q(user_id=user_id)
+    if therapist_id is not None:
+        mine |= Q(therapist_id=therapist_id)
+    return TherapySession.objects.filter(mine).order_by('start_date').values_list(
+        'surrogate', 'start_date', 'end_date', 'status', 'updated', 'user_id', 'user__profile__name',
+        'therapist__user__profile__name')
+
+
+def escape_text(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def format_datetime(value):
+    return timezone.localtime(value, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def content_line(name, value):
+    """
+    A CRLF terminated line, folded so no line is longer than 75 octets.
+    """
+    line = f'{name}:{value}'.encode('utf-8')
+    folded = []
+    while len(line) > 75:
+        cut = 75 if not folded else 74
+        # never split a multibyte character
+        while cut and (line[cut] & 0xC0) == 0x80:
+            cut -= 1
+        folded.append(line[:cut])
+        line = line[cut:]
+    folded.append(line)
+    return b'\r\n '.join(folded) + b'\r\n'
+
+
+def render_calendar(sessions, user_id, domain):
+    """
+    Yields the calendar of the user, sessions are (surrogate, start_date, end_date, status, updated,
+    user_id, client name, therapist name) rows.
+    """
+    yield content_line('BEGIN', 'VCALENDAR')
+    yield content_line('VERSION', '2.0')
+    yield content_line('PRODID', f'-//{domain}//Therapy sessions//EN')
+    yield content_line('CALSCALE', 'GREGORIAN')
+    yield content_line('X-WR-CALNAME', 'Therapy sessions')
+    for surrogate, start, end, status, updated, client_id, client_name, therapist_name in sessions:
+        if start is None:
+            continue
+        # the therapist sees who booked, the client who they are seeing
+        other = therapist_name if client_id == user_id else client_name
+        yield content_line('BEGIN', 'VEVENT')
+        yield content_line('UID', f'{surrogate}@{domain}')
+        yield content_line('DTSTAMP', format_datetime(updated))
+        yield content_line('LAST-MODIFIED', format_datetime(updated))
+        yield content_line('DTSTART', format_datetime(start))
+        yield content_line('DTEND', format_datetime(end))
+        yield content_line('SUMMARY', escape_text(f'Therapy session with {other}' if other else 'Therapy session'))
+        yield content_line('STATUS', EVENT_STATUS.get(status, 'TENTATIVE'))
+        yield content_line('END', 'VEVENT')
+    yield content_line('END', 'VCALENDAR')
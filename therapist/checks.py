@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    The versions of the cached directory (therapist.cache) are bumped by every web worker and by the
+    payments and images workers, a per-process cache would keep serving what the others invalidated.
+    """
+    if settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error('The default cache is local to each process.',
+                  hint='Set CACHE_URL to a cache shared by all processes, e.g. redis://.',
+                  id='therapist.E001')]
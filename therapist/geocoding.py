@@ -0,0 +1,84 @@
+"""
+Geocoding of therapist addresses and nearest-therapist queries.
+
+settings.GEOCODER is the dotted path of a class with a geocode(address) method returning
+(latitude, longitude) or None.
+"""
+import csv
+import math
+from functools import lru_cache
+from django.conf import settings
+from django.db.models import F, Q
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+from django.utils.module_loading import import_string
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def normalize_address(address):
+    return ' '.join((address or '').lower().split())
+
+
+class NullGeocoder:
+    def geocode(self, address):
+        return None
+
+
+class FileGeocoder:
+    """
+    Looks addresses up in a local CSV of address,latitude,longitude rows (settings.GEOCODER_FILE),
+    matching is case and whitespace insensitive.
+    """
+
+    def __init__(self, path=None):
+        self.locations = {}
+        with open(path or settings.GEOCODER_FILE, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                self.locations[normalize_address(row['address'])] = (float(row['latitude']),
+                                                                      float(row['longitude']))
+
+    def geocode(self, address):
+        return self.locations.get(normalize_address(address))
+
+
+@lru_cache(maxsize=None)
+def get_geocoder():
+    return import_string(settings.GEOCODER)()
+
+
+def locate(therapist):
+    """
+    Sets the therapist's coordinates from their address, without saving.
+    """
+    location = get_geocoder().geocode(therapist.address) if therapist.address else None
+    therapist.latitude, therapist.longitude = location or (None, None)
+
+
+def nearby(queryset, latitude, longitude, radius_km):
+    """
+    Therapists within radius_km of the point, annotated with their `distance` in km.
+
+    A bounding box on (latitude, longitude) narrows the rows down through the index,
+    the exact haversine distance is only computed for those. A box crossing the antimeridian
+    is split in two, and one around a pole spans every longitude.
+    """
+    delta_latitude = math.degrees(radius_km / EARTH_RADIUS_KM)
+    # meridians converge towards the poles, so a degree of longitude gets shorter
+    delta_longitude = math.degrees(radius_km / (EARTH_RADIUS_KM * max(math.cos(math.radians(latitude)), 0.01)))
+    west, east = longitude - delta_longitude, longitude + delta_longitude
+
+    if abs(latitude) + delta_latitude >= 90 or delta_longitude >= 180:
+        longitudes = Q()
+    elif west < -180:
+        longitudes = Q(longitude__gte=west + 360) | Q(longitude__lte=east)
+    elif east > 180:
+        longitudes = Q(longitude__gte=west) | Q(longitude__lte=east - 360)
+    else:
+        longitudes = Q(longitude__range=(west, east))
+    queryset = queryset.filter(longitudes, latitude__range=(latitude - delta_latitude, latitude + delta_latitude))
+
+    haversine = Power(Sin((Radians(F('latitude')) - math.radians(latitude)) / 2), 2) + \
+        math.cos(math.radians(latitude)) * Cos(Radians(F('latitude'))) * \
+        Power(Sin((Radians(F('longitude')) - math.radians(longitude)) / 2), 2)
+    distance = 2 * EARTH_RADIUS_KM * ASin(Sqrt(haversine))
+    return queryset.annotate(distance=distance).filter(distance__lte=radius_km)
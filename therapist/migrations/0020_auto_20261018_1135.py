@@ -0,0 +1,74 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:35
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def populate_ratings(apps, schema_editor):
+    Review = apps.get_model('reviews', 'Review')
+    Therapist = apps.get_model('therapist', 'Therapist')
+
+    summaries = Review.objects.filter(stars__isnull=False).values('therapist_id').annotate(
+        count=Count('id'),
+        total=Sum('stars'),
+        **{f'rating_{stars}': Count('id', filter=Q(stars=stars)) for stars in range(1, 6)}
+    )
+    for summary in summaries:
+        Therapist.objects.filter(pk=summary['therapist_id']).update(
+            rating_count=summary['count'],
+            rating_sum=summary['total'],
+            rating_average=summary['total'] / summary['count'],
+            **{f'rating_{stars}': summary[f'rating_{stars}'] for stars in range(1, 6)}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0019_auto_20210225_0157'),
+        ('reviews', '0004_review_surrogate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='therapist',
+            name='rating_1',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='rating_2',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='rating_3',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='rating_4',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='rating_5',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='rating_average',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0020_auto_20261018_1135'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='therapist',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='therapysession',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
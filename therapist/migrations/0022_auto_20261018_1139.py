@@ -0,0 +1,32 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:39
+
+import django.contrib.postgres.constraints
+import django.contrib.postgres.fields.ranges
+from django.contrib.postgres.operations import BtreeGistExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0021_auto_20261018_1136'),
+    ]
+
+    operations = [
+        # needed for the "therapist =" part of the exclusion constraint
+        BtreeGistExtension(),
+        migrations.AddField(
+            model_name='therapysession',
+            name='period',
+            field=django.contrib.postgres.fields.ranges.DateTimeRangeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE therapist_therapysession SET period = tstzrange(start_date, end_date) "
+            "WHERE start_date IS NOT NULL",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='therapysession',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(condition=models.Q(_negated=True, status='RJ'), expressions=[('therapist', '='), ('period', '&&')], name='exclude_overlapping_sessions'),
+        ),
+    ]
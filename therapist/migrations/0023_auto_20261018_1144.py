@@ -0,0 +1,30 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0022_auto_20261018_1139'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Specialty',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('slug', models.SlugField(allow_unicode=True, unique=True)),
+            ],
+            options={
+                'ordering': ('name',),
+            },
+        ),
+        migrations.AddField(
+            model_name='therapistspecialties',
+            name='canonical',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='therapist.specialty'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations
+from django.utils.text import slugify
+
+
+def fold_specialties(apps, schema_editor):
+    """
+    Points every free-text specialty at a canonical Specialty, dropping blanks and
+    duplicates of the same therapist.
+    """
+    Specialty = apps.get_model('therapist', 'Specialty')
+    TherapistSpecialties = apps.get_model('therapist', 'TherapistSpecialties')
+
+    specialties = {}
+    seen = set()
+    for row in TherapistSpecialties.objects.order_by('id'):
+        name = row.specialty.strip()
+        slug = slugify(name, allow_unicode=True)[:50]
+        if not slug or (row.therapist_id, slug) in seen:
+            row.delete()
+            continue
+        seen.add((row.therapist_id, slug))
+
+        if slug not in specialties:
+            specialties[slug], _ = Specialty.objects.get_or_create(slug=slug, defaults={'name': name})
+        row.canonical = specialties[slug]
+        row.save(update_fields=['canonical'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0023_auto_20261018_1144'),
+    ]
+
+    operations = [
+        migrations.RunPython(fold_specialties, migrations.RunPython.noop),
+    ]
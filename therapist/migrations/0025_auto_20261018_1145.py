@@ -0,0 +1,50 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0024_fold_specialties'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='therapistspecialties',
+            name='specialty',
+        ),
+        migrations.RenameField(
+            model_name='therapistspecialties',
+            old_name='canonical',
+            new_name='specialty',
+        ),
+        migrations.AlterField(
+            model_name='therapistspecialties',
+            name='specialty',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='therapist_specialties', to='therapist.specialty'),
+        ),
+        migrations.AlterField(
+            model_name='therapistspecialties',
+            name='therapist',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='therapist_specialties', to='therapist.therapist'),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='specialties',
+            field=models.ManyToManyField(related_name='therapists', through='therapist.TherapistSpecialties', to='therapist.Specialty'),
+        ),
+        migrations.AlterModelOptions(
+            name='specialty',
+            options={'ordering': ('name',), 'verbose_name_plural': 'specialties'},
+        ),
+        migrations.AddConstraint(
+            model_name='therapistspecialties',
+            constraint=models.UniqueConstraint(fields=('therapist', 'specialty'), name='unique_therapist_specialty'),
+        ),
+        migrations.AddIndex(
+            model_name='therapistspecialties',
+            index=models.Index(fields=['specialty', 'therapist'], name='specialty_therapist_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:46
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0025_auto_20261018_1145'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='therapist',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE therapist_therapist t SET search_vector =
+                setweight(to_tsvector('greek', coalesce(d.name, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(d.name, '')), 'A') ||
+                setweight(to_tsvector('greek', coalesce(d.specialties, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(d.specialties, '')), 'A') ||
+                setweight(to_tsvector('greek', coalesce(t.bio, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(t.bio, '')), 'B') ||
+                setweight(to_tsvector('greek', coalesce(t.address, '')), 'C') ||
+                setweight(to_tsvector('english', coalesce(t.address, '')), 'C')
+            FROM (
+                SELECT therapist.id,
+                       (SELECT p.name FROM accounts_userprofile p WHERE p.user_id = therapist.user_id) AS name,
+                       (SELECT string_agg(s.name, ' ') FROM therapist_therapistspecialties ts
+                        JOIN therapist_specialty s ON s.id = ts.specialty_id
+                        WHERE ts.therapist_id = therapist.id) AS specialties
+                FROM therapist_therapist therapist
+            ) d
+            WHERE d.id = t.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='therapist',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='therapist_search_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0026_auto_20261018_1146'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='therapist',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='therapist',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='therapist',
+            index=models.Index(fields=['latitude', 'longitude'], name='therapist_location_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('therapist', '0027_auto_20261018_1147'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='therapysession',
+            index=models.Index(fields=['user', '-created'], name='session_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='therapysession',
+            index=models.Index(fields=['therapist', '-created'], name='session_therapist_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='therapysession',
+            index=models.Index(condition=models.Q(_negated=True, status='RJ'), fields=['therapist', 'start_date'], name='session_active_start_idx'),
+        ),
+        # the composite indexes above replace the single column foreign key ones
+        migrations.AlterField(
+            model_name='therapysession',
+            name='therapist',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sessions', to='therapist.therapist'),
+        ),
+        migrations.AlterField(
+            model_name='therapysession',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sessions', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0028_auto_20261018_1150'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='therapysession',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunSQL(
+            'UPDATE therapist_therapysession SET updated = created',
+            migrations.RunSQL.noop,
+        ),
+    ]
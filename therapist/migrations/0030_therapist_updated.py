@@ -0,0 +1,22 @@
+# Generated by Django 3.1.4 on 2026-10-18 11:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0029_therapysession_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='therapist',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunSQL(
+            'UPDATE therapist_therapist SET updated = created',
+            migrations.RunSQL.noop,
+        ),
+    ]
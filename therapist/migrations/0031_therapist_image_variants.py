@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 12:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('therapist', '0030_therapist_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='therapist',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -1,7 +1,13 @@
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import DateTimeRangeField, RangeOperators
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils.text import slugify
 from djmoney.models.fields import MoneyField
+from psycopg2.extras import DateTimeTZRange
 from accounts.models import User
 import uuid
 from datetime import timedelta, datetime
@@ -24,33 +30,101 @@ class Therapist(models.Model):
     )
 
     surrogate = models.UUIDField(default=uuid.uuid4, db_index=True)
-    created = models.DateTimeField(auto_now_add=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # also moved by changes to what the therapist is serialized with, see therapist.cache
+    updated = models.DateTimeField(auto_now=True)
     user = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True, related_name="therapist")
     bio = models.TextField(null=True, blank=True, max_length=300)
     phone_number = models.CharField(max_length=30, blank=True, null=True)
     office_number = models.CharField(max_length=30, blank=True, null=True)
     address = models.CharField(max_length=160, blank=True, null=True)
+    # geocoded from address, see therapist.geocoding
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
     afm = models.CharField(max_length=60, blank=True, null=True)
     doy = models.CharField(max_length=300, blank=True, null=True)
     iban = models.CharField(max_length=40, blank=True, null=True)
     license = models.ImageField(upload_to='licenses/', null=True, blank=True)
     id_back = models.ImageField(upload_to='id/', null=True, blank=True)
     id_front = models.ImageField(upload_to='id/', null=True, blank=True)
+    # re-encoded documents and their previews, maintained by images.queue
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     credit = MoneyField(max_digits=6, decimal_places=2, default_currency='EUR', default=0.0)
+    specialties = models.ManyToManyField('Specialty', through='TherapistSpecialties', related_name='therapists')
+    # maintained by therapist.search
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+    # rating summary, maintained by reviews.models.Review and the rebuild_ratings command
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    rating_average = models.FloatField(null=True, blank=True)
+    rating_1 = models.IntegerField(default=0)
+    rating_2 = models.IntegerField(default=0)
+    rating_3 = models.IntegerField(default=0)
+    rating_4 = models.IntegerField(default=0)
+    rating_5 = models.IntegerField(default=0)
 
     def __str__(self):
         return str(self.user.email)
 
+    @property
+    def rating_histogram(self):
+        return {stars: getattr(self, f'rating_{stars}') for stars in range(1, 6)}
+
     class Meta:
         ordering = ('created',)
+        indexes = [
+            GinIndex(fields=['search_vector'], name='therapist_search_idx'),
+            # bounding box prefilter of ?near= searches
+            models.Index(fields=['latitude', 'longitude'], name='therapist_location_idx'),
+        ]
+
+
+class Specialty(models.Model):
+    name = models.CharField(max_length=50)
+    # the canonical form, "CBT", " cbt" and "Cbt" are all "cbt"
+    slug = models.SlugField(max_length=50, unique=True, allow_unicode=True)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def get_or_create_many(cls, names):
+        """
+        Canonical specialties for free-text names in two queries, names are trimmed
+        and deduplicated by slug and blank ones are dropped.
+        """
+        by_slug = {}
+        for name in names:
+            name = name.strip()[:50]
+            slug = slugify(name, allow_unicode=True)[:50]
+            if slug and slug not in by_slug:
+                by_slug[slug] = name
+
+        cls.objects.bulk_create([cls(name=name, slug=slug) for slug, name in by_slug.items()],
+                                ignore_conflicts=True)
+        return list(cls.objects.filter(slug__in=by_slug))
+
+    class Meta:
+        ordering = ('name',)
+        verbose_name_plural = 'specialties'
 
 
 class TherapistSpecialties(models.Model):
-    therapist = models.ForeignKey(Therapist, on_delete=models.CASCADE, related_name="specialties")
-    specialty = models.CharField(max_length=50)
+    therapist = models.ForeignKey(Therapist, on_delete=models.CASCADE, related_name="therapist_specialties")
+    specialty = models.ForeignKey(Specialty, on_delete=models.CASCADE, related_name="therapist_specialties")
 
     def __str__(self):
-        return self.specialty
+        return str(self.specialty)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['therapist', 'specialty'], name='unique_therapist_specialty'),
+        ]
+        indexes = [
+            # specialty first, for ?specialty= filtering on the directory
+            models.Index(fields=['specialty', 'therapist'], name='specialty_therapist_idx'),
+        ]
 
 
 class TherapySession(models.Model):
@@ -67,21 +141,50 @@ class TherapySession(models.Model):
     ]
 
     surrogate = models.UUIDField(default=uuid.uuid4, db_index=True)
-    created = models.DateTimeField(auto_now_add=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # queryset.update() calls have to set it themselves
+    updated = models.DateTimeField(auto_now=True)
     status = models.CharField(
         max_length=2,
         choices=STATUS_CHOICES,
         default=PENDING
     )
-    therapist = models.ForeignKey(Therapist, on_delete=models.CASCADE, null=False, blank=False, related_name="sessions")
-    user = models.ForeignKey(User, on_delete=models.CASCADE, null=False, blank=False, related_name="sessions")
+    # indexed by the composite indexes in Meta, which both lead with these
+    therapist = models.ForeignKey(Therapist, on_delete=models.CASCADE, null=False, blank=False, related_name="sessions",
+                                  db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=False, blank=False, related_name="sessions",
+                             db_index=False)
     start_date = models.DateTimeField(null=True, blank=True)
     end_date = models.DateTimeField(null=True, blank=True)
+    # [start_date, end_date) as a tstzrange, backs the overlap exclusion constraint
+    period = DateTimeRangeField(null=True, blank=True, editable=False)
 
     def save(self, *args, **kwargs):
         self.end_date = self.start_date + timedelta(hours=1)
+        self.period = DateTimeTZRange(self.start_date, self.end_date)
         super(TherapySession, self).save(*args, **kwargs)
 
+    class Meta:
+        constraints = [
+            # a therapist can't have two sessions at the same time, unless one of them was rejected
+            ExclusionConstraint(
+                name='exclude_overlapping_sessions',
+                expressions=[
+                    ('therapist', RangeOperators.EQUAL),
+                    ('period', RangeOperators.OVERLAPS),
+                ],
+                condition=~models.Q(status='RJ'),
+            ),
+        ]
+        indexes = [
+            # my_sessions, newest first
+            models.Index(fields=['user', '-created'], name='session_user_created_idx'),
+            models.Index(fields=['therapist', '-created'], name='session_therapist_created_idx'),
+            # the busy intervals of the slot endpoints only look at sessions that weren't rejected
+            models.Index(fields=['therapist', 'start_date'], name='session_active_start_idx',
+                         condition=~models.Q(status='RJ')),
+        ]
+
     def __str__(self):
         return self.therapist.user.email + ' - ' + str(self.start_date)
 
@@ -0,0 +1,98 @@
+"""
+Full-text search over the therapist directory.
+
+Therapist.search_vector holds the profile name, specialties, bio and address, each in the
+Greek and English configurations. It is recomputed for the affected therapists only, in the
+transaction that changed one of those fields, so it commits along with them: the directory
+version bumped once they commit (therapist.cache) never caches a ?q= page of the old vectors.
+"""
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db.models import F, FloatField, OuterRef, Subquery
+from django.db.models.functions import Cast
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+from .models import Therapist, TherapistSpecialties
+
+SEARCH_CONFIGS = ('greek', 'english')
+
+
+def search_document():
+    specialties = Subquery(
+        TherapistSpecialties.objects.filter(therapist=OuterRef('pk')).values('therapist')
+        .annotate(names=StringAgg('specialty__name', ' ')).values('names')
+    )
+    weighted = [
+        ('user__profile__name', 'A'),
+        (specialties, 'A'),
+        ('bio', 'B'),
+        ('address', 'C'),
+    ]
+
+    document = None
+    for field, weight in weighted:
+        for config in SEARCH_CONFIGS:
+            vector = SearchVector(field, config=config, weight=weight)
+            document = vector if document is None else document + vector
+    return document
+
+
+def search_query(text):
+    query = None
+    for config in SEARCH_CONFIGS:
+        config_query = SearchQuery(text, config=config, search_type='websearch')
+        query = config_query if query is None else query | config_query
+    return query
+
+
+def search(queryset, text):
+    """
+    Therapists matching text, annotated with their `rank`. Uses the GIN index on search_vector.
+    """
+    query = search_query(text)
+    # ts_rank returns a real, as a double the value round-trips exactly through a pagination cursor
+    return queryset.filter(search_vector=query).annotate(rank=Cast(SearchRank(F('search_vector'), query),
+                                                                   FloatField()))
+
+
+def update_search_vectors(*args, **kwargs):
+    """
+    Recomputes the search vector of the therapists matching the filter(*args, **kwargs) lookup
+    in a single UPDATE.
+    """
+    document = Therapist.objects.filter(pk=OuterRef('pk')).annotate(document=search_document())\
+        .values('document')[:1]
+    Therapist.objects.filter(*args, **kwargs).update(search_vector=Subquery(document))
+
+
+@receiver(post_save, sender=Therapist)
+def therapist_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'bio', 'address'} & set(update_fields):
+        update_search_vectors(pk=instance.pk)
+
+
+@receiver(post_save, sender='accounts.UserProfile')
+def user_profile_saved(sender, instance, update_fields=None, **kwargs):
+    if instance.is_therapist and (update_fields is None or 'name' in update_fields):
+        update_search_vectors(user_id=instance.user_id)
+
+
+@receiver(post_save, sender=TherapistSpecialties)
+@receiver(post_delete, sender=TherapistSpecialties)
+def therapist_specialty_changed(sender, instance, **kwargs):
+    update_search_vectors(pk=instance.therapist_id)
+
+
+@receiver(m2m_changed, sender=Therapist.specialties.through)
+def therapist_specialties_changed(sender, instance, action, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if isinstance(instance, Therapist):
+        update_search_vectors(pk=instance.pk)
+    else:
+        update_search_vectors(pk__in=kwargs.get('pk_set') or [])
+
+
+@receiver(post_save, sender='therapist.Specialty')
+def specialty_saved(sender, instance, **kwargs):
+    update_search_vectors(specialties=instance)
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+from django.utils import timezone
+
+# same fixed length TherapySession.save gives every session
+SLOT_LENGTH = timedelta(hours=1)
+
+
+def expand_time_ranges(time_ranges, start, end):
+    """
+    Expands weekly AvailableTimeRange rows into the sorted one hour slots between start and end.
+    Range times are in the current time zone.
+    """
+    tz = timezone.get_current_timezone()
+    by_weekday = {}
+    for time_range in time_ranges:
+        by_weekday.setdefault(time_range.weekday, []).append(time_range)
+    for ranges in by_weekday.values():
+        ranges.sort(key=lambda time_range: time_range.start_time)
+
+    slots = []
+    day = timezone.localtime(start, tz).date()
+    last_day = timezone.localtime(end, tz).date()
+    while day <= last_day:
+        for time_range in by_weekday.get(day.isoweekday(), []):
+            slot_start = timezone.make_aware(datetime.combine(day, time_range.start_time), tz)
+            range_end = timezone.make_aware(datetime.combine(day, time_range.end_time), tz)
+            while slot_start + SLOT_LENGTH <= range_end:
+                if slot_start >= start and slot_start + SLOT_LENGTH <= end:
+                    slots.append((slot_start, slot_start + SLOT_LENGTH))
+                slot_start += SLOT_LENGTH
+        day += timedelta(days=1)
+
+    # ranges of the same day may overlap each other
+    return sorted(set(slots))
+
+
+def subtract_busy_intervals(slots, busy):
+    """
+    Removes the slots that overlap any of the busy (start, end) intervals.
+    Both lists must be sorted by start, so this is a single sweep over the two.
+    """
+    free = []
+    i = 0
+    for slot_start, slot_end in slots:
+        # intervals that end before this slot can't overlap any later slot either
+        while i < len(busy) and busy[i][1] <= slot_start:
+            i += 1
+        # busy[i] ends after the slot starts and every later interval starts after busy[i] does
+        if i < len(busy) and busy[i][0] < slot_end:
+            continue
+        free.append((slot_start, slot_end))
+    return free
+
+
+def compute_free_slots(time_ranges, busy, start, end):
+    return subtract_busy_intervals(expand_time_ranges(time_ranges, start, end), busy)
@@ -1,3 +1,212 @@
-from django.test import TestCase
+import json
+from datetime import time, timedelta
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from psycopg2.extras import DateTimeTZRange
+from rest_framework.test import APIClient
+from accounts.models import User, UserProfile
+from reviews.models import Review
+from therapist.availability import find_conflicts
+from therapist.checks import check_shared_cache
+from therapist.search import search
+from therapist.models import (AvailableTimeRange, Specialty, Therapist, TherapistSpecialties,
+                              TherapySession)
 
-# Create your tests here.
+# the tables that grow with the number of users
+WATCHED_TABLES = {
+    User._meta.db_table, UserProfile._meta.db_table, Therapist._meta.db_table, TherapySession._meta.db_table,
+    Review._meta.db_table, AvailableTimeRange._meta.db_table, TherapistSpecialties._meta.db_table,
+}
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def full_scans(plan):
+    """
+    The watched tables a JSON EXPLAIN plan reads whole, with a sequential scan or by walking
+    an index without a condition and filtering every row.
+    """
+    return [node['Relation Name'] for node in plan_nodes(plan)
+            if node.get('Relation Name') in WATCHED_TABLES and (
+                node['Node Type'] == 'Seq Scan' or
+                node['Node Type'] in ('Index Scan', 'Index Only Scan') and 'Index Cond' not in node
+                and 'Filter' in node)]
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class QueryPlanTests(TestCase):
+    """
+    The queries of the hot endpoints are served by indexes. Whether a sequential scan is cheaper
+    depends on the size of the tables, with them disabled the planner only falls back to one when
+    no index can serve the query, so the seeded data needn't be production sized.
+    """
+    THERAPISTS = 200
+    CLIENTS = 500
+    SESSIONS_PER_THERAPIST = 10
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        specialties = Specialty.get_or_create_many([f'specialty {i}' for i in range(20)])
+
+        users = User.objects.bulk_create([User(email=f'user{i}@example.com')
+                                          for i in range(cls.THERAPISTS + cls.CLIENTS)])
+        therapist_users, clients = users[:cls.THERAPISTS], users[cls.THERAPISTS:]
+        # most therapists are listed, like in production
+        UserProfile.objects.bulk_create([UserProfile(user=user, is_therapist=i < cls.THERAPISTS,
+                                                     charges_enabled=i < cls.THERAPISTS and i % 5 != 0)
+                                         for i, user in enumerate(users)])
+        therapists = Therapist.objects.bulk_create([
+            Therapist(user=user, bio='', latitude=37.9 + (i % 100) / 100, longitude=23.7 + (i // 100) / 100)
+            for i, user in enumerate(therapist_users)
+        ])
+        TherapistSpecialties.objects.bulk_create([
+            TherapistSpecialties(therapist=therapist, specialty=specialties[(i + k) % len(specialties)])
+            for i, therapist in enumerate(therapists) for k in range(3)
+        ])
+        AvailableTimeRange.objects.bulk_create([
+            AvailableTimeRange(therapist=therapist, weekday=weekday, start_time='09:00', end_time='17:00')
+            for therapist in therapists for weekday in range(1, 6)
+        ])
+
+        sessions = []
+        statuses = [TherapySession.PENDING, TherapySession.APPROVED, TherapySession.PAYMENT_COMPLETED,
+                    TherapySession.REJECTED]
+        for i, therapist in enumerate(therapists):
+            for k in range(cls.SESSIONS_PER_THERAPIST):
+                start = (now + timedelta(hours=2 * k - cls.SESSIONS_PER_THERAPIST)).replace(
+                    minute=0, second=0, microsecond=0)
+                sessions.append(TherapySession(
+                    therapist=therapist, user=clients[(i * cls.SESSIONS_PER_THERAPIST + k) % len(clients)],
+                    start_date=start, end_date=start + timedelta(hours=1),
+                    period=DateTimeTZRange(start, start + timedelta(hours=1)), status=statuses[k % len(statuses)]))
+        TherapySession.objects.bulk_create(sessions)
+        Review.objects.bulk_create([
+            Review(user=clients[(i * 5 + k) % len(clients)], therapist=therapist, stars=k + 1)
+            for i, therapist in enumerate(therapists) for k in range(5)
+        ])
+
+        cls.listed = [therapist for i, therapist in enumerate(therapists) if i % 5 != 0]
+        cls.client_user = clients[0]
+        cls.specialty = specialties[0]
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            # until the test's transaction is rolled back
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertIndexed(self, url, user=None, indexes=()):
+        """
+        No query of GET url reads a watched table whole, and together they use indexes.
+        """
+        client = APIClient()
+        client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        used = set()
+        with connection.cursor() as cursor:
+            for query in queries.captured_queries:
+                sql = query['sql']
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+                plan = cursor.fetchone()[0]
+                plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+                self.assertEqual(full_scans(plan), [], f'full scan in {sql}\n{json.dumps(plan, indent=2)}')
+                used.update(node['Index Name'] for node in plan_nodes(plan) if 'Index Name' in node)
+        for index in indexes:
+            self.assertIn(index, used)
+
+    def test_directory(self):
+        self.assertIndexed('/api/v1/therapists/')
+        self.assertIndexed('/api/v1/therapists/', self.client_user)
+        self.assertIndexed('/api/v1/therapists/?expand=sessions')
+        self.assertIndexed(f'/api/v1/therapists/?specialty={self.specialty.slug}')
+        self.assertIndexed('/api/v1/therapists/?near=38.0,23.8&radius=5')
+
+    def test_therapist(self):
+        self.assertIndexed(f'/api/v1/therapists/{self.listed[0].surrogate}/')
+
+    def test_slots(self):
+        batch = ','.join(str(therapist.surrogate) for therapist in self.listed[:20])
+        self.assertIndexed(f'/api/v1/therapists/slots/?therapists={batch}', indexes=['session_active_start_idx'])
+
+    def test_my_sessions(self):
+        therapist_user = self.listed[0].user
+        self.assertIndexed('/api/v1/my_sessions/', self.client_user, indexes=['session_user_created_idx'])
+        self.assertIndexed('/api/v1/my_sessions/', therapist_user,
+                           indexes=['session_user_created_idx', 'session_therapist_created_idx'])
+        self.assertIndexed('/api/v1/my_sessions/?when=upcoming', self.client_user)
+        self.assertIndexed('/api/v1/my_sessions/?when=past&status=PC', therapist_user)
+
+
+class FindConflictsTests(SimpleTestCase):
+    def test_touching_ranges(self):
+        self.assertEqual(find_conflicts([(1, time(10), time(11)), (1, time(9), time(10)), (2, time(9), time(17))]), [])
+
+    def test_overlaps(self):
+        self.assertEqual(find_conflicts([(1, time(9), time(17)), (1, time(10), time(11)), (1, time(12), time(13))]), [
+            '10:00:00-11:00:00 overlaps 09:00:00-17:00:00 on weekday 1.',
+            '12:00:00-13:00:00 overlaps 09:00:00-17:00:00 on weekday 1.',
+        ])
+
+    def test_other_weekday(self):
+        self.assertEqual(find_conflicts([(1, time(9), time(17)), (2, time(10), time(11))]), [])
+
+    def test_inverted_and_empty(self):
+        self.assertEqual(find_conflicts([(3, time(12), time(10)), (3, time(9), time(9))]), [
+            '09:00:00-09:00:00 on weekday 3 ends before it starts.',
+            '12:00:00-10:00:00 on weekday 3 ends before it starts.',
+        ])
+
+
+class SharedCacheCheckTests(SimpleTestCase):
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_process_local_cache(self):
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['therapist.E001'])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django_redis.cache.RedisCache',
+                                           'LOCATION': 'redis://127.0.0.1:6379/0'}})
+    def test_shared_cache(self):
+        self.assertEqual(check_shared_cache(None), [])
+
+
+class SearchTests(TestCase):
+    """
+    The vectors are written in the transaction that changed what they index, which TestCase never commits.
+    """
+    def setUp(self):
+        user = User.objects.create(email='therapist@example.com')
+        self.profile = UserProfile.objects.create(user=user, name='Maria Papadopoulou', is_therapist=True)
+        self.therapist = Therapist.objects.create(user=user, bio='Cognitive behavioural therapy')
+
+    def found(self, text):
+        return list(search(Therapist.objects.all(), text)) == [self.therapist]
+
+    def test_bio(self):
+        self.assertTrue(self.found('cognitive'))
+        self.therapist.bio = 'Family therapy'
+        self.therapist.save(update_fields=['bio'])
+        self.assertTrue(self.found('family'))
+        self.assertFalse(self.found('cognitive'))
+
+    def test_name(self):
+        self.assertTrue(self.found('maria'))
+        self.profile.name = 'Eleni'
+        self.profile.save()
+        self.assertTrue(self.found('eleni'))
+
+    def test_specialties(self):
+        self.therapist.specialties.set(Specialty.get_or_create_many(['Anxiety']))
+        self.assertTrue(self.found('anxiety'))
+        self.therapist.specialties.clear()
+        self.assertFalse(self.found('anxiety'))
@@ -0,0 +1,42 @@
+"""
+The PostgreSQL backend, with connections taken from a per-process pool (therapy.db.pool) instead of
+opened for every request. Django still "closes" its connection at the end of each request, which
+hands it back to the pool, so CONN_MAX_AGE stays 0 and threads share the pool's connections.
+
+Configured by the POOL entry of the database settings: MIN_SIZE, MAX_SIZE, TIMEOUT, CHECK_AFTER and
+MAX_IDLE, see DATABASE_POOL in therapy.settings.
+"""
+from django.db.backends.postgresql import base, creation
+from .pool import close_pools, get_pool
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def destroy_test_db(self, *args, **kwargs):
+        # the pool would keep the test database's connections open, DROP DATABASE refuses to run then
+        self.connection.close()
+        close_pools(self.connection.alias, self.connection.settings_dict['NAME'])
+        super(DatabaseCreation, self).destroy_test_db(*args, **kwargs)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.get_connection_params(), self.settings_dict['POOL'])
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.acquire(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # set by the stock backend when it connects
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        with self.wrap_database_errors:
+            if self.in_atomic_block:
+                # the wrapper keeps the connection until the atomic block exits, it can't be shared meanwhile
+                self.pool.discard(self.connection)
+            else:
+                self.pool.release(self.connection)
@@ -0,0 +1,203 @@
+"""
+A thread-safe pool of PostgreSQL connections, one per process and database, see therapy.db.base.
+
+Connections are handed out most recently used first, so under light load the same few stay warm
+and the rest age out. A connection that sat idle for CHECK_AFTER seconds runs a SELECT 1 before it
+is handed out, so one the server or a proxy dropped is replaced instead of failing the request.
+"""
+import logging
+import os
+import threading
+import time
+from psycopg2 import Error, OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, min_size, max_size, timeout, check_after, max_idle):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+        self._condition = threading.Condition()
+        # (connection, released at), the most recently released last
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            'acquired': 0, 'opened': 0, 'closed': 0, 'failed_checks': 0, 'timeouts': 0,
+            'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'peak_in_use': 0,
+        }
+
+    def acquire(self, connect):
+        """
+        An idle connection, or a new one made by connect() while the pool is below max_size. Waits
+        up to timeout seconds for one to be released otherwise.
+        """
+        start = time.monotonic()
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = start + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        logger.warning('Timed out waiting for a database connection, raise DATABASE_POOL_MAX_SIZE?')
+                        raise PoolTimeout(f'No database connection was free within {self.timeout}s '
+                                          f'({self.max_size} in use).')
+                    self._condition.wait(remaining)
+                connection, released_at = self._idle.pop() if self._idle else (None, None)
+                if connection is None:
+                    # reserves the slot while connecting outside the lock
+                    self._size += 1
+
+            opened = connection is None
+            if opened:
+                try:
+                    connection = connect()
+                except Exception:
+                    self._forget()
+                    raise
+            elif not self._is_usable(connection, released_at):
+                logger.info('Replacing a database connection that failed its health check')
+                with self._condition:
+                    self._stats['failed_checks'] += 1
+                self._discard(connection)
+                continue
+
+            wait = time.monotonic() - start
+            with self._condition:
+                self._stats['acquired'] += 1
+                self._stats['opened'] += opened
+                self._stats['wait_seconds'] += wait
+                self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], wait)
+                self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._size - len(self._idle))
+            return connection
+
+    def release(self, connection):
+        if self._closed or not self._reset(connection):
+            self._discard(connection)
+            return
+        now = time.monotonic()
+        with self._condition:
+            self._idle.append((connection, now))
+            # the least recently used connections above min_size that idled for too long
+            expired = []
+            while self._size - len(expired) > self.min_size and now - self._idle[0][1] > self.max_idle:
+                expired.append(self._idle.pop(0)[0])
+            self._size -= len(expired)
+            self._condition.notify()
+        for connection in expired:
+            self._close(connection)
+
+    def discard(self, connection):
+        self._discard(connection)
+
+    def close(self):
+        """
+        Closes the idle connections, the ones in use are closed as they are released.
+        """
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._closed = True
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        with self._condition:
+            in_use = self._size - len(self._idle)
+            return {
+                **self._stats,
+                'size': self._size, 'idle': len(self._idle), 'in_use': in_use,
+                'min_size': self.min_size, 'max_size': self.max_size,
+                'utilization': in_use / self.max_size,
+            }
+
+    def _is_usable(self, connection, released_at):
+        if connection.closed:
+            return False
+        if time.monotonic() - released_at < self.check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except Error:
+            return False
+
+    def _reset(self, connection):
+        """
+        Brings a released connection back to a clean, idle state, False when it can't be reused.
+        """
+        if connection.closed:
+            return False
+        status = connection.get_transaction_status()
+        if status == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except Error:
+                return False
+        return True
+
+    def _discard(self, connection):
+        self._forget()
+        self._close(connection)
+
+    def _forget(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _close(self, connection):
+        with self._condition:
+            self._stats['closed'] += 1
+        try:
+            connection.close()
+        except Error:
+            pass
+
+
+# {(pid, alias, connection parameters): ConnectionPool}, a forked process starts over with its own
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, conn_params, options):
+    key = (os.getpid(), alias, tuple(sorted(conn_params.items())))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(options['MIN_SIZE'], options['MAX_SIZE'], options['TIMEOUT'],
+                                         options['CHECK_AFTER'], options['MAX_IDLE'])
+        return _pools[key]
+
+
+def close_pools(alias, database):
+    """
+    Closes this process' pools of connections to database, e.g. before it is dropped.
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        keys = [key for key in _pools if key[:2] == (pid, alias) and dict(key[2]).get('database') == database]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
+
+
+def pool_stats():
+    """
+    {"alias:database": stats} of the pools of this process.
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        pools = [(f"{alias}:{dict(params)['database']}", pool)
+                 for (owner, alias, params), pool in _pools.items() if owner == pid]
+    return {name: pool.stats() for name, pool in pools}
@@ -0,0 +1,17 @@
+"""
+gunicorn settings of the ASGI deployment, in which the Stripe views are async (see api.v1.async_views):
+
+    gunicorn -c therapy/gunicorn_asgi.py therapy.asgi:application
+
+Django 3.1 runs the sync views of an ASGI process one at a time on a single thread, so the rest of
+the API gets no more concurrency than one sync worker per process. Either keep WEB_CONCURRENCY at
+what the sync deployment uses, or route only the Stripe endpoints to these processes.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'uvicorn.workers.UvicornWorker'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# lets a restarting worker finish the requests it's waiting on Stripe for
+graceful_timeout = int(os.environ.get('STRIPE_READ_TIMEOUT', 20)) + 10
+raw_env = ['ASYNC_STRIPE_VIEWS=True']
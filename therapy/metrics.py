@@ -0,0 +1,271 @@
+"""
+Latency, SQL queries and response size of every request, per view and action, exported in the
+Prometheus text format by api.v1.views.metrics along with the Stripe client's latency and the
+database pool's stats.
+
+metrics_middleware times the request and a wrapper on every database connection (see
+connection.execute_wrapper) counts and times its queries. The wrapper finds the request's recorder
+through a context variable, which sync_to_async carries to the thread an async view queries from. A
+request repeating the same query, parameters aside, more than N_PLUS_ONE_THRESHOLD times is logged
+as a likely N+1.
+
+Like the connection pool, metrics are kept per process, each scrape answers for the worker serving it.
+"""
+import asyncio
+import contextvars
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.decorators import sync_and_async_middleware
+from payments import stripe_client
+from therapy.db.pool import pool_stats
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float('inf'))
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, float('inf'))
+# "IN (%s, %s, %s)" and the like, whose length follows the parameters
+PLACEHOLDER_LIST_RE = re.compile(r'%s(?:, %s)+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+class Histogram:
+    """
+    Thread-safe cumulative histogram per combination of label values.
+    """
+    def __init__(self, name, documentation, buckets, labels):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.setdefault(label_values, {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['count'] += 1
+            series['sum'] += value
+
+    def collect(self):
+        with self._lock:
+            series = [(label_values, {**stats, 'buckets': list(stats['buckets'])})
+                      for label_values, stats in self._series.items()]
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, stats in sorted(series):
+            labels = dict(zip(self.labels, label_values))
+            lines += histogram_lines(self.name, labels, self.buckets, stats)
+        return lines
+
+
+class LabeledCounter:
+    """
+    Thread-safe counter per combination of label values.
+    """
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = Counter()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def collect(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{format_labels(dict(zip(self.labels, label_values)))} {value}'
+                  for label_values, value in values]
+        return lines
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Time to answer a request.',
+                             DURATION_BUCKETS, ('view',))
+request_queries = Histogram('http_request_queries', 'SQL queries run by a request.', QUERY_COUNT_BUCKETS, ('view',))
+request_query_duration = Histogram('http_request_query_duration_seconds', 'Time a request spent in SQL queries.',
+                                   DURATION_BUCKETS, ('view',))
+response_size = Histogram('http_response_size_bytes', 'Size of a response body, streamed ones excluded '
+                          'unless they set Content-Length.', SIZE_BUCKETS, ('view',))
+responses = LabeledCounter('http_responses_total', 'Responses by status code.', ('view', 'status'))
+n_plus_one = LabeledCounter('http_request_n_plus_one_total', 'Requests that repeated a query more than '
+                            'N_PLUS_ONE_THRESHOLD times.', ('view',))
+METRICS = (request_duration, request_queries, request_query_duration, response_size, responses, n_plus_one)
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.statements[normalize(sql)] += 1
+
+
+current_recorder = contextvars.ContextVar('current_recorder', default=None)
+
+
+def normalize(sql):
+    # the parameters are passed apart, only the lists of placeholders vary
+    return PLACEHOLDER_LIST_RE.sub('%s, ...', WHITESPACE_RE.sub(' ', sql.strip()))
+
+
+def record_query(execute, sql, params, many, context):
+    recorder = current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_recorder(connection):
+    # a connection object is reused by its thread across requests
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    # the threads sync_to_async runs async views' queries in
+    install_query_recorder(connection)
+
+
+def view_name(request):
+    """
+    "TherapistsViewSet.list" for the action of a viewset, the name of the view function otherwise.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view = match.func
+    cls = getattr(view, 'cls', None)
+    actions = getattr(view, 'actions', None)
+    if cls is not None and actions:
+        return f'{cls.__name__}.{actions.get(request.method.lower(), request.method.lower())}'
+    # api_view names its class after the function
+    return getattr(cls, '__name__', None) or getattr(view, '__name__', 'unknown')
+
+
+def observe(request, response, recorder, duration):
+    view = view_name(request)
+    labels = (view,)
+    request_duration.observe(labels, duration)
+    request_queries.observe(labels, recorder.count)
+    request_query_duration.observe(labels, recorder.duration)
+    responses.inc((view, str(response.status_code)))
+    if response.has_header('Content-Length'):
+        response_size.observe(labels, int(response['Content-Length']))
+    elif not response.streaming:
+        response_size.observe(labels, len(response.content))
+
+    repeated = [(sql, count) for sql, count in recorder.statements.most_common()
+                if count > settings.N_PLUS_ONE_THRESHOLD]
+    if repeated:
+        n_plus_one.inc(labels)
+        for sql, count in repeated:
+            logger.warning('Likely N+1 in %s %s (%s): %d runs of %s', request.method, request.path, view, count,
+                           sql[:500])
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            recorder = QueryRecorder()
+            token = current_recorder.set(recorder)
+            start = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                current_recorder.reset(token)
+            observe(request, response, recorder, time.perf_counter() - start)
+            return response
+    else:
+        def middleware(request):
+            # including connections opened before this module was imported
+            for connection in connections.all():
+                install_query_recorder(connection)
+            recorder = QueryRecorder()
+            token = current_recorder.set(recorder)
+            start = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                current_recorder.reset(token)
+            observe(request, response, recorder, time.perf_counter() - start)
+            return response
+    return middleware
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def histogram_lines(name, labels, buckets, stats):
+    lines = [f'{name}_bucket{format_labels({**labels, "le": format_bound(bound)})} {count}'
+             for bound, count in zip(buckets, stats['buckets'])]
+    lines.append(f'{name}_sum{format_labels(labels)} {stats["sum"]}')
+    lines.append(f'{name}_count{format_labels(labels)} {stats["count"]}')
+    return lines
+
+
+def stripe_lines():
+    name = 'stripe_request_duration_seconds'
+    snapshot = sorted(stripe_client.latency.snapshot().items())
+    lines = [f'# HELP {name} Time of a Stripe API call, retries included.', f'# TYPE {name} histogram']
+    for operation, stats in snapshot:
+        lines += histogram_lines(name, {'operation': operation}, stripe_client.LatencyHistogram.BUCKETS, stats)
+    lines += ['# HELP stripe_request_errors_total Stripe API calls that failed.',
+              '# TYPE stripe_request_errors_total counter']
+    lines += [f'stripe_request_errors_total{format_labels({"operation": operation})} {stats["errors"]}'
+              for operation, stats in snapshot]
+    return lines
+
+
+def pool_lines():
+    stats = sorted(pool_stats().items())
+    lines = []
+    for metric, kind, key, documentation in (
+            ('db_pool_connections_in_use', 'gauge', 'in_use', 'Connections handed out.'),
+            ('db_pool_connections_idle', 'gauge', 'idle', 'Connections waiting in the pool.'),
+            ('db_pool_max_size', 'gauge', 'max_size', 'Connections the pool can open.'),
+            ('db_pool_acquired_total', 'counter', 'acquired', 'Connections handed out.'),
+            ('db_pool_timeouts_total', 'counter', 'timeouts', 'Waits for a connection that timed out.'),
+            ('db_pool_wait_seconds_total', 'counter', 'wait_seconds', 'Time spent waiting for a connection.')):
+        lines += [f'# HELP {metric} {documentation}', f'# TYPE {metric} {kind}']
+        lines += [f'{metric}{format_labels({"pool": pool})} {values[key]}' for pool, values in stats]
+    return lines
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.collect()
+    lines += stripe_lines()
+    lines += pool_lines()
+    return '\n'.join(lines) + '\n'
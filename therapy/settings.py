@@ -51,6 +51,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.sites',
+    'django.contrib.postgres',
     'allauth',
     'allauth.account',
     'allauth.socialaccount',
@@ -63,9 +64,13 @@ INSTALLED_APPS = [
     'djmoney',
     'therapist',
     'reviews',
+    'payments',
+    'images',
 ]
 
 MIDDLEWARE = [
+    # first, so it times the whole stack, see therapy.metrics
+    'therapy.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -126,6 +131,42 @@ elif len(sys.argv) > 0 and sys.argv[1] != 'collectstatic':
         "default": dj_database_url.parse(os.environ.get("DATABASE_URL")),
     }
 
+# connections are pooled per process, see therapy.db; DATABASE_POOL_MAX_SIZE=0 opens one per request again
+DATABASE_POOL = {
+    # kept open once opened, however long they idle
+    'MIN_SIZE': int(os.environ.get('DATABASE_POOL_MIN_SIZE', 1)),
+    # per process, so workers x MAX_SIZE must stay under the server's (or pgbouncer's) connection limit
+    'MAX_SIZE': int(os.environ.get('DATABASE_POOL_MAX_SIZE', 4)),
+    # seconds to wait for a free connection before failing the query
+    'TIMEOUT': float(os.environ.get('DATABASE_POOL_TIMEOUT', 10)),
+    # connections idle for longer run a SELECT 1 before they are reused
+    'CHECK_AFTER': float(os.environ.get('DATABASE_POOL_CHECK_AFTER', 30)),
+    # connections above MIN_SIZE idle for longer are closed
+    'MAX_IDLE': float(os.environ.get('DATABASE_POOL_MAX_IDLE', 300)),
+}
+# set when DATABASE_URL points at pgbouncer in transaction mode, where consecutive transactions of a
+# connection can land on different server connections
+DATABASE_PGBOUNCER = os.environ.get('DATABASE_PGBOUNCER', 'False') == 'True'
+if 'DATABASES' in globals():
+    if DATABASE_POOL['MAX_SIZE']:
+        DATABASES['default'].update(ENGINE='therapy.db', POOL=DATABASE_POOL)
+    # server side cursors (QuerySet.iterator()) live in the server session, they'd be lost between transactions
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = DATABASE_PGBOUNCER
+
+
+# e.g. redis://127.0.0.1:6379/0, the local memory cache is per process
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+# deployments need a cache shared by every process, `manage.py check --deploy` fails otherwise (therapist.checks)
+
+# how long serialized therapists and directory pages are kept, they are invalidated on change anyway
+THERAPIST_CACHE_TIMEOUT = int(os.environ.get('THERAPIST_CACHE_TIMEOUT', 60 * 60))
+
+
+# see therapist.geocoding, e.g. GEOCODER=therapist.geocoding.FileGeocoder with GEOCODER_FILE=addresses.csv
+GEOCODER = os.environ.get('GEOCODER', 'therapist.geocoding.NullGeocoder')
+GEOCODER_FILE = os.environ.get('GEOCODER_FILE', os.path.join(BASE_DIR, 'addresses.csv'))
 
 
 # Password validation
@@ -171,7 +212,8 @@ REST_FRAMEWORK = {
         # FIXME
         # Uncomment this later, doing this now for "csrf not provided" errors
         #'rest_framework.authentication.SessionAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # loads the user lazily, see accounts.authentication
+        'accounts.authentication.JWTAuthentication',
     ),
     'DEFAULT_PARSER_CLASSES': (
         'rest_framework.parsers.JSONParser',
@@ -180,6 +222,27 @@ REST_FRAMEWORK = {
     'DATE_INPUT_FORMATS': ['iso-8601', '%Y-%m-%dT%H:%M:%S.%fZ'],
 }
 
+# Stripe client, see payments.stripe_client
+STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_CONNECT_TIMEOUT = float(os.environ.get('STRIPE_CONNECT_TIMEOUT', 3))
+STRIPE_READ_TIMEOUT = float(os.environ.get('STRIPE_READ_TIMEOUT', 20))
+STRIPE_MAX_NETWORK_RETRIES = int(os.environ.get('STRIPE_MAX_NETWORK_RETRIES', 2))
+STRIPE_POOL_SIZE = int(os.environ.get('STRIPE_POOL_SIZE', 10))
+# connections the async views can have open to Stripe per process, see payments.stripe_client.acall
+STRIPE_ASYNC_POOL_SIZE = int(os.environ.get('STRIPE_ASYNC_POOL_SIZE', 200))
+# serve the Stripe views from api.v1.async_views, for the ASGI server (see therapy/gunicorn_asgi.py)
+ASYNC_STRIPE_VIEWS = os.environ.get('ASYNC_STRIPE_VIEWS', 'False') == 'True'
+
+# the bearer token Prometheus scrapes api/v1/metrics/ with, the endpoint answers 404 without one
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# times a request can run the same query, parameters aside, before it's logged as a likely N+1
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+
+# default page size of the v1 list endpoints, clients can ask for up to API_MAX_PAGE_SIZE with ?page_size=
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 20))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 100))
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
@@ -203,4 +266,12 @@ STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+# who sends the bytes of /media/ files, see images.views: X-Accel-Redirect for nginx, X-Sendfile for
+# Apache or lighttpd, empty to stream them from Django on local runs
+MEDIA_ACCEL_HEADER = os.environ.get('MEDIA_ACCEL_HEADER', '')
+# the nginx internal location aliasing MEDIA_ROOT
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media/')
+# resumable uploads of verification documents, see images.uploads; every web process must see the same directory
+UPLOAD_TEMP_DIR = os.environ.get('UPLOAD_TEMP_DIR', os.path.join(BASE_DIR, 'uploads'))
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 20 * 1024 * 1024))
 #django_heroku.settings(locals())
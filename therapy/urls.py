@@ -18,12 +18,14 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from images.views import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('rest-auth/', include('rest_auth.urls')),
     path('rest-auth/registration/', include('rest_auth.registration.urls')),
-    path('', include('api.urls'))
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)\
-  + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file
+    path('', include('api.urls')),
+    # verification documents are checked against the requester, see images.views
+    path(f'{settings.MEDIA_URL.strip("/")}/<path:path>', serve_media, name='media'),
+] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file